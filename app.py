@@ -1,147 +1,1440 @@
-from flask import Flask, request, render_template, redirect, url_for, send_from_directory
-from inky import Inky7Colour as Inky
-from PIL import Image
+import time
+STARTUP_STARTED = time.perf_counter()  # Startup is timed from the first import
+from flask import Flask, request, render_template, redirect, url_for, send_file, abort, jsonify
+from werkzeug.exceptions import HTTPException
 import os
-from datetime import datetime
-from apscheduler.schedulers.background import BackgroundScheduler
-import random
+from datetime import datetime, timedelta
 import shutil
 import logging
 from logging.handlers import RotatingFileHandler
 import traceback
-import RPi.GPIO as GPIO
 import json
+import threading
+import sqlite3
+import hashlib
+import hmac
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import uuid
+import re
+import urllib.error
+import urllib.parse
+import urllib.request
+import quantize
+import archives
+import backends
+import metrics
+import playlist
+import profiling
+from lazy import lazy_import
+from imaging import (ORIENTATION_0, ORIENTATION_90, ORIENTATION_180, ORIENTATION_270,
+                     get_capture_time, open_image, estimate_decode_memory, peak_rss_mb, current_rss_bytes,
+                     trim_memory, lower_thread_priority, flatten_to_rgb, display_size_for, master_size_for,
+                     master_decode_size, normalize_image, oriented_size, prepare_for_display,
+                     pack_frame, unpack_frame, perceptual_hash, hash_distance, open_image_covering,
+                     collage_layout, render_collage, COLLAGE_MAX_PHOTOS)
 
-# Set up logging
-log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-log_file = 'inky_frame.log'
-log_handler = RotatingFileHandler(log_file, maxBytes=1024*1024, backupCount=5)  # 1MB per file, keep 5 files
-log_handler.setFormatter(log_formatter)
+# Pillow and numpy are only imported when an image is first processed
+Image = lazy_import('PIL.Image')
+numpy = lazy_import('numpy')
 
 logger = logging.getLogger('inky_frame')
-logger.setLevel(logging.INFO)
-logger.addHandler(log_handler)
 
-# Also log to console for systemd journal
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(log_formatter)
-logger.addHandler(console_handler)
+def setup_logging():
+    """Log to a rotating file and to the console for the systemd journal"""
+    log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    log_file = 'inky_frame.log'
+    log_handler = RotatingFileHandler(log_file, maxBytes=1024*1024, backupCount=5)  # 1MB per file, keep 5 files
+    log_handler.setFormatter(log_formatter)
+
+    # Also log to console for systemd journal
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(log_formatter)
+
+    # waitress's warnings, such as requests queueing for a thread, go to the same places. Neither
+    # passes records on to the root logger, which waitress also sets up to print to the console
+    for named_logger in (logger, logging.getLogger('waitress')):
+        named_logger.setLevel(logging.INFO)
+        named_logger.addHandler(log_handler)
+        named_logger.addHandler(console_handler)
+        named_logger.propagate = False
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = os.path.abspath('photos')
-logger.info("Starting Inky Photo Frame application")
 
-# Ensure the upload folder exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-logger.info(f"Upload folder configured: {app.config['UPLOAD_FOLDER']}")
+# Cache of display-ready frames, keyed by photo content, orientation and resolution
+app.config['FRAME_CACHE_FOLDER'] = os.path.abspath(os.path.join('cache', 'frames'))
+
+# Thumbnails served to the web interface instead of full-size photos
+app.config['THUMBNAIL_FOLDER'] = os.path.abspath(os.path.join('cache', 'thumbnails'))
+THUMBNAIL_SIZES = {
+    'small': (300, 300),   # Gallery grid
+    'medium': (800, 600)   # Currently displaying section
+}
+
+# Number of photos shown per gallery page
+PHOTOS_PER_PAGE = 24
+
+# Catalog of photo metadata, kept in step with the upload folder
+CATALOG_FILE = 'catalog.db'
+
+# Photos whose perceptual hashes differ by at most this many bits are near-duplicates
+NEAR_DUPLICATE_DISTANCE = 6
+DUPLICATE_REPORT_FILE = os.path.join('cache', 'duplicates.json')
+duplicate_scan_lock = threading.Lock()
 
-# Handle static photos directory
+# Playlist order, saved so a restart carries on the same round. Recent
+# uploads and favourites are weighted to come up sooner.
+PLAYLIST_FILE = 'playlist.json'
+RECENT_UPLOAD_DAYS = 7
+RECENT_UPLOAD_WEIGHT = 3.0
+FAVOURITE_WEIGHT = 4.0
+
+# Uploads are spooled to disk and processed by a small worker pool, which
+# holds back new decodes while the estimated memory in use is over budget
+app.config['SPOOL_FOLDER'] = os.path.abspath(os.path.join('cache', 'spool'))
+UPLOAD_WORKERS = max(1, min(os.cpu_count() or 1, 4))
+UPLOAD_MEMORY_BUDGET = 128 * 1024 * 1024
+UPLOAD_BATCH_HISTORY = 20
+upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='upload')
+upload_memory_condition = threading.Condition()
+upload_memory_in_use = 0
+upload_batches = {}
+upload_batches_lock = threading.Lock()
+
+# Archive imports stream photos into the same worker pool. Each member is
+# copied to the upload spool, no bigger than IMPORT_MAX_MEMBER_SIZE, so none is
+# held in memory whole; only a few are spooled ahead of the workers at once.
+# Progress reports are saved so an interrupted import can be resumed.
+app.config['IMPORT_FOLDER'] = os.path.abspath(os.path.join('cache', 'imports'))
+IMPORT_MAX_MEMBER_SIZE = 50 * 1024 * 1024
+import_slots = threading.BoundedSemaphore(UPLOAD_WORKERS + 1)
+
+# The web page sends each photo in chunks, assembled here before being spooled,
+# so a dropped connection only costs the chunk that was being sent. Uploads
+# that are never finished are removed after CHUNK_UPLOAD_EXPIRY_HOURS.
+app.config['CHUNK_FOLDER'] = os.path.abspath(os.path.join('cache', 'chunks'))
+UPLOAD_CHUNK_SIZE = 256 * 1024
+UPLOAD_MAX_FILE_SIZE = 50 * 1024 * 1024
+CHUNK_UPLOAD_EXPIRY_HOURS = 48
+chunk_upload_lock = threading.Lock()
+
+# Photos are stored as masters no bigger than they are shown in either panel
+# orientation. Normalizing the library re-encodes photos stored before that,
+# at low priority, optionally moving the originals to ORIGINALS_FOLDER. Its
+# report is saved after every photo so an interrupted run can carry on.
+app.config['ORIGINALS_FOLDER'] = os.path.abspath('originals')
+NORMALIZE_REPORT_FILE = os.path.join('cache', 'normalize.json')
+NORMALIZE_PAUSE_SECONDS = 0.5
+normalize_lock = threading.Lock()
+
+# Photos and thumbnails are served from their own folders by the /photos and
+# /thumbnails routes. URLs carrying the content hash as ?v= never change
+# content, so browsers may cache them for good.
+PHOTO_CACHE_SECONDS = 365 * 24 * 60 * 60
+PHOTO_VERSION_LENGTH = 16
+
+# Where older versions mirrored the upload folder for static serving
 static_photos_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'photos')
 
-try:
-    # Remove existing symlink or directory if it exists
-    if os.path.islink(static_photos_dir):
-        os.unlink(static_photos_dir)
-        logger.info("Removed existing symlink")
-    elif os.path.exists(static_photos_dir):
-        shutil.rmtree(static_photos_dir)
-        logger.info("Removed existing static photos directory")
-
-    # Create new symlink
-    os.symlink(app.config['UPLOAD_FOLDER'], static_photos_dir)
-    logger.info("Created symlink for static photos")
-except Exception as e:
-    logger.warning(f"Could not create symlink: {e}")
-    # If symlink fails, try to create directory and copy files
-    try:
-        os.makedirs(static_photos_dir, exist_ok=True)
-        for file in os.listdir(app.config['UPLOAD_FOLDER']):
-            src = os.path.join(app.config['UPLOAD_FOLDER'], file)
-            dst = os.path.join(static_photos_dir, file)
-            if os.path.isfile(src):
-                shutil.copy2(src, dst)
-        logger.info("Created static photos directory and copied files")
-    except Exception as e:
-        logger.error(f"Error setting up static photos directory: {e}")
-
-# Initialize the Inky display
-try:
-    display = Inky(resolution=(600, 448))
-    logger.info(f"Successfully initialized Inky display: {display.width}x{display.height}")
-except Exception as e:
-    logger.error(f"Could not initialize Inky display: {e}\n{traceback.format_exc()}")
-    display = None
-
-def get_random_image():
-    """Get a random image from the photos directory"""
-    try:
-        photos = [f for f in os.listdir(app.config['UPLOAD_FOLDER']) 
-                if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-        logger.info(f"Found {len(photos)} photos in directory")
-        if photos:
-            chosen_photo = random.choice(photos)
-            logger.info(f"Selected random photo: {chosen_photo}")
-            return os.path.join(app.config['UPLOAD_FOLDER'], chosen_photo)
-        logger.warning("No photos available to display")
+def remove_static_photos():
+    """Remove the static photos symlink or copy left by older versions"""
+    try:
+        if os.path.islink(static_photos_dir):
+            os.unlink(static_photos_dir)
+            logger.info("Removed static photos symlink")
+        elif os.path.isdir(static_photos_dir):
+            shutil.rmtree(static_photos_dir)
+            logger.info("Removed static photos copy")
+    except Exception as e:
+        logger.error(f"Error removing static photos directory: {e}")
+
+# Serving. python app.py runs waitress, a production WSGI server with a fixed
+# pool of SERVER_THREADS that buffers request bodies to disk, or Flask's
+# development server when INKY_FRAME_SERVER=development or waitress isn't
+# installed. It is always one process, as the display, refresh queue and
+# upload pool belong to it. Requests that decode or render images hold one of
+# IMAGE_REQUEST_SLOTS, and new uploads are refused while UPLOAD_QUEUE_LIMIT
+# photos are waiting; both are answered with 503 and Retry-After. Request
+# bodies are limited to MAX_CONTENT_LENGTH, except for the upload routes.
+# waitress reads a whole body before the app sees it, so those per-route limits
+# only apply afterwards, and it turns away anything bigger than a form upload
+# itself. Bigger archives are imported from a path on the frame, which only
+# clients on the frame itself may give.
+SERVER = os.environ.get('INKY_FRAME_SERVER', 'production')
+SERVER_PORT = 5000
+SERVER_THREADS = 4
+SERVER_CONNECTION_LIMIT = 32
+IMAGE_REQUEST_SLOTS = 2
+IMAGE_REQUEST_WAIT_SECONDS = 2
+UPLOAD_QUEUE_LIMIT = 200
+RETRY_AFTER_SECONDS = 10
+app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024
+UPLOAD_MAX_REQUEST_SIZE = 256 * 1024 * 1024
+IMPORT_MIN_FREE_SPACE = 256 * 1024 * 1024  # Left free beyond a sent archive before an import starts
+image_request_slots = threading.BoundedSemaphore(IMAGE_REQUEST_SLOTS)
+
+# Display and button backends; the stand-ins let the app run off a Raspberry Pi
+DISPLAY_BACKEND = os.environ.get('INKY_FRAME_DISPLAY', backends.DISPLAY_INKY)
+BUTTON_BACKEND = os.environ.get('INKY_FRAME_BUTTONS', backends.BUTTONS_GPIO)
+DISPLAY_RESOLUTION = (600, 448)
+
+# Render server mode. A frame with INKY_FRAME_RENDER_SERVER set fetches its
+# packed frames from that server by photo content hash, rendering them itself
+# only when the server doesn't answer. The server renders each frame size,
+# orientation and colours it is asked for, and remembers them so new uploads
+# are rendered for the whole fleet ahead of time. Only the RENDER_TARGETS_LIMIT
+# targets asked for most recently are remembered, each for RENDER_TARGET_EXPIRY_DAYS
+# after it was last asked for, and new uploads are rendered for them one frame
+# at a time on a single low-priority thread.
+RENDER_SERVER = os.environ.get('INKY_FRAME_RENDER_SERVER')
+RENDER_SERVER_TIMEOUT = 10
+RENDER_SERVER_RETRY_SECONDS = 300
+RENDER_TARGETS_FILE = os.path.join('cache', 'render_targets.json')
+RENDER_TARGETS_LIMIT = 8
+RENDER_TARGET_EXPIRY_DAYS = 30
+RENDER_MAX_SIDE = 2048  # Largest frame width or height served
+render_server_retry_at = 0.0
+render_targets = {}
+render_targets_lock = threading.Lock()
+render_target_backlog = []  # Photos waiting to be rendered for every render target
+render_target_build_lock = threading.Lock()
+
+# On-demand profiling, served on /profile only when INKY_FRAME_PROFILE_TOKEN is
+# set and to requests carrying it as a bearer token. A profiled refresh or
+# upload runs under cProfile and tracemalloc, which slow it down several times;
+# the stack sampler is cheap enough to leave running on a frame in use.
+PROFILE_TOKEN = os.environ.get('INKY_FRAME_PROFILE_TOKEN')
+app.config['PROFILE_FOLDER'] = os.path.abspath(os.path.join('cache', 'profiles'))
+PROFILE_TOP = 25
+PROFILE_TIMEOUT = 600
+PROFILE_MAX_SAMPLE_MINUTES = 60
+profile_lock = threading.Lock()
+sampler = profiling.Sampler()
+
+# The display is set up in the background at startup, and stays None if that fails
+display = None
+
+def init_display():
+    """Initialize the display backend"""
+    global display
+    try:
+        display = backends.create_display(DISPLAY_BACKEND, DISPLAY_RESOLUTION, os.path.join('cache', 'displayed'))
+        logger.info(f"Successfully initialized {DISPLAY_BACKEND} display: {display.width}x{display.height}")
+    except Exception as e:
+        logger.error(f"Could not initialize {DISPLAY_BACKEND} display: {e}\n{traceback.format_exc()}")
+        display = None
+
+# Serialize access to the display buffer
+display_lock = threading.Lock()
+
+# What the panel is showing, so a restart can leave it alone. The fingerprint
+# of the last frame sent lets a refresh that wouldn't change anything skip
+# the slow panel update.
+DISPLAY_STATE_FILE = 'display_state.json'
+shown_fingerprint = None
+last_show_time = None  # time.monotonic() of the last panel update, for the refresh rate limit
+
+# Metrics exposed on /metrics; gauges are read when scraped
+update_seconds = metrics.Histogram(
+    'inky_frame_display_update_seconds', "Time taken by a whole display refresh", ['result'])
+update_stage_seconds = metrics.Histogram(
+    'inky_frame_display_update_stage_seconds', "Time taken by each stage of a display refresh", ['stage'])
+refresh_requests = metrics.Counter(
+    'inky_frame_display_refresh_requests', "Display refreshes requested, by trigger", ['trigger'])
+refreshes = metrics.Counter(
+    'inky_frame_display_refreshes', "Display refreshes run, by trigger and result", ['trigger', 'result'])
+refreshes_coalesced = metrics.Counter(
+    'inky_frame_display_refreshes_coalesced', "Queued display refreshes replaced by a newer request")
+refreshes_skipped = metrics.Counter(
+    'inky_frame_display_refreshes_skipped', "Panel updates avoided, by reason", ['reason'])
+requests_rejected = metrics.Counter(
+    'inky_frame_requests_rejected', "Requests turned away with 503, by reason", ['reason'])
+frame_cache_lookups = metrics.Counter(
+    'inky_frame_frame_cache_lookups', "Frame cache lookups, by result", ['result'])
+upload_file_seconds = metrics.Histogram(
+    'inky_frame_upload_file_seconds', "Time taken to process one uploaded photo", ['result'])
+upload_batch_seconds = metrics.Histogram(
+    'inky_frame_upload_batch_seconds', "Time from an upload batch arriving to its last photo being processed")
+metrics.Gauge('inky_frame_library_photos', "Photos in the catalog", function=lambda: count_photos())
+metrics.Gauge('inky_frame_display_refresh_queue_depth', "Display refreshes pending or running",
+              function=lambda: int(pending_refresh is not None) + int(running_refresh is not None))
+metrics.Gauge('inky_frame_upload_queue_depth', "Uploaded photos waiting for or being processed",
+              function=lambda: upload_queue_depth())
+metrics.Gauge('inky_frame_process_resident_memory_bytes', "Resident memory of the app process",
+              function=current_rss_bytes)
+startup_seconds = metrics.Gauge(
+    'inky_frame_startup_seconds', "Time taken by each startup phase", ['phase'])
+
+def frame_signature(colours=None):
+    """Get a signature of a dither mode and palette, the current settings by default, for frame cache keys"""
+    colours = colours or display_colours()
+    palette = quantize.blend_palette(colours.get('saturation', 0.5), colours.get('palette'))
+    return quantize.palette_signature(colours.get('dither', quantize.DITHER_DIFFUSION), palette)
+
+def frame_cache_path(photo, orientation, resolution=None, colours=None):
+    """Get the cache path of the display-ready frame for a photo, for this display unless told otherwise"""
+    width, height = resolution or (display.width, display.height)
+    filename = f"{artifact_key(photo)}.{orientation}.{width}x{height}.{frame_signature(colours)}.frame"
+    return os.path.join(app.config['FRAME_CACHE_FOLDER'], filename)
+
+def load_cached_frame(photo, orientation, resolution=None, colours=None):
+    """Load a cached frame, or None if it is missing or older than the photo"""
+    width, height = resolution or (display.width, display.height)
+    cache_path = frame_cache_path(photo, orientation, resolution, colours)
+    image_path = os.path.join(app.config['UPLOAD_FOLDER'], photo)
+    try:
+        if os.path.getmtime(cache_path) < os.path.getmtime(image_path):
+            logger.info(f"Cached frame is stale: {os.path.basename(cache_path)}")
+            return None
+        with open(cache_path, 'rb') as f:
+            data = f.read()
+        if len(data) * 2 != width * height:
+            logger.warning(f"Cached frame has unexpected size: {os.path.basename(cache_path)}")
+            return None
+        return unpack_frame(data, width, height)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"Error loading cached frame for {photo}: {e}")
+        return None
+
+def write_frame_file(cache_path, data):
+    """Write a packed frame to the frame cache"""
+    # The next frame may be rendered in the background while a refresh renders the same photo
+    temp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, cache_path)
+    logger.info(f"Cached frame: {os.path.basename(cache_path)}")
+
+def save_cached_frame(photo, orientation, frame, resolution=None, colours=None):
+    """Save a quantized frame to the frame cache"""
+    try:
+        write_frame_file(frame_cache_path(photo, orientation, resolution, colours), pack_frame(frame))
+    except Exception as e:
+        logger.error(f"Error saving cached frame for {photo}: {e}")
+
+def quantize_for_display(image, colours=None):
+    """Quantize an image to the panel palette, returning its palette index buffer.
+
+    Uses the current colour settings unless given a dict of dither,
+    saturation and palette.
+    """
+    colours = colours or display_colours()
+    frame = quantize.quantize_image(image, colours.get('dither', quantize.DITHER_DIFFUSION),
+                                    colours.get('saturation', 0.5), colours.get('palette'))
+    return numpy.asarray(frame, dtype=numpy.uint8)
+
+def render_frame(photo, orientation, resolution=None, colours=None):
+    """Get the quantized frame for a photo, using the frame cache when possible.
+
+    Frames for this display are fetched from the render server, when one is
+    set, before being rendered here. Other resolutions and colours are
+    rendered for frames that use this one as their render server.
+    """
+    # One snapshot of the colour settings, so a change meanwhile can't file the frame under the wrong key
+    own_colours = colours is None
+    colours = colours or display_colours()
+    with update_stage_seconds.time(stage='cache_load'):
+        frame = load_cached_frame(photo, orientation, resolution, colours)
+    if frame is not None:
+        logger.info(f"Using cached frame for {photo}")
+        frame_cache_lookups.inc(result='hit')
+        return frame
+
+    if RENDER_SERVER and resolution is None and own_colours:
+        with update_stage_seconds.time(stage='fetch'):
+            frame = fetch_server_frame(photo, orientation, colours)
+        if frame is not None:
+            frame_cache_lookups.inc(result='server')
+            return frame
+    frame_cache_lookups.inc(result='miss')
+
+    resolution = resolution or (display.width, display.height)
+    image_path = os.path.join(app.config['UPLOAD_FOLDER'], photo)
+    logger.info(f"Opening image: {image_path}")
+    with update_stage_seconds.time(stage='open'):
+        image = open_image(image_path, display_size_for(orientation, resolution))
+
+    # Prepare image for display with current orientation
+    with update_stage_seconds.time(stage='prepare'):
+        display_image = prepare_for_display(image, orientation, resolution)
+    logger.info(f"Prepared image for display (peak RSS {peak_rss_mb()}MB)")
+
+    # Quantize to the display palette and keep the result for next time
+    with update_stage_seconds.time(stage='quantize'):
+        frame = quantize_for_display(display_image, colours)
+    save_cached_frame(photo, orientation, frame, resolution, colours)
+    return frame
+
+def fetch_server_frame(photo, orientation, colours):
+    """Get a photo's frame for this display from the render server, or None if it can't provide one.
+
+    A frame already cached here but older than the photo is revalidated
+    with a conditional GET instead of being fetched again. After the server
+    fails to answer it is left alone for RENDER_SERVER_RETRY_SECONDS.
+    """
+    global render_server_retry_at
+    if time.monotonic() < render_server_retry_at:
+        return None
+    cache_path = frame_cache_path(photo, orientation, colours=colours)
+    query = {'width': display.width, 'height': display.height, 'orientation': orientation,
+             'dither': colours['dither'], 'saturation': colours['saturation']}
+    if colours['palette']:
+        query['palette'] = ','.join(str(c) for colour in colours['palette'] for c in colour)
+    url = f"{RENDER_SERVER.rstrip('/')}/frames/{artifact_key(photo)}?{urllib.parse.urlencode(query)}"
+    headers = {}
+    if os.path.exists(cache_path):
+        headers['If-None-Match'] = f'"{frame_etag(cache_path)}"'
+
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers),
+                                    timeout=RENDER_SERVER_TIMEOUT) as response:
+            data = response.read()
+        if len(data) * 2 != display.width * display.height:
+            raise ValueError(f"Frame has unexpected size {len(data)}")
+        write_frame_file(cache_path, data)
+        logger.info(f"Fetched frame for {photo} from the render server")
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            os.utime(cache_path)  # The cached frame is still right, so it is no longer stale
+            with open(cache_path, 'rb') as f:
+                data = f.read()
+            logger.info(f"Render server confirmed the cached frame for {photo}")
+        else:
+            if e.code == 503:
+                # The server is busy; come back when it asks rather than leaving it for the full wait
+                retry_after = e.headers.get('Retry-After', '')
+                render_server_retry_at = time.monotonic() + (int(retry_after) if retry_after.isdigit()
+                                                              else RENDER_SERVER_RETRY_SECONDS)
+            elif e.code != 404:
+                render_server_retry_at = time.monotonic() + RENDER_SERVER_RETRY_SECONDS
+            logger.warning(f"Render server could not provide a frame for {photo} ({e.code}), rendering locally")
+            return None
+    except Exception as e:
+        render_server_retry_at = time.monotonic() + RENDER_SERVER_RETRY_SECONDS
+        logger.warning(f"Render server unavailable ({e}), rendering locally for "
+                       f"{RENDER_SERVER_RETRY_SECONDS}s")
+        return None
+    return unpack_frame(data, display.width, display.height)
+
+def frame_etag(cache_path):
+    """Get the ETag of a cached frame, which names the photo contents, orientation, size and colours"""
+    return os.path.basename(cache_path)[:-len('.frame')]
+
+def build_frame_cache(photos, orientation, resolution=None, colours=None):
+    """Build cached frames for the given photos in the background"""
+    if not display and resolution is None:
+        return
+    for photo in photos:
+        try:
+            if not os.path.exists(frame_cache_path(photo, orientation, resolution, colours)):
+                render_frame(photo, orientation, resolution, colours)
+        except Exception as e:
+            logger.error(f"Error building cached frame for {photo}: {e}\n{traceback.format_exc()}")
+    logger.info(f"Frame cache build finished for {len(photos)} photos")
+
+def start_frame_cache_build(photos, orientation, resolution=None, colours=None):
+    """Start building cached frames on a background thread"""
+    thread = threading.Thread(target=build_frame_cache, args=(list(photos), orientation, resolution, colours),
+                              daemon=True)
+    thread.start()
+
+def remember_render_target(resolution, orientation, colours):
+    """Note a frame size, orientation and colours a client has been served, so new photos are rendered for it.
+
+    The least recently requested targets are forgotten beyond RENDER_TARGETS_LIMIT.
+    The saved list is only rewritten for a new target or once a day per target.
+    """
+    key = f"{orientation}.{resolution[0]}x{resolution[1]}.{frame_signature(colours)}"
+    now = datetime.now()
+    with render_targets_lock:
+        previous = render_targets.get(key)
+        render_targets[key] = {'resolution': list(resolution), 'orientation': orientation, 'colours': colours,
+                               'last_requested': now.isoformat()}
+        if previous and datetime.fromisoformat(previous['last_requested']) > now - timedelta(days=1):
+            return
+        forgotten = expire_render_targets()
+        targets = dict(render_targets)
+    if not previous:
+        logger.info(f"New render target: {key}")
+    delete_render_target_frames(forgotten)
+    temp_path = f"{RENDER_TARGETS_FILE}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(targets, f, indent=2)
+        os.replace(temp_path, RENDER_TARGETS_FILE)
+    except Exception as e:
+        logger.error(f"Error saving render targets: {e}")
+
+def expire_render_targets():
+    """Forget render targets not asked for in RENDER_TARGET_EXPIRY_DAYS, and the oldest beyond RENDER_TARGETS_LIMIT.
+
+    Must be called holding render_targets_lock. Returns the keys forgotten.
+    """
+    cutoff = (datetime.now() - timedelta(days=RENDER_TARGET_EXPIRY_DAYS)).isoformat()
+    recent = sorted(render_targets.items(), key=lambda item: item[1]['last_requested'], reverse=True)
+    forgotten = []
+    for rank, (key, target) in enumerate(recent):
+        if rank >= RENDER_TARGETS_LIMIT or target['last_requested'] < cutoff:
+            del render_targets[key]
+            forgotten.append(key)
+            logger.info(f"Forgot render target: {key}")
+    return forgotten
+
+def delete_render_target_frames(keys):
+    """Remove the cached frames rendered for forgotten render targets, unless this display uses them too"""
+    suffixes = tuple(f".{key}.frame" for key in keys if not own_frame_layout(key))
+    if not suffixes:
+        return
+    for entry in os.scandir(app.config['FRAME_CACHE_FOLDER']):
+        if entry.name.endswith(suffixes):
+            try:
+                os.remove(entry.path)
+            except OSError as e:
+                logger.error(f"Error deleting cached frame {entry.name}: {e}")
+
+def own_frame_layout(layout):
+    """Check whether a frame layout, 'orientation.WxH.signature' as in frame cache names, is this display's.
+
+    Only frames for the current colour settings count, in any orientation.
+    """
+    width, height = (display.width, display.height) if display else DISPLAY_RESOLUTION
+    parts = layout.split('.')
+    return len(parts) == 3 and parts[1] == f"{width}x{height}" and parts[2] == frame_signature()
+
+def load_render_targets():
+    """Load the render targets clients have asked for before"""
+    global render_targets
+    try:
+        with open(RENDER_TARGETS_FILE) as f:
+            render_targets = json.load(f)
+        with render_targets_lock:
+            expire_render_targets()
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Could not load render targets: {e}")
+
+def build_render_targets():
+    """Render the photos in the backlog for every render target, one frame at a time at low priority"""
+    if not render_target_build_lock.acquire(blocking=False):
+        return  # The running build picks up the new photos
+    try:
+        lower_thread_priority(19)
+        while True:
+            with render_targets_lock:
+                if not render_target_backlog:
+                    return
+                photo = render_target_backlog.pop(0)
+                expire_render_targets()
+                targets = list(render_targets.values())
+            for target in targets:
+                resolution = tuple(target['resolution'])
+                # Shares the slots of image requests, waiting as long as it takes rather than being turned away
+                with image_request_slots:
+                    try:
+                        if not os.path.exists(frame_cache_path(photo, target['orientation'], resolution,
+                                                               target['colours'])):
+                            render_frame(photo, target['orientation'], resolution, target['colours'])
+                    except FileNotFoundError:
+                        break  # Deleted meanwhile
+                    except Exception as e:
+                        logger.error(f"Error rendering {photo} for a render target: {e}\n{traceback.format_exc()}")
+                    finally:
+                        trim_memory()
+    finally:
+        render_target_build_lock.release()
+
+def start_render_target_builds(photos):
+    """Render new photos for every client of this render server in the background"""
+    with render_targets_lock:
+        if not render_targets:
+            return
+        render_target_backlog.extend(photo for photo in photos if photo not in render_target_backlog)
+    threading.Thread(target=build_render_targets, name='render-targets', daemon=True).start()
+
+def delete_cached_frames(key):
+    """Remove all cached frames stored under a content hash"""
+    prefix = f"{key}."
+    for filename in os.listdir(app.config['FRAME_CACHE_FOLDER']):
+        if filename.startswith(prefix) and filename.endswith('.frame'):
+            try:
+                os.remove(os.path.join(app.config['FRAME_CACHE_FOLDER'], filename))
+                logger.info(f"Deleted cached frame: {filename}")
+            except Exception as e:
+                logger.error(f"Error deleting cached frame {filename}: {e}")
+
+def thumbnail_path(photo, size_name):
+    """Get the path of a photo's thumbnail at the given size"""
+    return os.path.join(app.config['THUMBNAIL_FOLDER'], size_name, f"{artifact_key(photo)}.jpg")
+
+def create_thumbnails(photo, image=None):
+    """Create all thumbnail sizes for a photo, largest first so each reuses the last"""
+    if image is None:
+        image = open_image(os.path.join(app.config['UPLOAD_FOLDER'], photo), THUMBNAIL_SIZES['medium'])
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    sizes = sorted(THUMBNAIL_SIZES.items(), key=lambda item: item[1][0] * item[1][1], reverse=True)
+    for size_name, size in sizes:
+        thumbnail = image.copy()
+        thumbnail.thumbnail(size, Image.Resampling.LANCZOS)
+        # Browsers may ask for a missing thumbnail more than once at a time
+        path = thumbnail_path(photo, size_name)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        thumbnail.save(temp_path, 'JPEG', quality=80)
+        os.replace(temp_path, path)
+        image = thumbnail
+    logger.info(f"Created thumbnails for {photo}")
+
+def delete_thumbnails(key):
+    """Remove all thumbnails stored under a content hash"""
+    for size_name in THUMBNAIL_SIZES:
+        path = os.path.join(app.config['THUMBNAIL_FOLDER'], size_name, f"{key}.jpg")
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except Exception as e:
+            logger.error(f"Error deleting {size_name} thumbnail {key}: {e}")
+
+def delete_unused_artifacts(key):
+    """Remove the cached frames and thumbnails for a content hash once no photo uses it"""
+    if not key:
+        return
+    with closing(catalog_connection()) as conn:
+        in_use = conn.execute("SELECT 1 FROM photos WHERE content_hash = ? LIMIT 1", (key,)).fetchone()
+    if not in_use:
+        delete_cached_frames(key)
+        delete_thumbnails(key)
+
+def prune_artifacts():
+    """Remove cached frames and thumbnails that no catalogued photo uses, such as old filename-keyed ones"""
+    try:
+        started = time.time()
+        with closing(catalog_connection()) as conn:
+            keys = {row['content_hash'] for row in conn.execute("SELECT DISTINCT content_hash FROM photos")}
+        with render_targets_lock:
+            targets = set(render_targets)
+        def unused_frame(name):
+            key, _, layout = name[:-len('.frame')].partition('.')
+            # Nor are frames for colour settings since changed or render targets since forgotten
+            return key not in keys or not (layout in targets or own_frame_layout(layout))
+        unused = [(app.config['FRAME_CACHE_FOLDER'], unused_frame)]
+        unused += [(os.path.join(app.config['THUMBNAIL_FOLDER'], size_name),
+                    lambda name: os.path.splitext(name)[0] not in keys) for size_name in THUMBNAIL_SIZES]
+        removed = 0
+        for folder, is_unused in unused:
+            for entry in os.scandir(folder):
+                # Leave anything written since the catalog was read
+                if entry.is_file() and is_unused(entry.name) and entry.stat().st_mtime < started:
+                    os.remove(entry.path)
+                    removed += 1
+        logger.info(f"Pruned {removed} unused cached frames and thumbnails")
+    except Exception as e:
+        logger.error(f"Error pruning cached artifacts: {e}\n{traceback.format_exc()}")
+
+def backfill_thumbnails():
+    """Create missing thumbnails for photos uploaded before thumbnails existed"""
+    try:
+        photos = list_photos()
+        missing = [photo for photo in photos
+                   if not all(os.path.exists(thumbnail_path(photo, size_name)) for size_name in THUMBNAIL_SIZES)]
+        logger.info(f"Thumbnail backfill started for {len(missing)} photos")
+        for photo in missing:
+            try:
+                create_thumbnails(photo)
+            except Exception as e:
+                logger.error(f"Error creating thumbnails for {photo}: {e}")
+        logger.info("Thumbnail backfill finished")
+    except Exception as e:
+        logger.error(f"Error in thumbnail backfill: {e}\n{traceback.format_exc()}")
+
+def catalog_connection():
+    """Open a connection to the photo catalog"""
+    conn = sqlite3.connect(CATALOG_FILE, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def init_catalog():
+    """Create the photo catalog tables if they don't exist"""
+    with closing(catalog_connection()) as conn, conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS photos (
+                filename TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                file_size INTEGER NOT NULL,
+                width INTEGER NOT NULL,
+                height INTEGER NOT NULL,
+                captured_at TEXT,
+                uploaded_at TEXT NOT NULL,
+                mtime REAL NOT NULL,
+                source_hash TEXT,
+                phash TEXT,
+                favourite INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        # Add columns to catalogs created before them
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(photos)")}
+        for column, definition in (('source_hash', 'TEXT'), ('phash', 'TEXT'),
+                                   ('favourite', 'INTEGER NOT NULL DEFAULT 0')):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE photos ADD COLUMN {column} {definition}")
+        conn.execute("CREATE INDEX IF NOT EXISTS photos_captured_at ON photos (captured_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS photos_uploaded_at ON photos (uploaded_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS photos_content_hash ON photos (content_hash)")
+        conn.execute("CREATE INDEX IF NOT EXISTS photos_source_hash ON photos (source_hash)")
+    logger.info(f"Photo catalog ready: {CATALOG_FILE}")
+
+def hash_file(file_path):
+    """Calculate the SHA-256 hash of a file's contents"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_upload_time(filename, file_path):
+    """Get the upload time from the filename timestamp, falling back to the file's mtime"""
+    try:
+        return datetime.strptime(filename[:15], '%Y%m%d_%H%M%S').isoformat()
+    except ValueError:
+        return datetime.fromtimestamp(os.path.getmtime(file_path)).isoformat()
+
+def catalog_add(filename, captured_at=None, uploaded_at=None, source_hash=None, phash=None):
+    """Add or refresh a photo in the catalog from the file on disk.
+
+    The hash of the original upload is kept when refreshing, and the
+    perceptual hash too unless the contents have changed.
+    """
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    stat = os.stat(file_path)
+    # Opening only reads the header, the pixels aren't decoded
+    with Image.open(file_path) as image:
+        width, height = image.size
+        if captured_at is None:
+            captured_at = get_capture_time(image)
+    if uploaded_at is None:
+        uploaded_at = get_upload_time(filename, file_path)
+
+    with closing(catalog_connection()) as conn, conn:
+        conn.execute(
+            "INSERT INTO photos "
+            "(filename, content_hash, file_size, width, height, captured_at, uploaded_at, mtime, source_hash, phash) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (filename) DO UPDATE SET "
+            "file_size = excluded.file_size, width = excluded.width, height = excluded.height, "
+            "captured_at = excluded.captured_at, uploaded_at = excluded.uploaded_at, mtime = excluded.mtime, "
+            "source_hash = COALESCE(excluded.source_hash, source_hash), "
+            "phash = CASE WHEN excluded.content_hash = content_hash THEN COALESCE(excluded.phash, phash) "
+            "ELSE excluded.phash END, "
+            "content_hash = excluded.content_hash",
+            (filename, hash_file(file_path), stat.st_size, width, height, captured_at, uploaded_at, stat.st_mtime,
+             source_hash, phash))
+    logger.info(f"Catalogued photo: {filename}")
+
+def artifact_key(photo):
+    """Get the content hash a photo's cached frames and thumbnails are stored under"""
+    with closing(catalog_connection()) as conn:
+        row = conn.execute("SELECT content_hash FROM photos WHERE filename = ?", (photo,)).fetchone()
+    if row:
+        return row['content_hash']
+    # Not catalogued yet, so hash the file itself
+    return hash_file(os.path.join(app.config['UPLOAD_FOLDER'], photo))
+
+def photo_versions(photos):
+    """Get the ?v= version of each catalogued photo's URLs, from its content hash"""
+    photos = [photo for photo in photos if photo]
+    if not photos:
+        return {}
+    with closing(catalog_connection()) as conn:
+        rows = conn.execute(f"SELECT filename, content_hash FROM photos WHERE filename IN ({','.join('?' * len(photos))})",
+                            photos).fetchall()
+    return {row['filename']: row['content_hash'][:PHOTO_VERSION_LENGTH] for row in rows}
+
+def find_duplicate(source_hash):
+    """Get the catalogued photo an upload is an exact copy of, or None"""
+    with closing(catalog_connection()) as conn:
+        # A stored photo uploaded again matches its content hash rather than its source hash
+        row = conn.execute("SELECT filename FROM photos WHERE source_hash = ? OR content_hash = ? LIMIT 1",
+                           (source_hash, source_hash)).fetchone()
+    return row['filename'] if row else None
+
+def photo_for_key(key):
+    """Get a catalogued photo with the given content hash, or the hash of the file it was stored from, or None"""
+    with closing(catalog_connection()) as conn:
+        # Frames that stored the same upload themselves may have kept it as sent or re-encoded it differently
+        row = conn.execute("SELECT filename FROM photos WHERE content_hash = ? OR source_hash = ? "
+                           "ORDER BY content_hash = ? DESC LIMIT 1", (key, key, key)).fetchone()
+    return row['filename'] if row else None
+
+def find_similar_photo(filename):
+    """Get the catalogued photo most like the given one, or None if none are near-duplicates"""
+    with closing(catalog_connection()) as conn:
+        row = conn.execute("SELECT phash FROM photos WHERE filename = ?", (filename,)).fetchone()
+        if not row or not row['phash']:
+            return None
+        candidates = conn.execute("SELECT filename, phash FROM photos WHERE phash IS NOT NULL AND filename != ?",
+                                  (filename,)).fetchall()
+    distances = [(hash_distance(row['phash'], candidate['phash']), candidate['filename']) for candidate in candidates]
+    distance, similar = min(distances, default=(None, None))
+    return similar if distance is not None and distance <= NEAR_DUPLICATE_DISTANCE else None
+
+def catalog_remove(filename):
+    """Remove a photo from the catalog"""
+    with closing(catalog_connection()) as conn, conn:
+        conn.execute("DELETE FROM photos WHERE filename = ?", (filename,))
+
+def set_favourite(filename, favourite):
+    """Mark or unmark a photo as a favourite"""
+    with closing(catalog_connection()) as conn, conn:
+        conn.execute("UPDATE photos SET favourite = ? WHERE filename = ?", (int(bool(favourite)), filename))
+
+def favourite_photos():
+    """Get the filenames of all favourite photos"""
+    with closing(catalog_connection()) as conn:
+        return {row['filename'] for row in conn.execute("SELECT filename FROM photos WHERE favourite")}
+
+def catalog_clear():
+    """Remove every photo from the catalog"""
+    with closing(catalog_connection()) as conn, conn:
+        conn.execute("DELETE FROM photos")
+
+def reconcile_catalog():
+    """Bring the catalog in line with files added, changed or removed outside the app"""
+    try:
+        on_disk = {}
+        for entry in os.scandir(app.config['UPLOAD_FOLDER']):
+            if entry.is_file() and entry.name.lower().endswith(('.png', '.jpg', '.jpeg')):
+                stat = entry.stat()
+                if stat.st_size:  # Empty files are names reserved for photos still being processed
+                    on_disk[entry.name] = (stat.st_size, stat.st_mtime)
+
+        with closing(catalog_connection()) as conn:
+            catalogued = {row['filename']: (row['file_size'], row['mtime'])
+                          for row in conn.execute("SELECT filename, file_size, mtime FROM photos")}
+
+        removed = [filename for filename in catalogued if filename not in on_disk]
+        changed = [filename for filename, info in on_disk.items() if catalogued.get(filename) != info]
+
+        for filename in removed:
+            catalog_remove(filename)
+            logger.info(f"Removed missing photo from catalog: {filename}")
+        for filename in changed:
+            try:
+                catalog_add(filename)
+            except Exception as e:
+                logger.error(f"Error cataloguing photo {filename}: {e}")
+
+        logger.info(f"Catalog reconciled: {len(changed)} added or updated, {len(removed)} removed")
+        photo_playlist.sync(list_photos(unique=True))
+    except Exception as e:
+        logger.error(f"Error reconciling catalog: {e}\n{traceback.format_exc()}")
+
+# Sort keys and shape filters accepted by list_photos
+CATALOG_SORTS = {
+    'name': 'filename',
+    'uploaded': 'uploaded_at',
+    'captured': 'COALESCE(captured_at, uploaded_at)',
+    'size': 'file_size'
+}
+CATALOG_SHAPES = {
+    'landscape': 'width > height',
+    'portrait': 'width < height',
+    'square': 'width = height'
+}
+
+def list_photos(sort='name', descending=False, shape=None, limit=None, offset=0, unique=False):
+    """List catalogued photo filenames, optionally sorted, filtered and paged.
+
+    With unique, photos with the same contents are listed once.
+    """
+    query = "SELECT MIN(filename) AS filename FROM photos" if unique else "SELECT filename FROM photos"
+    if shape in CATALOG_SHAPES:
+        query += f" WHERE {CATALOG_SHAPES[shape]}"
+    if unique:
+        query += " GROUP BY content_hash"
+    query += f" ORDER BY {CATALOG_SORTS.get(sort, 'filename')} {'DESC' if descending else 'ASC'}, filename"
+    params = ()
+    if limit is not None:
+        query += " LIMIT ? OFFSET ?"
+        params = (limit, offset)
+    with closing(catalog_connection()) as conn:
+        return [row['filename'] for row in conn.execute(query, params)]
+
+def count_photos(shape=None):
+    """Count catalogued photos, optionally filtered by shape"""
+    query = "SELECT COUNT(*) FROM photos"
+    if shape in CATALOG_SHAPES:
+        query += f" WHERE {CATALOG_SHAPES[shape]}"
+    with closing(catalog_connection()) as conn:
+        return conn.execute(query).fetchone()[0]
+
+def scan_duplicates():
+    """Group the library into clusters of identical and near-identical photos, returning the report.
+
+    Perceptual hashes missing from older photos are filled in first. Returns
+    None if a scan is already running.
+    """
+    if not duplicate_scan_lock.acquire(blocking=False):
+        logger.info("Duplicate scan already running")
+        return None
+    try:
+        start = time.perf_counter()
+        with closing(catalog_connection()) as conn:
+            rows = [dict(row) for row in conn.execute(
+                "SELECT filename, content_hash, source_hash, phash FROM photos ORDER BY filename")]
+
+        for row in rows:
+            if row['phash']:
+                continue
+            try:
+                image = open_image(os.path.join(app.config['UPLOAD_FOLDER'], row['filename']), (256, 256))
+                row['phash'] = perceptual_hash(image)
+                with closing(catalog_connection()) as conn, conn:
+                    conn.execute("UPDATE photos SET phash = ? WHERE filename = ?", (row['phash'], row['filename']))
+            except Exception as e:
+                logger.error(f"Error hashing photo {row['filename']}: {e}")
+
+        # Union photos that share a hash or whose perceptual hashes are close
+        parent = list(range(len(rows)))
+        def find(index):
+            while parent[index] != index:
+                parent[index] = parent[parent[index]]
+                index = parent[index]
+            return index
+        def union(first, second):
+            parent[find(first)] = find(second)
+
+        first_with_hash = {}
+        for index, row in enumerate(rows):
+            for key in (row['content_hash'], row['source_hash']):
+                if key:
+                    union(index, first_with_hash.setdefault(key, index))
+
+        hashed = [index for index, row in enumerate(rows) if row['phash']]
+        if hashed:
+            # Compare the hashes as bit matrices a block at a time to keep memory small
+            bits = numpy.array([[int(bit) for bit in f"{int(rows[index]['phash'], 16):064b}"] for index in hashed],
+                               dtype=numpy.float32)
+            ones = bits.sum(axis=1)
+            for block_start in range(0, len(hashed), 256):
+                block = bits[block_start:block_start + 256]
+                distances = ones[block_start:block_start + 256, None] + ones[None, :] - 2 * (block @ bits.T)
+                for row_offset, column in zip(*numpy.nonzero(distances <= NEAR_DUPLICATE_DISTANCE)):
+                    if block_start + row_offset < column:
+                        union(hashed[block_start + row_offset], hashed[column])
+
+        groups = {}
+        for index in range(len(rows)):
+            groups.setdefault(find(index), []).append(rows[index])
+        clusters = [{'photos': [row['filename'] for row in group],
+                     'exact': len({row['content_hash'] for row in group}) == 1}
+                    for group in groups.values() if len(group) > 1]
+
+        report = {
+            'scanned_at': datetime.now().isoformat(),
+            'photos': len(rows),
+            'duplicates': sum(len(cluster['photos']) - 1 for cluster in clusters),
+            'clusters': clusters
+        }
+        temp_path = f"{DUPLICATE_REPORT_FILE}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        os.replace(temp_path, DUPLICATE_REPORT_FILE)
+        logger.info(f"Duplicate scan found {len(clusters)} clusters in {len(rows)} photos "
+                    f"in {time.perf_counter() - start:.1f}s")
+        return report
+    except Exception as e:
+        logger.error(f"Error scanning for duplicates: {e}\n{traceback.format_exc()}")
+        return None
+    finally:
+        duplicate_scan_lock.release()
+
+def load_duplicate_report():
+    """Load the last duplicate scan report, or None if there hasn't been one"""
+    try:
+        with open(DUPLICATE_REPORT_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"Error loading duplicate report: {e}")
+        return None
+
+def archive_original(source, filename):
+    """Keep a photo's original file, from a path or stream, in the originals folder"""
+    archive_path = os.path.join(app.config['ORIGINALS_FOLDER'], filename)
+    temp_path = f"{archive_path}.{threading.get_ident()}.tmp"
+    if isinstance(source, str):
+        try:
+            os.link(source, temp_path)  # Free when both are on the same filesystem
+        except OSError:
+            shutil.copyfile(source, temp_path)
+    else:
+        source.seek(0)
+        with open(temp_path, 'wb') as f:
+            shutil.copyfileobj(source, f)
+    os.replace(temp_path, archive_path)
+    logger.info(f"Archived original of {filename}")
+
+def normalize_photo(photo, keep_originals):
+    """Replace a stored photo with its master, returning the bytes and decode seconds before and after.
+
+    The bytes kept in the originals folder are returned too, as archiving
+    the stored file there frees none of its space. Returns None if the photo
+    is already stored at its master size.
+    """
+    path = os.path.join(app.config['UPLOAD_FOLDER'], photo['filename'])
+    decode_size = master_decode_size(DISPLAY_RESOLUTION)
+    with Image.open(path) as header:
+        size = oriented_size(header)
+    if master_size_for(size, DISPLAY_RESOLUTION) == size:
+        return None
+    old_key = artifact_key(photo['filename'])
+    bytes_before = os.path.getsize(path)
+
+    # Time the decode a display update does, before and after
+    start = time.perf_counter()
+    image = open_image(path, decode_size)
+    decode_before = time.perf_counter() - start
+    image = normalize_image(flatten_to_rgb(image), DISPLAY_RESOLUTION)
+
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    image.save(temp_path, 'JPEG', quality=85, optimize=True)
+    if not os.path.exists(path):
+        os.remove(temp_path)  # Deleted meanwhile
+        return None
+    if keep_originals:
+        archive_original(path, photo['filename'])
+    os.replace(temp_path, path)
+
+    start = time.perf_counter()
+    open_image(path, decode_size)
+    decode_after = time.perf_counter() - start
+
+    # The catalog keeps the capture time the master no longer carries in EXIF
+    catalog_add(photo['filename'], captured_at=photo['captured_at'], uploaded_at=photo['uploaded_at'],
+                phash=perceptual_hash(image))
+    delete_unused_artifacts(old_key)
+    create_thumbnails(photo['filename'], image)
+    logger.info(f"Normalized {photo['filename']}: {size[0]}x{size[1]} to "
+                f"{image.width}x{image.height}, {bytes_before // 1024}KB to {os.path.getsize(path) // 1024}KB")
+    return {'bytes_before': bytes_before, 'bytes_after': os.path.getsize(path),
+            'bytes_archived': bytes_before if keep_originals else 0,
+            'decode_seconds_before': decode_before, 'decode_seconds_after': decode_after}
+
+def save_normalize_report(report):
+    """Save the progress and savings of a library normalization"""
+    report['bytes_saved'] = report['bytes_before'] - report['bytes_after'] - report['bytes_archived']
+    report['decode_seconds_saved'] = report['decode_seconds_before'] - report['decode_seconds_after']
+    temp_path = f"{NORMALIZE_REPORT_FILE}.tmp"
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        os.replace(temp_path, NORMALIZE_REPORT_FILE)
+    except Exception as e:
+        logger.error(f"Error saving normalization report: {e}")
+
+def load_normalize_report():
+    """Load the report of the last library normalization, or None if there hasn't been one"""
+    try:
+        with open(NORMALIZE_REPORT_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"Error loading normalization report: {e}")
+        return None
+
+def normalize_library(keep_originals=True):
+    """Re-encode every photo stored bigger than its master, at low priority, returning the report.
+
+    Photos already at their master size are skipped, so a run cut short
+    carries on where it stopped, adding to the totals of its saved report.
+    Returns None if a run is already going.
+    """
+    if not normalize_lock.acquire(blocking=False):
+        logger.info("Library normalization already running")
+        return None
+    try:
+        lower_thread_priority(19)  # Lowest priority, for the disk as well as the CPU
+        report = load_normalize_report()
+        if report and not report['finished_at']:
+            logger.info(f"Resuming library normalization started at {report['started_at']}")
+            report.setdefault('bytes_archived', 0)
+        else:
+            report = {'started_at': datetime.now().isoformat(), 'finished_at': None,
+                      'keep_originals': keep_originals, 'photos': 0, 'checked': 0, 'normalized': 0, 'failed': 0,
+                      'bytes_before': 0, 'bytes_after': 0, 'bytes_archived': 0, 'decode_seconds_before': 0.0,
+                      'decode_seconds_after': 0.0, 'errors': []}
+        with closing(catalog_connection()) as conn:
+            photos = [dict(row) for row in conn.execute(
+                "SELECT filename, captured_at, uploaded_at FROM photos ORDER BY filename")]
+        report['photos'] = len(photos)
+        report['checked'] = 0
+        failed = {error['filename'] for error in report['errors']}
+
+        for photo in photos:
+            report['checked'] += 1
+            if photo['filename'] in failed:
+                continue
+            reserved = 0
+            try:
+                path = os.path.join(app.config['UPLOAD_FOLDER'], photo['filename'])
+                reserved = reserve_upload_memory(estimate_decode_memory(path, master_decode_size(DISPLAY_RESOLUTION)))
+                result = normalize_photo(photo, report['keep_originals'])
+            except FileNotFoundError:
+                continue  # Deleted since the run started
+            except Exception as e:
+                logger.error(f"Error normalizing {photo['filename']}: {e}")
+                report['failed'] += 1
+                report['errors'].append({'filename': photo['filename'], 'error': str(e)})
+                save_normalize_report(report)
+                continue
+            finally:
+                if reserved:
+                    release_upload_memory(reserved)
+            if result is None:
+                continue
+            report['normalized'] += 1
+            for key, value in result.items():
+                report[key] += value
+            save_normalize_report(report)
+            # Leave the disk to display updates and uploads for a moment
+            time.sleep(NORMALIZE_PAUSE_SECONDS)
+
+        report['finished_at'] = datetime.now().isoformat()
+        save_normalize_report(report)
+        logger.info(f"Library normalization finished: {report['normalized']} photos re-encoded, "
+                    f"{report['bytes_saved'] // (1024 * 1024)}MB saved, {report['failed']} failed")
+        return report
+    except Exception as e:
+        logger.error(f"Error normalizing library: {e}\n{traceback.format_exc()}")
         return None
+    finally:
+        normalize_lock.release()
+
+def resume_normalize_library():
+    """Carry on a library normalization cut short by a restart, in the background"""
+    report = load_normalize_report()
+    if report and not report['finished_at']:
+        threading.Thread(target=normalize_library, name='normalize', daemon=True).start()
+
+def playlist_weight(photo):
+    """Get how strongly a photo is favoured by the playlist"""
+    with closing(catalog_connection()) as conn:
+        row = conn.execute("SELECT uploaded_at, favourite FROM photos WHERE filename = ?", (photo,)).fetchone()
+    if not row:
+        return 1.0
+    weight = FAVOURITE_WEIGHT if row['favourite'] else 1.0
+    try:
+        if (datetime.now() - datetime.fromisoformat(row['uploaded_at'])).days < RECENT_UPLOAD_DAYS:
+            weight *= RECENT_UPLOAD_WEIGHT
+    except ValueError:
+        pass
+    return weight
+
+# Loaded at startup; photos with the same contents are only put in it once
+photo_playlist = None
+
+def next_photo():
+    """Move the playlist on to the next photo that still exists and return it, or None"""
+    try:
+        while True:
+            photo = photo_playlist.advance()
+            if photo is None:
+                logger.warning("No photos available to display")
+                return None
+            if os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], photo)):
+                logger.info(f"Selected next photo: {photo}")
+                return photo
+            logger.warning(f"Playlist photo is missing, skipping it: {photo}")
+            photo_playlist.remove(photo)
     except Exception as e:
-        logger.error(f"Error in get_random_image: {e}\n{traceback.format_exc()}")
+        logger.error(f"Error choosing next photo: {e}\n{traceback.format_exc()}")
         return None
 
+# The next photo in the playlist, rendered in the background after each
+# refresh so the next one only has to show it
+prepared_frame = None
+prepared_frame_lock = threading.Lock()
+prepare_running = threading.Lock()
+
+def prepare_next_frame():
+    """Render the next photo in the playlist ahead of time at low priority"""
+    global prepared_frame
+    if not display or not prepare_running.acquire(blocking=False):
+        return
+    try:
+        lower_thread_priority(10)  # So the web interface stays responsive
+        photo = photo_playlist.peek()
+        if photo is None:
+            return
+        orientation = current_orientation  # Read once, as a button press may change it meanwhile
+        key = (photo, orientation, frame_signature())
+        with prepared_frame_lock:
+            if prepared_frame and prepared_frame[0] == key:
+                return
+        frame = render_frame(photo, orientation)
+        with prepared_frame_lock:
+            prepared_frame = (key, frame)
+        logger.info(f"Prepared next frame: {photo}")
+    except Exception as e:
+        logger.error(f"Error preparing next frame: {e}\n{traceback.format_exc()}")
+    finally:
+        prepare_running.release()
+
+def start_prepare_next_frame():
+    """Start rendering the next photo on a background thread"""
+    threading.Thread(target=prepare_next_frame, name='prepare-next', daemon=True).start()
+
+def take_prepared_frame(photo, orientation):
+    """Get the prepared frame for a photo if it matches the current settings, or None"""
+    global prepared_frame
+    with prepared_frame_lock:
+        if prepared_frame and prepared_frame[0] == (photo, orientation, frame_signature()):
+            frame = prepared_frame[1]
+            prepared_frame = None
+            return frame
+    return None
+
 def update_display():
-    """Update the Inky display with a random image"""
+    """Update the Inky display with the next photo in the playlist, returning whether it succeeded"""
     global current_photo
     logger.info("Starting display update process")
     
     if not display:
         logger.error("Display not initialized, skipping update")
-        return
+        return False
 
-    image_path = get_random_image()
-    if not image_path:
+    photo = next_photo()
+    if not photo:
         logger.error("No images available for display update")
-        return
+        return False
 
     try:
-        # Open the image
-        logger.info(f"Opening image: {image_path}")
-        image = Image.open(image_path)
+        # Use the frame prepared in the background, or render it now
+        frame = take_prepared_frame(photo, current_orientation)
+        if frame is not None:
+            logger.info(f"Using prepared frame for {photo}")
+            frame_cache_lookups.inc(result='prepared')
+        else:
+            frame = render_frame(photo, current_orientation)
         
-        # Prepare image for display with current orientation
-        display_image = prepare_for_display(image, current_orientation)
+        if show_frame(frame, photo):
+            logger.info(f"Successfully updated display with image: {photo}")
+    except Exception as e:
+        logger.error(f"Error updating display: {e}\n{traceback.format_exc()}")
+        return False
+    finally:
+        current_photo = photo
+        start_prepare_next_frame()
+    return True
+
+# Display refresh queue. Only the worker thread touches the display; a new
+# request replaces any request that hasn't started yet. Refreshes nobody
+# asked for there and then keep to min_refresh_minutes, while ones from the
+# web interface and buttons run straight away.
+RATE_LIMITED_TRIGGERS = ('scheduler', 'upload')
+refresh_condition = threading.Condition()
+refresh_counter = 0
+pending_refresh = None
+running_refresh = None
+last_refresh = None
+
+def request_display_update(trigger, action=None, args=()):
+    """Queue a display refresh and return its request id without waiting for it"""
+    global refresh_counter, pending_refresh
+    with refresh_condition:
+        refresh_counter += 1
+        refresh_requests.inc(trigger=trigger)
+        if pending_refresh is not None:
+            logger.info(f"Display refresh {pending_refresh['id']} ({pending_refresh['trigger']}) "
+                        f"replaced by {refresh_counter} ({trigger})")
+            refreshes_coalesced.inc()
+        pending_refresh = {
+            'id': refresh_counter,
+            'trigger': trigger,
+            'action': action or update_display,
+            'args': args,
+            'requested_at': datetime.now().isoformat()
+        }
+        refresh_condition.notify()
+        logger.info(f"Display refresh {refresh_counter} queued ({trigger})")
+        return refresh_counter
+
+def display_refresh_worker():
+    """Run queued display refreshes one at a time"""
+    global pending_refresh, running_refresh, last_refresh
+    while True:
+        with refresh_condition:
+            while True:
+                while pending_refresh is None:
+                    refresh_condition.wait()
+                # Hold back bursts; requests made meanwhile replace the pending one
+                hold = refresh_hold_seconds(pending_refresh['trigger'])
+                if hold <= 0:
+                    break
+                logger.info(f"Display refresh {pending_refresh['id']} held for {hold:.0f}s by the refresh rate limit")
+                refresh_condition.wait(hold)
+            job = pending_refresh
+            pending_refresh = None
+            running_refresh = {key: job[key] for key in ('id', 'trigger', 'requested_at')}
+            running_refresh['started_at'] = datetime.now().isoformat()
+
+        start = time.perf_counter()
+        try:
+            succeeded = job['action'](*job['args']) is not False
+        except Exception as e:
+            logger.error(f"Error in display refresh {job['id']}: {e}\n{traceback.format_exc()}")
+            succeeded = False
+        result = 'success' if succeeded else 'failure'
+        update_seconds.observe(time.perf_counter() - start, result=result)
+        trim_memory()
+        refreshes.inc(trigger=job['trigger'], result=result)
+
+        with refresh_condition:
+            last_refresh = dict(running_refresh, finished_at=datetime.now().isoformat(),
+                                state='done' if succeeded else 'failed')
+            running_refresh = None
+
+def refresh_hold_seconds(trigger):
+    """Get how long a refresh from a trigger must wait to keep to min_refresh_minutes"""
+    if last_show_time is None or trigger not in RATE_LIMITED_TRIGGERS:
+        return 0
+    return last_show_time + float(settings.get('min_refresh_minutes') or 0) * 60 - time.monotonic()
+
+def get_refresh_status(request_id=None):
+    """Describe the refresh queue, or the state of one request id.
+
+    A request that was replaced before it started takes the state of the
+    request that replaced it.
+    """
+    with refresh_condition:
+        pending = {key: pending_refresh[key] for key in ('id', 'trigger', 'requested_at')} if pending_refresh else None
+        running = dict(running_refresh) if running_refresh else None
+        last = dict(last_refresh) if last_refresh else None
+
+    if request_id is None:
+        state = 'pending' if pending else 'running' if running else last['state'] if last else 'idle'
+    elif last and request_id <= last['id']:
+        state = last['state'] if request_id == last['id'] else 'done'
+    elif running and request_id <= running['id']:
+        state = 'running'
+    elif pending and request_id <= pending['id']:
+        state = 'pending'
+    else:
+        state = 'unknown'
+    held = False
+    if pending:
+        pending['held_for'] = max(0, round(refresh_hold_seconds(pending['trigger'])))
+        held = pending['held_for'] > 0 and state == 'pending'
+    return {'state': state, 'held': held, 'pending': pending, 'running': running, 'last': last,
+            'current_photo': current_photo, 'playlist': photo_playlist.status()}
+
+def show_frame(frame, photo):
+    """Send a frame to the panel, unless it already shows exactly that frame.
+
+    Returns whether the panel was updated.
+    """
+    global shown_fingerprint, last_show_time
+    fingerprint = hashlib.sha256(frame.tobytes()).hexdigest()
+    if fingerprint == shown_fingerprint:
+        logger.info(f"Display already shows this frame of {photo}, skipping the refresh")
+        refreshes_skipped.inc(reason='unchanged')
+        return False
+
+    with display_lock:
+        logger.info("Setting image on display")
+        with update_stage_seconds.time(stage='set_image'):
+            backends.set_buffer(display, frame)
         
         # Show the image on the display
-        logger.info("Setting image on display")
-        display.set_image(display_image)
         logger.info("Showing image on display")
-        display.show()
-        
-        logger.info(f"Successfully updated display with image: {os.path.basename(image_path)}")
+        with update_stage_seconds.time(stage='show'):
+            display.show()
+    shown_fingerprint = fingerprint
+    last_show_time = time.monotonic()
+    save_display_state(photo, fingerprint)
+    return True
+
+def save_display_state(photo, fingerprint):
+    """Remember the photo on the panel, how it was rendered and the fingerprint of the frame"""
+    state = {
+        'photo': photo,
+        'orientation': current_orientation,
+        'signature': frame_signature(),
+        'fingerprint': fingerprint,
+        'shown_at': datetime.now().isoformat()
+    }
+    temp_path = f"{DISPLAY_STATE_FILE}.tmp"
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp_path, DISPLAY_STATE_FILE)
     except Exception as e:
-        logger.error(f"Error updating display: {e}\n{traceback.format_exc()}")
-    
-    current_photo = os.path.basename(image_path)
+        logger.error(f"Could not save display state: {e}")
+
+def load_display_state():
+    """Load what the panel was last showing, or None if it isn't known"""
+    try:
+        with open(DISPLAY_STATE_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Could not load display state: {e}")
+        return None
+
+def first_update_time(state):
+    """Get when the first scheduled update is due, skipping the startup redraw if the panel already shows the right photo"""
+    now = datetime.now()
+    if not state or DISPLAY_BACKEND not in backends.PERSISTENT_DISPLAYS:
+        return now
+    try:
+        if (state['orientation'] != current_orientation or state['signature'] != frame_signature()
+                or not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], state['photo']))):
+            return now
+        due = datetime.fromisoformat(state['shown_at']) + timedelta(hours=update_interval_hours())
+    except (KeyError, TypeError, ValueError):
+        return now
+    if due <= now:
+        return now
+    logger.info(f"Display already shows {state['photo']}, skipping the startup redraw")
+    return due
 
 def schedule_update():
     """Wrapper for scheduler to catch and log any errors"""
     try:
+        if in_quiet_hours():
+            logger.info("Scheduled update skipped during quiet hours")
+            refreshes_skipped.inc(reason='quiet_hours')
+            return
         logger.info("Scheduled update triggered")
-        update_display()
+        request_display_update('scheduler')
     except Exception as e:
         logger.error(f"Error in scheduled update: {e}\n{traceback.format_exc()}")
 
 # Global variables
 current_photo = None
-ORIENTATION_0 = "0"    # Normal
-ORIENTATION_90 = "90"  # Rotated right
-ORIENTATION_180 = "180"  # Upside down
-ORIENTATION_270 = "270"  # Rotated left
 current_orientation = ORIENTATION_0
 
 # Constants for settings
 SETTINGS_FILE = 'settings.json'
+UPDATE_INTERVAL_HOURS = 1
 DEFAULT_SETTINGS = {
-    'orientation': ORIENTATION_0
+    'orientation': ORIENTATION_0,
+    'dither': quantize.DITHER_DIFFUSION,
+    'saturation': 0.5,
+    'palette': None,  # Optional calibrated list of 7 [r, g, b] panel colours
+    # Refresh policy: how often the photo changes, optional ["HH:MM", "HH:MM"] hours
+    # without scheduled changes, and the least time between panel updates
+    'update_interval_hours': UPDATE_INTERVAL_HOURS,
+    'quiet_hours': None,
+    'min_refresh_minutes': 1,
+    'keep_originals': False  # Keep uploaded files as sent in the originals folder
 }
 
 def load_settings():
@@ -154,206 +1447,842 @@ def load_settings():
     except (FileNotFoundError, json.JSONDecodeError) as e:
         logger.warning(f"Could not load settings ({e}), using defaults")
         save_settings(DEFAULT_SETTINGS)
-        return DEFAULT_SETTINGS
+        return dict(DEFAULT_SETTINGS)
+
+# Guards settings changes coming from buttons and the web interface
+settings_lock = threading.Lock()
+
+def update_settings(**changes):
+    """Change some settings and save them all"""
+    with settings_lock:
+        settings.update(changes)
+        save_settings(settings)
+
+def display_colours():
+    """Get a consistent snapshot of the colour settings frames are rendered with"""
+    with settings_lock:
+        return {key: settings.get(key) for key in ('dither', 'saturation', 'palette')}
+
+def set_current_orientation(orientation):
+    """Change the display orientation and save it, returning False if it was already set"""
+    global current_orientation
+    with settings_lock:
+        if orientation == current_orientation:
+            return False
+        current_orientation = orientation
+        settings['orientation'] = orientation
+        save_settings(settings)
+    logger.info(f"Orientation changed to: {orientation}°")
+    return True
 
 def save_settings(settings):
     """Save settings to file"""
     try:
-        with open(SETTINGS_FILE, 'w') as f:
+        temp_path = f"{SETTINGS_FILE}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as f:
             json.dump(settings, f)
+        os.replace(temp_path, SETTINGS_FILE)
         logger.info(f"Settings saved: {settings}")
     except Exception as e:
         logger.error(f"Could not save settings: {e}")
 
-# Initialize the scheduler
-scheduler = BackgroundScheduler()
+# Settings in use, loaded at startup
+settings = dict(DEFAULT_SETTINGS)
 
-# Load saved settings
-settings = load_settings()
-current_orientation = settings.get('orientation', ORIENTATION_0)
-logger.info(f"Loaded orientation setting: {current_orientation}")
+scheduler = None
 
-scheduler.add_job(schedule_update, 'interval', hours=1, next_run_time=datetime.now())  # Run immediately and then every hour
-scheduler.start()
-logger.info("Scheduler started - images will update every hour")
+def update_interval_hours():
+    """Get the hours between scheduled display updates"""
+    return float(settings.get('update_interval_hours') or UPDATE_INTERVAL_HOURS)
 
-def fix_image_orientation(image):
-    """Fix image orientation based on EXIF data"""
+def in_quiet_hours(now=None):
+    """Check whether scheduled updates are paused by the quiet hours setting"""
+    quiet = settings.get('quiet_hours')
+    if not quiet:
+        return False
+    start, end = quiet
+    now = (now or datetime.now()).strftime('%H:%M')
+    if start <= end:
+        return start <= now < end
+    return now >= start or now < end  # Quiet overnight
+
+def start_scheduler(first_update):
+    """Start the scheduled display updates and daily catalog reconciliation"""
+    global scheduler
+    # Only imported here, as APScheduler is slow to import
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(schedule_update, 'interval', hours=update_interval_hours(), next_run_time=first_update,
+                      id='update')
+    scheduler.add_job(reconcile_catalog, 'interval', hours=24)
+    scheduler.add_job(prune_chunk_uploads, 'interval', hours=24)
+    scheduler.add_job(prune_artifacts, 'interval', hours=24)
+    scheduler.start()
+    logger.info(f"Scheduler started - images will update every {update_interval_hours():g} hours, "
+                f"next at {first_update:%H:%M:%S}")
+
+@contextmanager
+def startup_phase(name):
+    """Time a startup phase, logging it and recording it for /metrics"""
+    start = time.perf_counter()
     try:
-        # Check if image has EXIF data
-        if hasattr(image, '_getexif') and image._getexif():
-            exif = dict(image._getexif().items())
-            
-            # EXIF orientation tag
-            orientation = exif.get(274)  # 274 is the orientation tag ID
-            
-            # Rotate or flip based on orientation
-            if orientation == 2:
-                return image.transpose(Image.FLIP_LEFT_RIGHT)
-            elif orientation == 3:
-                return image.transpose(Image.ROTATE_180)
-            elif orientation == 4:
-                return image.transpose(Image.FLIP_TOP_BOTTOM)
-            elif orientation == 5:
-                return image.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_90)
-            elif orientation == 6:
-                return image.transpose(Image.ROTATE_270)
-            elif orientation == 7:
-                return image.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_270)
-            elif orientation == 8:
-                return image.transpose(Image.ROTATE_90)
-    except Exception as e:
-        logger.warning(f"Error processing EXIF orientation: {e}")
-    
-    return image
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        startup_seconds.set(elapsed, phase=name)
+        logger.info(f"Startup phase {name} took {elapsed * 1000:.0f}ms")
+
+def startup_background():
+    """Set up the hardware and scheduler, then catch up on maintenance, while the web interface is already serving"""
+    global cleanup_buttons
+    start = time.perf_counter()
+    with startup_phase('static_photos'):
+        remove_static_photos()
+    with startup_phase('display'):
+        init_display()
+    with startup_phase('buttons'):
+        try:
+            cleanup_buttons = backends.setup_buttons(BUTTON_BACKEND, [BUTTON_A, BUTTON_B, BUTTON_C, BUTTON_D],
+                                                     handle_button)
+        except Exception as e:
+            logger.error(f"Could not set up {BUTTON_BACKEND} buttons: {e}\n{traceback.format_exc()}")
+
+    # Catch the catalog up with the upload folder before the first update picks from it
+    with startup_phase('reconcile'):
+        reconcile_catalog()
+    with startup_phase('scheduler'):
+        start_scheduler(first_update_time(load_display_state()))
+
+    # Then tidy and fill in derived files and scan for duplicates
+    with startup_phase('prune'):
+        prune_artifacts()
+    with startup_phase('resume_uploads'):
+        resume_spooled_uploads()
+    start_prepare_next_frame()
+    with startup_phase('thumbnails'):
+        backfill_thumbnails()
+    with startup_phase('duplicates'):
+        scan_duplicates()
+    resume_normalize_library()
+    startup_seconds.set(time.perf_counter() - start, phase='background')
+    logger.info(f"Background startup finished in {time.perf_counter() - start:.1f}s")
 
-# Initialize GPIO for buttons
 BUTTON_A = 5
 BUTTON_B = 6
 BUTTON_C = 16
 BUTTON_D = 24
 
-GPIO.setmode(GPIO.BCM)
-GPIO.setup([BUTTON_A, BUTTON_B, BUTTON_C, BUTTON_D], GPIO.IN, pull_up_down=GPIO.PUD_UP)
-
 def handle_button(channel):
     """Handle button presses for orientation changes"""
-    global current_orientation
     try:
         if channel in [BUTTON_A, BUTTON_B, BUTTON_C, BUTTON_D]:
             # Cycle through orientations based on button press
             if channel == BUTTON_A:
-                current_orientation = ORIENTATION_0
+                orientation = ORIENTATION_0
             elif channel == BUTTON_B:
-                current_orientation = ORIENTATION_90
+                orientation = ORIENTATION_90
             elif channel == BUTTON_C:
-                current_orientation = ORIENTATION_180
+                orientation = ORIENTATION_180
             elif channel == BUTTON_D:
-                current_orientation = ORIENTATION_270
+                orientation = ORIENTATION_270
             
             # Save the new orientation
-            save_settings({'orientation': current_orientation})
+            if not set_current_orientation(orientation):
+                logger.info(f"Orientation already {orientation}°, not refreshing")
+                return
             
-            logger.info(f"Orientation changed to: {current_orientation}°")
-            update_display()  # Update the display with new orientation
+            request_display_update('button')  # Update the display with new orientation
     except Exception as e:
         logger.error(f"Error handling button press: {e}")
 
-# Update button event detection for all buttons
-GPIO.remove_event_detect(BUTTON_A)  # Remove existing detection first
-GPIO.remove_event_detect(BUTTON_B)
-GPIO.setup([BUTTON_A, BUTTON_B, BUTTON_C, BUTTON_D], GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.add_event_detect(BUTTON_A, GPIO.FALLING, callback=handle_button, bouncetime=250)
-GPIO.add_event_detect(BUTTON_B, GPIO.FALLING, callback=handle_button, bouncetime=250)
-GPIO.add_event_detect(BUTTON_C, GPIO.FALLING, callback=handle_button, bouncetime=250)
-GPIO.add_event_detect(BUTTON_D, GPIO.FALLING, callback=handle_button, bouncetime=250)
-
-def compress_image(image, max_width, max_height):
-    """Compress and resize image to target dimensions while maintaining aspect ratio"""
-    # Calculate scaling ratios
-    width_ratio = max_width / image.width
-    height_ratio = max_height / image.height
-    scale_ratio = min(width_ratio, height_ratio)
-    
-    # Calculate new dimensions
-    new_width = int(image.width * scale_ratio)
-    new_height = int(image.height * scale_ratio)
-    
-    # Resize the image using high-quality Lanczos resampling
-    resized_image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-    
-    # Create a new white background image
-    final_image = Image.new("RGB", (max_width, max_height), (255, 255, 255))
-    
-    # Calculate position to center the image
-    x = (max_width - new_width) // 2
-    y = (max_height - new_height) // 2
-    
-    # Paste the resized image onto the white background
-    final_image.paste(resized_image, (x, y))
-    
-    return final_image
-
-def prepare_for_display(image, orientation):
-    """Prepare image for display by rotating if needed"""
-    # Create a mapping of orientations to rotation angles
-    rotations = {
-        ORIENTATION_0: 0,
-        ORIENTATION_90: 90,
-        ORIENTATION_180: 180,
-        ORIENTATION_270: 270
-    }
-    
-    # Determine target dimensions based on orientation
-    if orientation in [ORIENTATION_90, ORIENTATION_270]:
-        target_width = display.height
-        target_height = display.width
-    else:
-        target_width = display.width
-        target_height = display.height
+# Releases the button pins; replaced once the buttons are set up
+cleanup_buttons = lambda: None
+
+def process_upload(source, original_name, source_hash=None, captured_at=None, keep_original=None):
+    """Turn an uploaded image into a stored photo and return its filename.
+
+    captured_at is used when the image has no EXIF capture time of its own,
+    as with photos the web page has already downscaled. The upload is kept
+    in the originals folder if keep_original is set, or by default if the
+    keep_originals setting is.
+    """
+    # Read the capture time before the EXIF data is dropped on save
+    with Image.open(source) as header:
+        captured_at = get_capture_time(header) or captured_at
+    if hasattr(source, 'seek'):
+        source.seek(0)
     
-    # Calculate scaling ratios
-    width_ratio = target_width / image.width
-    height_ratio = target_height / image.height
-    scale_ratio = min(width_ratio, height_ratio)
+    # Open the image at reduced scale, fixing EXIF orientation during upload
+    image = open_image(source, master_decode_size(DISPLAY_RESOLUTION))
     
-    # Calculate new dimensions
-    new_width = int(image.width * scale_ratio)
-    new_height = int(image.height * scale_ratio)
+    # Convert to RGB if necessary (handles PNG with transparency)
+    image = flatten_to_rgb(image)
     
-    # Create a black background image of the correct size
-    final_image = Image.new("RGB", (target_width, target_height), (0, 0, 0))
+    # Shrink to the master stored for both panel orientations
+    image = normalize_image(image, DISPLAY_RESOLUTION)
     
-    # Resize the original image
-    resized_image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    # Claim a filename of its own and save the compressed image under it
+    filename = reserve_photo_filename(original_name)
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    temp_path = f"{file_path}.{threading.get_ident()}.tmp"
+    try:
+        if settings.get('keep_originals') if keep_original is None else keep_original:
+            archive_original(source, filename)
+        image.save(temp_path, 'JPEG', quality=85, optimize=True)
+        os.replace(temp_path, file_path)
+    except Exception:
+        for path in (temp_path, file_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    logger.info(f"New photo uploaded and compressed: {filename} (peak RSS {peak_rss_mb()}MB)")
+    catalog_add(filename, captured_at=captured_at, source_hash=source_hash, phash=perceptual_hash(image))
     
-    # Center the resized image
-    x = (target_width - new_width) // 2
-    y = (target_height - new_height) // 2
-    final_image.paste(resized_image, (x, y))
+    # Create gallery thumbnails from the already decoded image
+    try:
+        create_thumbnails(filename, image)
+    except Exception as e:
+        logger.error(f"Error creating thumbnails for {filename}: {e}")
     
-    # Get the rotation angle and rotate if needed
-    angle = rotations.get(orientation, 0)
-    if angle != 0:
-        # For 90 and 270 degree rotations, we need to rotate around the center and adjust the size
-        if orientation in [ORIENTATION_90, ORIENTATION_270]:
-            # Create a new image with swapped dimensions
-            rotated = Image.new("RGB", (display.width, display.height), (255, 255, 255))
-            # Rotate and paste into the center of the new image
-            rotated_content = final_image.rotate(angle, expand=True)
-            x = (display.width - rotated_content.width) // 2
-            y = (display.height - rotated_content.height) // 2
-            rotated.paste(rotated_content, (x, y))
-            return rotated
+    return filename
+
+def reserve_photo_filename(original_name):
+    """Claim a free filename for a new photo in the upload folder, adding a counter when the name is taken.
+
+    The name is held by an empty file until the photo replaces it, so photos
+    with the same name processed at once, such as from different folders
+    of an archive, can't overwrite each other.
+    """
+    prefix = datetime.now().strftime('%Y%m%d_%H%M%S')
+    stem, extension = os.path.splitext(original_name)
+    counter = 1
+    while True:
+        filename = f"{prefix}_{original_name}" if counter == 1 else f"{prefix}_{stem}_{counter}{extension}"
+        try:
+            os.close(os.open(os.path.join(app.config['UPLOAD_FOLDER'], filename), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return filename
+        except FileExistsError:
+            counter += 1
+
+def reserve_upload_memory(nbytes):
+    """Block until the upload memory budget has room, returning the amount reserved"""
+    global upload_memory_in_use
+    # An image bigger than the whole budget runs on its own
+    nbytes = min(nbytes, UPLOAD_MEMORY_BUDGET)
+    with upload_memory_condition:
+        while upload_memory_in_use + nbytes > UPLOAD_MEMORY_BUDGET:
+            upload_memory_condition.wait()
+        upload_memory_in_use += nbytes
+    return nbytes
+
+def release_upload_memory(nbytes):
+    """Return reserved bytes to the upload memory budget"""
+    global upload_memory_in_use
+    with upload_memory_condition:
+        upload_memory_in_use -= nbytes
+        upload_memory_condition.notify_all()
+
+def find_queued_upload(source_hash):
+    """Get the name of a queued or processing upload with the given hash, or None"""
+    with upload_batches_lock:
+        for batch in upload_batches.values():
+            for item in batch['items']:
+                if item['source_hash'] == source_hash and item['state'] in ('queued', 'processing'):
+                    return item['name']
+    return None
+
+def new_upload_item(name):
+    """Create the progress record for one photo in an upload batch"""
+    return {'name': name, 'state': 'queued', 'filename': None, 'error': None,
+            'source_hash': None, 'duplicate_of': None, 'similar_to': None}
+
+def find_duplicate_of(source_hash, earlier_items):
+    """Get the name of the stored, queued or earlier photo in the batch an upload is a copy of, or None"""
+    return (next((i['name'] for i in earlier_items if i['source_hash'] == source_hash), None)
+            or find_duplicate(source_hash) or find_queued_upload(source_hash))
+
+def start_upload_batch(batch_id, spooled, captured_at=None, keep_originals=None):
+    """Register a batch of spooled uploads and queue them on the worker pool.
+
+    Each upload is hashed first, and exact copies of stored, queued or
+    earlier photos in the batch are dropped without being decoded.
+    captured_at optionally maps spool paths to capture times sent with them,
+    and keep_originals overrides the setting of the same name for the batch.
+    """
+    captured_at = captured_at or {}
+    items = []
+    queued = []
+    for spool_path, original_name in spooled:
+        item = new_upload_item(original_name)
+        items.append(item)
+        try:
+            item['source_hash'] = hash_file(spool_path)
+            duplicate_of = find_duplicate_of(item['source_hash'], items[:-1])
+        except Exception as e:
+            logger.error(f"Error hashing upload {original_name}: {e}")
+            duplicate_of = None
+        if duplicate_of:
+            logger.info(f"Upload {original_name} skipped as a duplicate of {duplicate_of}")
+            item['state'] = 'duplicate'
+            item['duplicate_of'] = duplicate_of
+            try:
+                os.remove(spool_path)
+            except OSError as e:
+                logger.warning(f"Could not remove spooled upload {spool_path}: {e}")
         else:
-            return final_image.rotate(angle, expand=False)
-    
-    return final_image
+            queued.append((len(items) - 1, spool_path, original_name))
+
+    with upload_batches_lock:
+        upload_batches[batch_id] = {
+            'batch_id': batch_id,
+            'created_at': datetime.now().isoformat(),
+            'created_timestamp': time.time(),
+            'finished_at': None if queued else datetime.now().isoformat(),
+            'keep_originals': keep_originals,
+            'items': items
+        }
+        # Forget the oldest finished batches
+        finished = [key for key, batch in upload_batches.items() if batch['finished_at']]
+        for key in finished[:-UPLOAD_BATCH_HISTORY]:
+            del upload_batches[key]
+    logger.info(f"Upload batch {batch_id} queued with {len(queued)} files, "
+                f"{len(items) - len(queued)} duplicates skipped")
+    for index, spool_path, original_name in queued:
+        upload_executor.submit(process_spooled_upload, batch_id, index, spool_path, original_name,
+                               captured_at.get(spool_path))
+
+def process_batch_item(batch_id, index, source, original_name, captured_at=None):
+    """Process one photo of a batch, from a path or stream, within the memory budget"""
+    batch = upload_batches[batch_id]
+    item = batch['items'][index]
+    reserved = 0
+    start = None
+    try:
+        reserved = reserve_upload_memory(estimate_decode_memory(source, master_decode_size(DISPLAY_RESOLUTION)))
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        item['state'] = 'processing'
+        start = time.perf_counter()
+        item['filename'] = process_upload(source, original_name, item['source_hash'], captured_at,
+                                          batch.get('keep_originals'))
+        photo_playlist.add(item['filename'])
+        item['similar_to'] = find_similar_photo(item['filename'])
+        if item['similar_to']:
+            logger.info(f"Uploaded photo {item['filename']} looks like {item['similar_to']}")
+        item['state'] = 'done'
+    except Exception as e:
+        logger.error(f"Error processing image {original_name}: {e}")
+        item['state'] = 'failed'
+        item['error'] = str(e)
+    finally:
+        if start is not None:
+            upload_file_seconds.observe(time.perf_counter() - start, result=item['state'])
+        if reserved:
+            release_upload_memory(reserved)
+
+def process_spooled_upload(batch_id, index, spool_path, original_name, captured_at=None):
+    """Process one spooled upload, then tidy up the batch"""
+    try:
+        process_batch_item(batch_id, index, spool_path, original_name, captured_at)
+    finally:
+        try:
+            os.remove(spool_path)
+        except OSError as e:
+            logger.warning(f"Could not remove spooled upload {spool_path}: {e}")
+    finish_upload_batch(batch_id)
+
+def finish_upload_batch(batch_id):
+    """Mark a batch finished once none of its photos are left to read or process"""
+    with upload_batches_lock:
+        batch = upload_batches[batch_id]
+        if (batch['finished_at'] or batch.get('reading')
+                or any(i['state'] in ('queued', 'processing') for i in batch['items'])):
+            return
+        batch['finished_at'] = datetime.now().isoformat()
+    upload_batch_seconds.observe(time.time() - batch['created_timestamp'])
+    trim_memory()
+    if 'archive' in batch:
+        save_import_report(batch_id)
+    uploaded_files = [i['filename'] for i in batch['items'] if i['state'] == 'done']
+    logger.info(f"Upload batch {batch_id} finished: {len(uploaded_files)} of {len(batch['items'])} files stored")
+    if uploaded_files:
+        start_frame_cache_build(uploaded_files, current_orientation)
+        start_render_target_builds(uploaded_files)
+        request_display_update('upload')  # Update display with the last uploaded image
+
+def get_upload_batch_status(batch_id):
+    """Summarize the progress of an upload batch, or None if it isn't known"""
+    with upload_batches_lock:
+        batch = upload_batches.get(batch_id)
+        if batch is None:
+            return None
+        items = [dict(item) for item in batch['items']]
+        status = {key: batch[key] for key in ('batch_id', 'created_at', 'finished_at')}
+        status.update({key: batch[key] for key in ('archive', 'reading', 'error') if key in batch})
+    status['total'] = len(items)
+    for state in ('queued', 'processing', 'done', 'failed', 'duplicate'):
+        status[state] = sum(1 for item in items if item['state'] == state)
+    status['similar'] = sum(1 for item in items if item['similar_to'])
+    status['items'] = items
+    return status
+
+def upload_queue_depth():
+    """Count uploaded photos waiting for or being processed"""
+    with upload_batches_lock:
+        return sum(1 for batch in upload_batches.values() for item in batch['items']
+                   if item['state'] in ('queued', 'processing'))
+
+def valid_import_id(import_id):
+    """Check an import id is safe to use in a file name"""
+    return bool(re.fullmatch(r'[A-Za-z0-9_-]{1,64}', import_id or ''))
+
+def import_report_path(import_id):
+    """Get the path of the saved progress report for an import"""
+    return os.path.join(app.config['IMPORT_FOLDER'], f"{import_id}.json")
+
+def save_import_report(import_id):
+    """Save an import's progress and per-file results so it can be resumed"""
+    status = get_upload_batch_status(import_id)
+    if status is None:
+        return
+    temp_path = f"{import_report_path(import_id)}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(status, f, indent=2)
+        os.replace(temp_path, import_report_path(import_id))
+    except Exception as e:
+        logger.error(f"Error saving import report {import_id}: {e}")
+
+def load_import_report(import_id):
+    """Load the saved report of an import, or None if there isn't one"""
+    if not valid_import_id(import_id):
+        return None
+    try:
+        with open(import_report_path(import_id)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"Error loading import report {import_id}: {e}")
+        return None
+
+def import_archive(stream, archive_name, import_id):
+    """Import the photos in a ZIP or tar archive as it is read, one member at a time.
+
+    Photos already stored by an earlier run with the same import id are
+    skipped without being read, so an interrupted import can be resumed by
+    sending the archive again.
+    """
+    previous = load_import_report(import_id)
+    completed = {item['name']: item for item in (previous or {}).get('items', [])
+                 if item['state'] in ('done', 'duplicate')}
+    with upload_batches_lock:
+        upload_batches[import_id] = {
+            'batch_id': import_id,
+            'archive': archive_name,
+            'created_at': datetime.now().isoformat(),
+            'created_timestamp': time.time(),
+            'finished_at': None,
+            'reading': True,
+            'error': None,
+            'items': []
+        }
+        items = upload_batches[import_id]['items']
+    logger.info(f"Import {import_id} of {archive_name} started"
+                + (f", resuming after {len(completed)} photos" if completed else ""))
+
+    spool_path = os.path.join(app.config['IMPORT_FOLDER'], f"{import_id}.part")
+    try:
+        for name, size, save in archives.iter_photo_members(stream, spool_path, IMPORT_MAX_MEMBER_SIZE):
+            if name in completed:
+                with upload_batches_lock:
+                    items.append(dict(completed[name]))
+                continue
+
+            item = new_upload_item(name)
+            # Wait for a free slot before spooling, so the archive isn't unpacked far ahead of the workers
+            import_slots.acquire()
+            member_path = os.path.join(app.config['SPOOL_FOLDER'],
+                                       f"{import_id}_{len(items):04d}_{os.path.basename(name)}")
+            try:
+                save(member_path)
+                item['source_hash'] = hash_file(member_path)
+                item['duplicate_of'] = find_duplicate_of(item['source_hash'], items)
+                if item['duplicate_of']:
+                    logger.info(f"Imported photo {name} skipped as a duplicate of {item['duplicate_of']}")
+                    item['state'] = 'duplicate'
+            except Exception as e:
+                logger.error(f"Error reading {name} from {archive_name}: {e}")
+                item['state'] = 'failed'
+                item['error'] = str(e)
+            with upload_batches_lock:
+                items.append(item)
+                index = len(items) - 1
+            if item['state'] == 'queued':
+                upload_executor.submit(process_imported_photo, import_id, index, member_path, name)
+            else:
+                import_slots.release()
+                if os.path.exists(member_path):
+                    os.remove(member_path)
+    except Exception as e:
+        logger.error(f"Error reading archive {archive_name}: {e}")
+        upload_batches[import_id]['error'] = str(e)
+    finally:
+        with upload_batches_lock:
+            upload_batches[import_id]['reading'] = False
+        save_import_report(import_id)
+    logger.info(f"Import {import_id} read {len(items)} photos from {archive_name}")
+    finish_upload_batch(import_id)
+
+def process_imported_photo(batch_id, index, member_path, name):
+    """Process one photo spooled from an archive, then tidy up the import"""
+    try:
+        process_spooled_upload(batch_id, index, member_path, os.path.basename(name))
+    finally:
+        import_slots.release()
+    save_import_report(batch_id)
+
+def resume_spooled_uploads():
+    """Queue uploads left in the spool by a restart as a new batch"""
+    spooled = []
+    for name in sorted(os.listdir(app.config['SPOOL_FOLDER'])):
+        parts = name.split('_', 2)
+        if len(parts) == 3:
+            spooled.append((os.path.join(app.config['SPOOL_FOLDER'], name), parts[2]))
+    if spooled:
+        logger.info(f"Resuming {len(spooled)} spooled uploads")
+        start_upload_batch(uuid.uuid4().hex[:12], spooled)
+
+    # Archives saved by an import cut short are no use without the request that sent them
+    for name in os.listdir(app.config['IMPORT_FOLDER']):
+        if name.endswith(('.part', '.tmp')):
+            os.remove(os.path.join(app.config['IMPORT_FOLDER'], name))
+    prune_chunk_uploads()
+
+def chunk_upload_path(upload_id):
+    """Get the path a chunked upload is assembled at"""
+    return os.path.join(app.config['CHUNK_FOLDER'], f"{upload_id}.part")
+
+def chunk_upload_offset(upload_id):
+    """Get how many bytes of a chunked upload have been received"""
+    try:
+        return os.path.getsize(chunk_upload_path(upload_id))
+    except FileNotFoundError:
+        return 0
+
+def append_upload_chunk(upload_id, offset, data):
+    """Add a chunk to an upload if it starts where the bytes received so far end.
+
+    Returns the number of bytes received and whether the chunk was added.
+    A chunk that doesn't line up, such as one resent after its response
+    was lost, is dropped and the client carries on from the bytes received.
+    """
+    with chunk_upload_lock:
+        received = chunk_upload_offset(upload_id)
+        if offset != received:
+            return received, False
+        if received + len(data) > UPLOAD_MAX_FILE_SIZE:
+            raise ValueError(f"Uploads are limited to {UPLOAD_MAX_FILE_SIZE // (1024 * 1024)}MB")
+        with open(chunk_upload_path(upload_id), 'ab') as f:
+            f.write(data)
+        return received + len(data), True
+
+def finish_chunked_uploads(uploads, keep_originals=None):
+    """Spool completed chunked uploads and process them as one batch.
+
+    Each upload is a dict with its upload_id, name and size, and optionally
+    captured_at. keep_originals overrides the setting of the same name.
+    Returns the batch id, or None if none were complete, and the errors for
+    any that weren't.
+    """
+    batch_id = uuid.uuid4().hex[:12]
+    spooled = []
+    captured_at = {}
+    errors = []
+    for upload in uploads:
+        upload_id, name = str(upload.get('upload_id', '')), os.path.basename(str(upload.get('name', '')))
+        if not valid_import_id(upload_id) or not name.lower().endswith(archives.PHOTO_EXTENSIONS):
+            errors.append({'upload_id': upload_id, 'name': name, 'error': 'Invalid upload'})
+            continue
+        with chunk_upload_lock:
+            received = chunk_upload_offset(upload_id)
+            if received == 0 or received != upload.get('size'):
+                errors.append({'upload_id': upload_id, 'name': name,
+                               'error': f"Upload incomplete, {received} of {upload.get('size')} bytes received"})
+                continue
+            spool_path = os.path.join(app.config['SPOOL_FOLDER'], f"{batch_id}_{len(spooled):04d}_{name}")
+            os.replace(chunk_upload_path(upload_id), spool_path)
+        spooled.append((spool_path, name))
+        try:
+            captured_at[spool_path] = datetime.fromisoformat(upload['captured_at']).isoformat()
+        except (KeyError, TypeError, ValueError):
+            pass
+
+    for error in errors:
+        logger.warning(f"Chunked upload {error['upload_id']} ({error['name']}) not finished: {error['error']}")
+    if not spooled:
+        return None, errors
+    start_upload_batch(batch_id, spooled, captured_at, keep_originals)
+    return batch_id, errors
+
+def prune_chunk_uploads():
+    """Remove chunked uploads that were started but never finished"""
+    cutoff = time.time() - CHUNK_UPLOAD_EXPIRY_HOURS * 3600
+    with chunk_upload_lock:
+        for entry in os.scandir(app.config['CHUNK_FOLDER']):
+            if entry.name.endswith('.part') and entry.stat().st_mtime < cutoff:
+                logger.info(f"Removing abandoned chunked upload {entry.name}")
+                os.remove(entry.path)
+
+def busy_response(message):
+    """Build a 503 response asking the client to try again after RETRY_AFTER_SECONDS"""
+    response = jsonify({'error': message})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(RETRY_AFTER_SECONDS)
+    return response
+
+@contextmanager
+def image_request_slot():
+    """Hold an image request slot while a request decodes or renders images.
+
+    Aborts with 503 when no slot frees up within IMAGE_REQUEST_WAIT_SECONDS.
+    """
+    if not image_request_slots.acquire(timeout=IMAGE_REQUEST_WAIT_SECONDS):
+        requests_rejected.inc(reason='image_slots')
+        logger.warning(f"Turned away {request.path}: all {IMAGE_REQUEST_SLOTS} image request slots busy")
+        abort(busy_response('Busy processing other images, try again shortly'))
+    try:
+        yield
+    finally:
+        image_request_slots.release()
+        trim_memory()
+
+def check_upload_backlog():
+    """Abort with 503 while UPLOAD_QUEUE_LIMIT uploaded photos are waiting to be processed"""
+    if upload_queue_depth() >= UPLOAD_QUEUE_LIMIT:
+        requests_rejected.inc(reason='upload_backlog')
+        logger.warning(f"Turned away {request.path}: {UPLOAD_QUEUE_LIMIT} uploaded photos still waiting")
+        abort(busy_response('Still processing earlier uploads, try again shortly'))
+
+def check_profile_token():
+    """Abort the request unless profiling is enabled and the request carries its token"""
+    if not PROFILE_TOKEN:
+        abort(404)
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    if not hmac.compare_digest(supplied.encode(), PROFILE_TOKEN.encode()):
+        abort(401)
+
+def new_profile_path(kind, extension):
+    """Get a timestamped path in the profile folder for a saved profile"""
+    return os.path.join(app.config['PROFILE_FOLDER'], f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{kind}.{extension}")
+
+def profile_display_update(top=PROFILE_TOP, prof_path=None):
+    """Run one display refresh on the refresh worker under the profiler and return its report.
+
+    Returns None if a newer refresh request replaced it before it started,
+    or it didn't finish within PROFILE_TIMEOUT.
+    """
+    finished = threading.Event()
+    outcome = {}
+
+    def profiled_update():
+        try:
+            result, outcome['report'] = profiling.profile_call(update_display, top=top, prof_path=prof_path)
+        finally:
+            finished.set()
+        return result
+
+    request_id = request_display_update('profile', profiled_update)
+    deadline = time.monotonic() + PROFILE_TIMEOUT
+    while not finished.wait(1):
+        replaced = get_refresh_status(request_id)['state'] in ('done', 'failed') and not finished.is_set()
+        if replaced or time.monotonic() > deadline:
+            return None
+    return outcome.get('report')
+
+def profile_upload_file(path, original_name, top=PROFILE_TOP, prof_path=None):
+    """Process one upload under the profiler, returning the stored filename and the report"""
+    reserved = reserve_upload_memory(estimate_decode_memory(path, master_decode_size(DISPLAY_RESOLUTION)))
+    try:
+        filename, report = profiling.profile_call(process_upload, path, original_name, hash_file(path),
+                                                  top=top, prof_path=prof_path)
+    finally:
+        release_upload_memory(reserved)
+    photo_playlist.add(filename)
+    return filename, report
 
 @app.route('/')
 def index():
-    photos = []
-    for filename in os.listdir(app.config['UPLOAD_FOLDER']):
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            photos.append(filename)
-    photos.sort()
-    return render_template('index.html', photos=photos, current_photo=current_photo, current_orientation=current_orientation)
+    sort = request.args.get('sort', 'name')
+    if sort not in CATALOG_SORTS:
+        sort = 'name'
+    order = 'desc' if request.args.get('order') == 'desc' else 'asc'
+    shape = request.args.get('shape') if request.args.get('shape') in CATALOG_SHAPES else None
+
+    # Paginate the gallery
+    total_photos = count_photos(shape)
+    total_pages = max(1, (total_photos + PHOTOS_PER_PAGE - 1) // PHOTOS_PER_PAGE)
+    page = min(max(request.args.get('page', 1, type=int), 1), total_pages)
+    photos = list_photos(sort, order == 'desc', shape, PHOTOS_PER_PAGE, (page - 1) * PHOTOS_PER_PAGE)
+    return render_template('index.html', photos=photos, total_photos=total_photos,
+                           versions=photo_versions(photos + [current_photo]),
+                           page=page, total_pages=total_pages, sort=sort, order=order, shape=shape,
+                           favourites=favourite_photos(),
+                           current_photo=current_photo, current_orientation=current_orientation,
+                           dither=settings.get('dither'), saturation=settings.get('saturation'),
+                           dither_modes=quantize.DITHER_MODES,
+                           display_resolution=DISPLAY_RESOLUTION,
+                           upload_chunk_size=UPLOAD_CHUNK_SIZE,
+                           update_interval_hours=update_interval_hours(), quiet_hours=settings.get('quiet_hours'),
+                           min_refresh_minutes=settings.get('min_refresh_minutes'))
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Expose metrics in the Prometheus text format"""
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+def send_photo_file(path, key, etag):
+    """Send a photo or thumbnail with a strong ETag, answering If-None-Match and Range requests"""
+    versioned = request.args.get('v') == key[:PHOTO_VERSION_LENGTH]
+    response = send_file(path, mimetype='image/jpeg' if path.lower().endswith(('.jpg', '.jpeg')) else None,
+                         etag=etag, conditional=True, max_age=PHOTO_CACHE_SECONDS if versioned else 0)
+    if versioned:
+        response.cache_control.immutable = True
+    else:
+        # The same URL may serve a changed file, so check back each time
+        response.cache_control.no_cache = True
+    return response
+
+@app.route('/photos/<path:filename>')
+def full_photo(filename):
+    """Serve a full-size photo from the upload folder"""
+    photo = os.path.basename(filename)
+    path = os.path.join(app.config['UPLOAD_FOLDER'], photo)
+    if not os.path.isfile(path):
+        abort(404)
+    key = artifact_key(photo)
+    return send_photo_file(path, key, key)
+
+@app.route('/thumbnails/<size_name>/<path:filename>')
+def thumbnail(size_name, filename):
+    """Serve a photo thumbnail, creating it on demand if missing"""
+    if size_name not in THUMBNAIL_SIZES:
+        abort(404)
+    photo = os.path.basename(filename)
+    if not os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], photo)):
+        abort(404)
+    key = artifact_key(photo)
+    path = thumbnail_path(photo, size_name)
+    if not os.path.exists(path):
+        try:
+            with image_request_slot():
+                create_thumbnails(photo)
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Error creating thumbnails for {photo}: {e}")
+            abort(500)
+    width, height = THUMBNAIL_SIZES[size_name]
+    return send_photo_file(path, key, f"{key}-{width}x{height}")
+
+@app.route('/frames/<key>')
+def served_frame(key):
+    """Serve the packed frame of a photo, by content hash, for the size, orientation and colours asked for"""
+    width = request.args.get('width', type=int)
+    height = request.args.get('height', type=int)
+    orientation = request.args.get('orientation', ORIENTATION_0)
+    # Saturation is rounded so near-identical requests share a cached frame and render target
+    colours = {'dither': request.args.get('dither', quantize.DITHER_DIFFUSION),
+               'saturation': round(request.args.get('saturation', 0.5, type=float), 2), 'palette': None}
+    if request.args.get('palette'):
+        try:
+            values = [int(value) for value in request.args['palette'].split(',')]
+        except ValueError:
+            values = []
+        if len(values) != 21 or not all(0 <= value <= 255 for value in values):
+            return jsonify({'error': 'Palette must be 7 colours of 3 values from 0 to 255'}), 400
+        colours['palette'] = [values[i:i + 3] for i in range(0, 21, 3)]
+    if (not width or not height or not 0 < width <= RENDER_MAX_SIDE or not 0 < height <= RENDER_MAX_SIDE
+            or width * height % 2
+            or orientation not in [ORIENTATION_0, ORIENTATION_90, ORIENTATION_180, ORIENTATION_270]
+            or colours['dither'] not in quantize.DITHER_MODES or not 0.0 <= colours['saturation'] <= 1.0):
+        return jsonify({'error': 'Invalid frame size, orientation or colours'}), 400
+
+    photo = photo_for_key(key)
+    if photo is None:
+        abort(404)
+    resolution = (width, height)
+    cache_path = frame_cache_path(photo, orientation, resolution, colours)
+    etag = frame_etag(cache_path)
+    # The ETag names everything the frame depends on, so a match needs no rendering
+    if request.if_none_match.contains(etag):
+        remember_render_target(resolution, orientation, colours)
+        return '', 304, {'ETag': f'"{etag}"'}
+    if load_cached_frame(photo, orientation, resolution, colours) is None:
+        with image_request_slot():
+            render_frame(photo, orientation, resolution, colours)
+    remember_render_target(resolution, orientation, colours)
+    return send_file(cache_path, mimetype='application/octet-stream', etag=etag, conditional=True,
+                     max_age=PHOTO_CACHE_SECONDS)
 
 @app.route('/set_orientation', methods=['POST'])
 def set_orientation():
     """Handle orientation changes"""
-    global current_orientation
     new_orientation = request.form.get('orientation')
     if new_orientation in [ORIENTATION_0, ORIENTATION_90, ORIENTATION_180, ORIENTATION_270]:
-        current_orientation = new_orientation
-        save_settings({'orientation': current_orientation})
-        logger.info(f"Orientation changed to: {current_orientation}°")
-        update_display()  # Update the display with new orientation
+        if set_current_orientation(new_orientation):
+            request_display_update('web')  # Update the display with new orientation
+        else:
+            logger.info(f"Orientation already {new_orientation}°, not refreshing")
+    return redirect(url_for('index'))
+
+@app.route('/set_display_colours', methods=['POST'])
+def set_display_colours():
+    """Handle dithering and saturation changes"""
+    dither = request.form.get('dither')
+    saturation = request.form.get('saturation', type=float)
+    changes = {}
+    if dither in quantize.DITHER_MODES and dither != settings.get('dither'):
+        changes['dither'] = dither
+    if saturation is not None and 0.0 <= saturation <= 1.0 and saturation != settings.get('saturation'):
+        changes['saturation'] = saturation
+    if changes:
+        update_settings(**changes)
+        logger.info(f"Display colours changed: {changes}")
+        request_display_update('web')  # Update the display with the new colours
+    return redirect(url_for('index'))
+
+@app.route('/set_refresh_policy', methods=['POST'])
+def set_refresh_policy():
+    """Handle changes to how often and when the display refreshes"""
+    interval = request.form.get('update_interval_hours', type=float)
+    min_refresh = request.form.get('min_refresh_minutes', type=float)
+    quiet_start = request.form.get('quiet_start', '')
+    quiet_end = request.form.get('quiet_end', '')
+    changes = {}
+    if interval is not None and 0.25 <= interval <= 24:
+        changes['update_interval_hours'] = interval
+    if min_refresh is not None and 0 <= min_refresh <= 60:
+        changes['min_refresh_minutes'] = min_refresh
+    if not quiet_start and not quiet_end:
+        changes['quiet_hours'] = None
+    elif all(re.fullmatch(r'([01]\d|2[0-3]):[0-5]\d', value) for value in (quiet_start, quiet_end)):
+        changes['quiet_hours'] = [quiet_start, quiet_end]
+    update_settings(**changes)
+    logger.info(f"Refresh policy changed: {changes}")
+
+    if scheduler is not None and 'update_interval_hours' in changes:
+        scheduler.reschedule_job('update', trigger='interval', hours=update_interval_hours())
+    with refresh_condition:
+        refresh_condition.notify()  # A held refresh may be free to run now
     return redirect(url_for('index'))
 
 @app.route('/upload', methods=['POST'])
 def upload():
-    """Handle photo uploads"""
+    """Handle photo uploads by spooling them to disk for the upload workers"""
+    check_upload_backlog()
+    request.max_content_length = UPLOAD_MAX_REQUEST_SIZE
     if 'photos' not in request.files:
         logger.warning("Upload attempted with no files")
         return redirect(url_for('index'))
@@ -363,68 +2292,253 @@ def upload():
         logger.warning("Upload attempted with empty filenames")
         return redirect(url_for('index'))
     
-    uploaded_files = []
+    batch_id = uuid.uuid4().hex[:12]
+    spooled = []
     for file in files:
         if file and file.filename.lower().endswith(('.png', '.jpg', '.jpeg')):
+            original_name = os.path.basename(file.filename)
+            spool_path = os.path.join(app.config['SPOOL_FOLDER'], f"{batch_id}_{len(spooled):04d}_{original_name}")
             try:
-                # Open and process the image
-                image = Image.open(file)
-                
-                # Fix EXIF orientation during upload
-                image = fix_image_orientation(image)
-                
-                # Convert to RGB if necessary (handles PNG with transparency)
-                if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
-                    background = Image.new('RGB', image.size, (255, 255, 255))
-                    if image.mode == 'P':
-                        image = image.convert('RGBA')
-                    background.paste(image, mask=image.split()[-1])
-                    image = background
-                elif image.mode != 'RGB':
-                    image = image.convert('RGB')
-                
-                # Compress and resize the image
-                if current_orientation == ORIENTATION_90 or current_orientation == ORIENTATION_270:
-                    image = compress_image(image, display.height, display.width)
-                elif current_orientation == ORIENTATION_180:
-                    image = compress_image(image, display.width, display.height)
-                
-                # Generate filename and save path
-                filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file.filename}"
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                
-                # Save the compressed image
-                image.save(file_path, 'JPEG', quality=85, optimize=True)
-                logger.info(f"New photo uploaded and compressed: {filename}")
-                uploaded_files.append(filename)
-                
-                # Also copy to static directory if symlink failed
-                static_file_path = os.path.join(static_photos_dir, filename)
-                try:
-                    if not os.path.islink(static_photos_dir):
-                        shutil.copy2(file_path, static_file_path)
-                        logger.info(f"Copied photo to static directory: {filename}")
-                except Exception as e:
-                    logger.error(f"Error copying to static directory: {e}")
-                    
+                file.save(spool_path)
+                spooled.append((spool_path, original_name))
             except Exception as e:
-                logger.error(f"Error processing image {file.filename}: {e}")
-                continue
+                logger.error(f"Error spooling upload {file.filename}: {e}")
         else:
             logger.warning(f"Upload rejected - invalid file type: {file.filename}")
     
-    if uploaded_files:
-        update_display()  # Update display with the last uploaded image
+    if spooled:
+        start_upload_batch(batch_id, spooled)  # Also skips duplicates before they're decoded
     
+    if request.accept_mimetypes.best == 'application/json':
+        if not spooled:
+            return jsonify({'error': 'No valid photos in upload'}), 400
+        return jsonify({'batch_id': batch_id, 'status_url': url_for('upload_status', batch_id=batch_id)}), 202
     return redirect(url_for('index'))
 
+@app.route('/upload_chunks/<upload_id>', methods=['GET'])
+def upload_chunk_offset(upload_id):
+    """Report how much of a chunked upload has been received, so the client can resume it"""
+    if not valid_import_id(upload_id):
+        return jsonify({'error': 'Invalid upload id'}), 400
+    return jsonify({'upload_id': upload_id, 'offset': chunk_upload_offset(upload_id)})
+
+@app.route('/upload_chunks/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    """Receive the chunk of an upload starting at ?offset=, sent as the request body"""
+    offset = request.args.get('offset', type=int)
+    if not valid_import_id(upload_id) or offset is None:
+        return jsonify({'error': 'Invalid upload id or offset'}), 400
+    if request.content_length is None or request.content_length > UPLOAD_CHUNK_SIZE:
+        return jsonify({'error': f"Chunks are limited to {UPLOAD_CHUNK_SIZE} bytes"}), 413
+    data = request.get_data(cache=False)
+    try:
+        received, appended = append_upload_chunk(upload_id, offset, data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 413
+    except OSError as e:
+        logger.error(f"Error saving chunk of upload {upload_id}: {e}")
+        return jsonify({'error': 'Could not save chunk'}), 500
+    if not appended:
+        # Out of step, tell the client where to carry on from
+        return jsonify({'upload_id': upload_id, 'offset': received}), 409
+    return jsonify({'upload_id': upload_id, 'offset': received})
+
+@app.route('/upload_chunks/finish', methods=['POST'])
+def finish_upload_chunks():
+    """Process a set of completed chunked uploads as one batch, keeping the originals if keep_originals is true"""
+    check_upload_backlog()
+    body = request.get_json(silent=True) or {}
+    uploads = body.get('uploads')
+    if not isinstance(uploads, list) or not all(isinstance(upload, dict) for upload in uploads):
+        return jsonify({'error': 'Expected a list of uploads'}), 400
+    keep_originals = body.get('keep_originals')
+    batch_id, errors = finish_chunked_uploads(uploads, keep_originals if isinstance(keep_originals, bool) else None)
+    if batch_id is None:
+        return jsonify({'error': 'No complete uploads', 'errors': errors}), 400
+    return jsonify({'batch_id': batch_id, 'status_url': url_for('upload_status', batch_id=batch_id),
+                    'errors': errors}), 202
+
+@app.route('/import', methods=['POST'])
+def import_photos():
+    """Import a ZIP or tar archive of photos, sent as the request body or an 'archive' form file.
+
+    Clients on the frame itself may pass the path of an archive on it
+    instead, which is read in place. Passing the import_id of an earlier
+    import resumes it.
+    """
+    check_upload_backlog()
+    request.max_content_length = UPLOAD_MAX_REQUEST_SIZE
+    local_path = request.args.get('path')
+    if local_path and request.remote_addr not in ('127.0.0.1', '::1'):
+        return jsonify({'error': 'Archives can only be imported by path from the frame itself'}), 403
+    if local_path and not (os.path.isabs(local_path) and os.path.isfile(local_path)):
+        return jsonify({'error': f"No archive at {local_path}"}), 400
+    # A sent ZIP is saved whole before its photos are read, and the photos need room too
+    needed = (0 if local_path else request.content_length or 0) + IMPORT_MIN_FREE_SPACE
+    if shutil.disk_usage(app.config['UPLOAD_FOLDER']).free < needed:
+        return jsonify({'error': f"Not enough free space, {needed // (1024 * 1024)}MB is needed"}), 507
+    import_id = request.args.get('import_id') or uuid.uuid4().hex[:12]
+    if not valid_import_id(import_id):
+        return jsonify({'error': 'Invalid import id'}), 400
+    with upload_batches_lock:
+        running = import_id in upload_batches and not upload_batches[import_id]['finished_at']
+    if running:
+        return jsonify({'error': f"Import {import_id} is already running"}), 409
+
+    # Photos are read from the archive one at a time and processed in the background
+    if local_path:
+        with open(local_path, 'rb') as stream:
+            import_archive(stream, os.path.basename(local_path), import_id)
+    elif 'archive' in request.files:
+        archive = request.files['archive']
+        import_archive(archive.stream, os.path.basename(archive.filename or 'archive'), import_id)
+    else:
+        import_archive(request.stream, os.path.basename(request.args.get('name', 'archive')), import_id)
+    status = get_upload_batch_status(import_id)
+    if status['error'] and not status['total']:
+        return jsonify(dict(status, import_id=import_id)), 400
+    return jsonify({'import_id': import_id, 'status_url': url_for('upload_status', batch_id=import_id)}), 202
+
+@app.route('/upload_status/<batch_id>')
+def upload_status(batch_id):
+    """Report processing progress for an upload batch or import"""
+    status = get_upload_batch_status(batch_id) or load_import_report(batch_id)
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
 @app.route('/update_display', methods=['POST'])
 def trigger_update_display():
     """Manually trigger a display update"""
     logger.info("Manual display update triggered")
-    update_display()
+    request_display_update('web')
     return redirect(url_for('index'))
 
+@app.route('/display_status')
+def display_status():
+    """Report whether a display refresh is pending, running or done"""
+    return jsonify(get_refresh_status(request.args.get('id', type=int)))
+
+@app.route('/duplicates')
+def duplicates():
+    """Report the clusters of duplicate photos found by the last scan"""
+    report = load_duplicate_report() or {'scanned_at': None, 'photos': 0, 'duplicates': 0, 'clusters': []}
+    report['scanning'] = duplicate_scan_lock.locked()
+    return jsonify(report)
+
+@app.route('/duplicates/scan', methods=['POST'])
+def start_duplicate_scan():
+    """Start a background scan of the library for duplicate photos"""
+    if not duplicate_scan_lock.locked():
+        threading.Thread(target=scan_duplicates, daemon=True).start()
+    return jsonify({'status_url': url_for('duplicates')}), 202
+
+@app.route('/normalize')
+def normalization():
+    """Report the progress and savings of the last library normalization"""
+    report = load_normalize_report() or {'started_at': None, 'finished_at': None}
+    report['running'] = normalize_lock.locked()
+    return jsonify(report)
+
+@app.route('/normalize/run', methods=['POST'])
+def start_normalization():
+    """Start re-encoding oversized photos as masters, moving the originals aside if keep_originals is set"""
+    keep_originals = request.form.get('keep_originals', request.args.get('keep_originals'))
+    if keep_originals is None:
+        keep_originals = bool(settings.get('keep_originals'))
+    else:
+        keep_originals = keep_originals != '0'
+    if not normalize_lock.locked():
+        threading.Thread(target=normalize_library, args=(keep_originals,), name='normalize', daemon=True).start()
+    return jsonify({'status_url': url_for('normalization')}), 202
+
+@app.route('/profile/update', methods=['POST'])
+def profile_update():
+    """Run one display refresh under cProfile and tracemalloc and report where its time and memory went"""
+    check_profile_token()
+    if not profile_lock.acquire(blocking=False):
+        return jsonify({'error': 'A profile is already running'}), 409
+    try:
+        prof_path = new_profile_path('update', 'prof') if request.args.get('save') == '1' else None
+        report = profile_display_update(request.args.get('top', PROFILE_TOP, type=int), prof_path)
+    finally:
+        profile_lock.release()
+    if report is None:
+        return jsonify({'error': 'The profiled refresh was replaced by a newer one or timed out'}), 409
+    return jsonify(report)
+
+@app.route('/profile/upload', methods=['POST'])
+def profile_upload():
+    """Process one photo under cProfile and tracemalloc, sent as the request body or a 'photo' form file"""
+    check_profile_token()
+    request.max_content_length = UPLOAD_MAX_FILE_SIZE
+    if 'photo' in request.files:
+        file = request.files['photo']
+        stream, original_name = file.stream, os.path.basename(file.filename or '')
+    else:
+        stream, original_name = request.stream, os.path.basename(request.args.get('name', ''))
+    if not original_name.lower().endswith(('.png', '.jpg', '.jpeg')):
+        return jsonify({'error': 'Expected a .png, .jpg or .jpeg photo'}), 400
+    if not profile_lock.acquire(blocking=False):
+        return jsonify({'error': 'A profile is already running'}), 409
+    spool_path = os.path.join(app.config['PROFILE_FOLDER'], f"{uuid.uuid4().hex[:12]}.upload")
+    try:
+        with open(spool_path, 'wb') as f:
+            shutil.copyfileobj(stream, f)
+        duplicate = find_duplicate(hash_file(spool_path))
+        if duplicate:
+            return jsonify({'error': f"Photo is already stored as {duplicate}"}), 409
+        prof_path = new_profile_path('upload', 'prof') if request.args.get('save') == '1' else None
+        with image_request_slot():
+            filename, report = profile_upload_file(spool_path, original_name,
+                                                   request.args.get('top', PROFILE_TOP, type=int), prof_path)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error profiling upload {original_name}: {e}\n{traceback.format_exc()}")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        profile_lock.release()
+        if os.path.exists(spool_path):
+            os.remove(spool_path)
+    return jsonify(dict(report, filename=filename))
+
+@app.route('/profile/sample')
+def profile_sample():
+    """Report the current or last stack sampling run"""
+    check_profile_token()
+    return jsonify(sampler.report(request.args.get('top', PROFILE_TOP, type=int)))
+
+@app.route('/profile/sample', methods=['POST'])
+def start_profile_sample():
+    """Sample every thread's stack for ?minutes= (default 1) every ?interval_ms= (default 20)"""
+    check_profile_token()
+    minutes = request.args.get('minutes', 1, type=float)
+    interval_ms = request.args.get('interval_ms', 20, type=int)
+    if not 0 < minutes <= PROFILE_MAX_SAMPLE_MINUTES or not 1 <= interval_ms <= 1000:
+        return jsonify({'error': f"Sample for up to {PROFILE_MAX_SAMPLE_MINUTES} minutes "
+                                 f"at intervals of 1 to 1000ms"}), 400
+    if not sampler.start(minutes * 60, interval_ms / 1000, new_profile_path('sample', 'folded')):
+        return jsonify({'error': 'Stack sampling is already running'}), 409
+    logger.info(f"Stack sampling started for {minutes:g} minutes every {interval_ms}ms")
+    return jsonify({'status_url': url_for('profile_sample')}), 202
+
+@app.route('/profile/sample/stop', methods=['POST'])
+def stop_profile_sample():
+    """End the current stack sampling run early"""
+    check_profile_token()
+    sampler.stop()
+    return jsonify({'status_url': url_for('profile_sample')})
+
+@app.route('/profile/files/<name>')
+def profile_file(name):
+    """Download a saved .prof profile or .folded stack samples"""
+    check_profile_token()
+    path = os.path.join(app.config['PROFILE_FOLDER'], os.path.basename(name))
+    if not name.endswith(('.prof', '.folded')) or not os.path.isfile(path):
+        abort(404)
+    return send_file(path, as_attachment=True)
+
 @app.route('/bulk_delete', methods=['POST'])
 def bulk_delete():
     """Handle bulk photo deletion"""
@@ -434,16 +2548,35 @@ def bulk_delete():
     for filename in selected_files:
         try:
             file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            key = artifact_key(filename) if os.path.exists(file_path) else None
             if os.path.exists(file_path):
                 os.remove(file_path)
                 logger.info(f"Deleted file: {filename}")
             else:
                 logger.warning(f"File not found for deletion: {filename}")
+            catalog_remove(filename)
+            photo_playlist.remove(filename)
+            # Identical photos share cached frames and thumbnails
+            delete_unused_artifacts(key)
         except Exception as e:
             logger.error(f"Error deleting file {filename}: {e}")
     
     return redirect(url_for('index'))
 
+@app.route('/bulk_favourite', methods=['POST'])
+def bulk_favourite():
+    """Mark or unmark selected photos as favourites, which the playlist shows more often"""
+    selected_files = request.form.getlist('selected_files')
+    favourite = request.form.get('favourite') == '1'
+    logger.info(f"Bulk {'favourite' if favourite else 'unfavourite'} requested for {len(selected_files)} files")
+    for filename in selected_files:
+        try:
+            set_favourite(filename, favourite)
+            photo_playlist.reweight(filename)
+        except Exception as e:
+            logger.error(f"Error updating favourite {filename}: {e}")
+    return redirect(url_for('index'))
+
 @app.route('/bulk_display', methods=['POST'])
 def bulk_display():
     """Handle bulk display update with selected photos"""
@@ -457,45 +2590,81 @@ def bulk_display():
         logger.error("Display not initialized")
         return redirect(url_for('index'))
     
-    try:
-        # Use the first selected image for now (future enhancement could be to create a collage)
-        image_path = os.path.join(app.config['UPLOAD_FOLDER'], selected_files[0])
-        if os.path.exists(image_path):
-            logger.info(f"Updating display with selected image: {selected_files[0]}")
-            image = Image.open(image_path)
-            
-            # Convert to RGB if necessary
-            if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
-                background = Image.new('RGB', image.size, (255, 255, 255))
-                if image.mode == 'P':
-                    image = image.convert('RGBA')
-                background.paste(image, mask=image.split()[-1])
-                image = background
-            elif image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            # Fix orientation and compress
-            compressed_image = compress_image(image, display.width, display.height)
-            
-            # Update the display
-            display.set_image(compressed_image)
-            display.show()
-            
-            logger.info("Display updated successfully")
+    # Show one photo on its own, or up to COLLAGE_MAX_PHOTOS as a collage
+    photos = []
+    for filename in selected_files:
+        if os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], filename)):
+            photos.append(filename)
         else:
-            logger.error(f"Selected image not found: {image_path}")
-    except Exception as e:
-        logger.error(f"Error updating display with selected image: {e}")
+            logger.error(f"Selected image not found: {filename}")
+    if len(photos) > COLLAGE_MAX_PHOTOS:
+        logger.warning(f"Only the first {COLLAGE_MAX_PHOTOS} selected photos fit in a collage")
+        photos = photos[:COLLAGE_MAX_PHOTOS]
+    
+    if len(photos) == 1:
+        request_display_update('web', display_selected_image, (os.path.join(app.config['UPLOAD_FOLDER'], photos[0]),))
+    elif photos:
+        request_display_update('web', display_collage, (photos,))
     
     return redirect(url_for('index'))
 
+def display_selected_image(image_path):
+    """Show a selected image on the display, run by the display refresh worker"""
+    global current_photo
+    try:
+        photo = os.path.basename(image_path)
+        logger.info(f"Updating display with selected image: {photo}")
+        frame = render_frame(photo, current_orientation)
+        show_frame(frame, photo)
+        current_photo = photo
+        
+        logger.info("Display updated successfully")
+        return True
+    except Exception as e:
+        logger.error(f"Error updating display with selected image: {e}")
+        return False
+
+def open_collage_tile(photo, size):
+    """Open a photo for a collage tile, from its medium thumbnail when that is big enough"""
+    try:
+        thumbnail = Image.open(thumbnail_path(photo, 'medium'))
+        if thumbnail.width >= size[0] and thumbnail.height >= size[1]:
+            thumbnail.load()
+            return thumbnail
+        thumbnail.close()
+    except OSError:
+        pass  # No thumbnail yet
+    return open_image_covering(os.path.join(app.config['UPLOAD_FOLDER'], photo), size)
+
+def display_collage(photos):
+    """Show a collage of selected photos on the display, run by the display refresh worker"""
+    global current_photo
+    try:
+        logger.info(f"Updating display with a collage of {len(photos)} photos: {', '.join(photos)}")
+        resolution = (display.width, display.height)
+        tiles = collage_layout(len(photos), display_size_for(current_orientation, resolution))
+        with update_stage_seconds.time(stage='open'):
+            images = [open_collage_tile(photo, (width, height)) for photo, (_, _, width, height) in zip(photos, tiles)]
+        with update_stage_seconds.time(stage='prepare'):
+            image = render_collage(images, current_orientation, resolution)
+        with update_stage_seconds.time(stage='quantize'):
+            frame = quantize_for_display(image)
+        # The first photo stands in for the collage as the one on the panel
+        show_frame(frame, photos[0])
+        current_photo = photos[0]
+        
+        logger.info(f"Display updated with collage (peak RSS {peak_rss_mb()}MB)")
+        return True
+    except Exception as e:
+        logger.error(f"Error updating display with collage: {e}\n{traceback.format_exc()}")
+        return False
+
 @app.route('/delete_all_photos', methods=['POST'])
 def delete_all_photos():
     """Delete all photos from the system"""
     try:
         # Get list of all photos
-        photos = [f for f in os.listdir(app.config['UPLOAD_FOLDER']) 
-                if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+        photos = list_photos()
         
         logger.info(f"Attempting to delete all photos ({len(photos)} files)")
         
@@ -506,24 +2675,104 @@ def delete_all_photos():
                 if os.path.exists(file_path):
                     os.remove(file_path)
                     logger.info(f"Deleted file: {filename}")
-                
-                # Also remove from static directory if it exists
-                static_file_path = os.path.join(static_photos_dir, filename)
-                if os.path.exists(static_file_path) and not os.path.islink(static_photos_dir):
-                    os.remove(static_file_path)
-                    logger.info(f"Deleted file from static directory: {filename}")
             except Exception as e:
                 logger.error(f"Error deleting file {filename}: {e}")
         
+        catalog_clear()
+        photo_playlist.sync([])
+        
+        # Clear the frame cache and thumbnails
+        artifact_folders = [app.config['FRAME_CACHE_FOLDER']]
+        artifact_folders += [os.path.join(app.config['THUMBNAIL_FOLDER'], size_name) for size_name in THUMBNAIL_SIZES]
+        for folder in artifact_folders:
+            for filename in os.listdir(folder):
+                try:
+                    os.remove(os.path.join(folder, filename))
+                except Exception as e:
+                    logger.error(f"Error deleting cached file {filename}: {e}")
+        logger.info("Frame cache and thumbnails cleared")
+        
         logger.info("All photos deleted successfully")
     except Exception as e:
         logger.error(f"Error during bulk deletion: {e}")
     
     return redirect(url_for('index'))
 
+def create_app():
+    """Set up the app so the web interface can start serving straight away.
+
+    Only quick work happens here; the display, buttons, scheduler and
+    maintenance are started on a background thread.
+    """
+    global settings, current_orientation, current_photo, photo_playlist, shown_fingerprint
+    if app.config.get('STARTED'):
+        return app
+    app.config['STARTED'] = True
+    startup_seconds.set(time.perf_counter() - STARTUP_STARTED, phase='imports')
+
+    setup_logging()
+    logger.info("Starting Inky Photo Frame application")
+
+    with startup_phase('folders'):
+        for folder in (app.config['UPLOAD_FOLDER'], app.config['FRAME_CACHE_FOLDER'], app.config['SPOOL_FOLDER'],
+                       app.config['IMPORT_FOLDER'], app.config['CHUNK_FOLDER'], app.config['ORIGINALS_FOLDER'],
+                       app.config['PROFILE_FOLDER']):
+            os.makedirs(folder, exist_ok=True)
+        for size_name in THUMBNAIL_SIZES:
+            os.makedirs(os.path.join(app.config['THUMBNAIL_FOLDER'], size_name), exist_ok=True)
+        logger.info(f"Upload folder configured: {app.config['UPLOAD_FOLDER']}")
+
+    with startup_phase('catalog'):
+        init_catalog()
+
+    with startup_phase('settings'):
+        # Load saved settings, filling in any added since they were saved
+        settings = dict(DEFAULT_SETTINGS, **load_settings())
+        current_orientation = settings.get('orientation', ORIENTATION_0)
+        logger.info(f"Loaded orientation setting: {current_orientation}")
+        state = load_display_state()
+        if state and os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], str(state.get('photo')))):
+            current_photo = state['photo']
+        # Only a panel that keeps its image across restarts still shows the last frame
+        if state and DISPLAY_BACKEND in backends.PERSISTENT_DISPLAYS:
+            shown_fingerprint = state.get('fingerprint')
+
+    with startup_phase('render_targets'):
+        load_render_targets()
+
+    with startup_phase('playlist'):
+        photo_playlist = playlist.ShuffleBag(PLAYLIST_FILE, playlist_weight)
+        photo_playlist.sync(list_photos(unique=True))
+
+    threading.Thread(target=display_refresh_worker, name='display-refresh', daemon=True).start()
+    threading.Thread(target=startup_background, name='startup', daemon=True).start()
+    logger.info(f"Upload pipeline configured: {UPLOAD_WORKERS} workers, "
+                f"{UPLOAD_MEMORY_BUDGET // (1024 * 1024)}MB memory budget")
+
+    ready = time.perf_counter() - STARTUP_STARTED
+    startup_seconds.set(ready, phase='ready')
+    logger.info(f"Web interface ready {ready * 1000:.0f}ms after start")
+    return app
+
+def serve(application):
+    """Serve the app with waitress, or Flask's development server when asked to or waitress is missing"""
+    if SERVER != 'development':
+        try:
+            # Only imported here so the development server works without it
+            import waitress
+        except ImportError:
+            logger.warning("waitress is not installed, falling back to Flask's development server")
+        else:
+            logger.info(f"Starting waitress on port {SERVER_PORT} with {SERVER_THREADS} threads")
+            waitress.serve(application, host='0.0.0.0', port=SERVER_PORT, threads=SERVER_THREADS,
+                           connection_limit=SERVER_CONNECTION_LIMIT, max_request_body_size=UPLOAD_MAX_REQUEST_SIZE,
+                           ident='inky-photo-frame')
+            return
+    logger.info("Starting Flask web server")
+    application.run(host='0.0.0.0', port=SERVER_PORT)
+
 if __name__ == '__main__':
     try:
-        logger.info("Starting Flask web server")
-        app.run(host='0.0.0.0', port=5000)
+        serve(create_app())
     finally:
-        GPIO.cleanup()  # Clean up GPIO on exit 
\ No newline at end of file
+        cleanup_buttons()  # Clean up GPIO on exit 
\ No newline at end of file
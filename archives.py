@@ -0,0 +1,101 @@
+"""Read photos out of ZIP and tar archives one member at a time.
+
+Tar archives (optionally compressed) are read straight from the stream.
+ZIP archives keep their index at the end, so a ZIP arriving as a stream
+is first saved to a single spool file, still compressed, and its members
+read from there. A ZIP already in a file is read in place.
+"""
+import io
+import os
+import shutil
+import tarfile
+import zipfile
+
+PHOTO_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+ZIP_MAGIC = b'PK\x03\x04'
+
+class _PrefixedStream(io.RawIOBase):
+    """A read-only stream that puts back bytes already read from the start of another"""
+
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.prefix:
+            count = min(len(buffer), len(self.prefix))
+            buffer[:count] = self.prefix[:count]
+            self.prefix = self.prefix[count:]
+            return count
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+def is_photo_member(name):
+    """Check whether an archive member name looks like a photo worth importing"""
+    base = os.path.basename(name)
+    # Skip folders, hidden files and the resource forks macOS adds to ZIPs
+    return (bool(base) and not base.startswith('.') and '__MACOSX/' not in name
+            and base.lower().endswith(PHOTO_EXTENSIONS))
+
+def save_member(fileobj, size, max_size, path):
+    """Copy a member to a file a piece at a time, refusing it if it is too big"""
+    if size > max_size:
+        raise ValueError(f"{size // (1024 * 1024)}MB is over the {max_size // (1024 * 1024)}MB limit")
+    written = 0
+    try:
+        with open(path, 'wb') as f:
+            # The header's size is checked again against what the member really holds
+            while chunk := fileobj.read(1024 * 1024):
+                written += len(chunk)
+                if written > max_size:
+                    raise ValueError(f"Member is over the {max_size // (1024 * 1024)}MB limit")
+                f.write(chunk)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+def _iter_zip_members(file, max_size):
+    """Yield (name, size, save) for each photo in a ZIP file, given by path or seekable stream"""
+    with zipfile.ZipFile(file) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or not is_photo_member(info.filename):
+                continue
+            def save(path, info=info):
+                with archive.open(info) as member:
+                    save_member(member, info.file_size, max_size, path)
+            yield info.filename, info.file_size, save
+
+def iter_photo_members(stream, spool_path, max_size):
+    """Yield (name, size, save) for each photo in a ZIP or tar archive, one at a time.
+
+    Calling save(path) copies the member to a file, so it is never held in
+    memory whole. For tar archives it must be called before moving on to the
+    next member, and members that are never saved are skipped over.
+    """
+    head = stream.read(len(ZIP_MAGIC))
+    if head == ZIP_MAGIC and getattr(stream, 'seekable', lambda: False)():
+        stream.seek(0)
+        yield from _iter_zip_members(stream, max_size)
+        return
+    stream = io.BufferedReader(_PrefixedStream(head, stream))
+
+    if head == ZIP_MAGIC:
+        with open(spool_path, 'wb') as f:
+            shutil.copyfileobj(stream, f, 1024 * 1024)
+        try:
+            yield from _iter_zip_members(spool_path, max_size)
+        finally:
+            os.remove(spool_path)
+    else:
+        with tarfile.open(fileobj=stream, mode='r|*') as archive:
+            for info in archive:
+                if not info.isfile() or not is_photo_member(info.name):
+                    continue
+                def save(path, info=info):
+                    save_member(archive.extractfile(info), info.size, max_size, path)
+                yield info.name, info.size, save
@@ -0,0 +1,110 @@
+import os
+import logging
+import threading
+from datetime import datetime
+from lazy import lazy_import
+import quantize
+
+numpy = lazy_import('numpy')
+Image = lazy_import('PIL.Image')
+
+logger = logging.getLogger('inky_frame')
+
+# Display backends: the real panel, or stand-ins that record frames instead
+DISPLAY_INKY = 'inky'
+DISPLAY_MEMORY = 'memory'
+DISPLAY_FILE = 'file'
+DISPLAY_BACKENDS = [DISPLAY_INKY, DISPLAY_MEMORY, DISPLAY_FILE]
+# Backends that still show the last frame after the app restarts
+PERSISTENT_DISPLAYS = [DISPLAY_INKY, DISPLAY_FILE]
+
+# Button backends: Raspberry Pi GPIO, or none at all
+BUTTONS_GPIO = 'gpio'
+BUTTONS_NULL = 'null'
+BUTTON_BACKENDS = [BUTTONS_GPIO, BUTTONS_NULL]
+
+class MemoryDisplay:
+    """Stand-in for the Inky display that keeps the frames it is shown in memory"""
+
+    def __init__(self, resolution=(600, 448), max_frames=10):
+        self.resolution = resolution
+        self.width, self.height = resolution
+        self.buf = numpy.zeros((self.height, self.width), dtype=numpy.uint8)
+        self.max_frames = max_frames
+        self.frames = []
+        self.show_count = 0
+        self._lock = threading.Lock()
+
+    def set_image(self, image, saturation=0.5):
+        """Copy an image to the buffer, quantizing it the way Inky does if it isn't a palette image"""
+        if not image.size == (self.width, self.height):
+            raise ValueError(f"Image must be ({self.width}x{self.height}) pixels!")
+        if not image.mode == "P":
+            image = quantize.quantize_image(image, quantize.DITHER_DIFFUSION, saturation)
+        self.buf = numpy.array(image, dtype=numpy.uint8).reshape((self.height, self.width))
+
+    def show(self, busy_wait=True):
+        """Record the buffer as a shown frame"""
+        with self._lock:
+            self.show_count += 1
+            self.frames.append(self.buf.copy())
+            del self.frames[:-self.max_frames]
+
+    def frame_image(self, buf=None, saturation=0.5):
+        """Render a palette index buffer, the last shown frame by default, as an RGB image"""
+        if buf is None:
+            buf = self.frames[-1] if self.frames else self.buf
+        image = Image.frombytes('P', (self.width, self.height), numpy.ascontiguousarray(buf).tobytes())
+        image.putpalette([c for colour in quantize.blend_palette(saturation) for c in colour])
+        return image.convert('RGB')
+
+class FileDisplay(MemoryDisplay):
+    """Stand-in for the Inky display that also writes each shown frame to a PNG file"""
+
+    def __init__(self, resolution=(600, 448), folder='frames'):
+        super().__init__(resolution)
+        self.folder = os.path.abspath(folder)
+        os.makedirs(self.folder, exist_ok=True)
+
+    def show(self, busy_wait=True):
+        """Record the buffer and save it as a PNG"""
+        super().show(busy_wait)
+        path = os.path.join(self.folder, f"frame_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{self.show_count:04d}.png")
+        self.frame_image().save(path)
+        logger.info(f"Saved displayed frame to {path}")
+
+def set_buffer(display, buf):
+    """Put a palette index buffer straight into a display's buffer, as set_image would, without PIL"""
+    if buf.shape != (display.height, display.width):
+        raise ValueError(f"Buffer must be ({display.width}x{display.height}) pixels!")
+    display.buf = numpy.array(buf, dtype=numpy.uint8)
+
+def create_display(backend=DISPLAY_INKY, resolution=(600, 448), folder='frames'):
+    """Create the display for a backend name"""
+    if backend == DISPLAY_INKY:
+        # Only imported here so other backends work without the Inky library
+        from inky import Inky7Colour
+        return Inky7Colour(resolution=resolution)
+    elif backend == DISPLAY_MEMORY:
+        return MemoryDisplay(resolution)
+    elif backend == DISPLAY_FILE:
+        return FileDisplay(resolution, folder)
+    raise ValueError(f"Unknown display backend: {backend}")
+
+def setup_buttons(backend, pins, callback, bouncetime=250):
+    """Watch the button pins for presses, returning a function that releases them"""
+    if backend == BUTTONS_NULL:
+        logger.info("Buttons disabled")
+        return lambda: None
+    elif backend != BUTTONS_GPIO:
+        raise ValueError(f"Unknown button backend: {backend}")
+
+    # Only imported here so other backends work off a Raspberry Pi
+    import RPi.GPIO as GPIO
+
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setup(pins, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+    for pin in pins:
+        GPIO.remove_event_detect(pin)  # Remove existing detection first
+        GPIO.add_event_detect(pin, GPIO.FALLING, callback=callback, bouncetime=bouncetime)
+    return GPIO.cleanup
@@ -0,0 +1,227 @@
+"""Benchmark the render pipeline on a fixed corpus of synthetic images.
+
+Runs without the Inky display or GPIO. Each corpus image is run in a fresh
+process so its peak memory can be measured on its own.
+
+    python benchmark.py --output results.json
+    python benchmark.py --compare results.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import multiprocessing
+from datetime import datetime
+import numpy
+import PIL
+from PIL import Image
+import imaging
+import quantize
+import backends
+
+CORPUS_FOLDER = os.path.abspath(os.path.join('cache', 'benchmark'))
+RESOLUTION = (600, 448)
+
+# (filename, size, EXIF orientation); PNGs with "alpha" in the name get transparency
+CORPUS = [
+    ('photo_2mp.jpg', (1600, 1200), 1),
+    ('photo_12mp.jpg', (4032, 3024), 1),
+    ('photo_12mp_rotated.jpg', (4032, 3024), 6),
+    ('photo_48mp.jpg', (8000, 6000), 1),
+    ('graphic_2mp.png', (1600, 1200), 1),
+    ('graphic_8mp_alpha.png', (3264, 2448), 1)
+]
+
+STAGES = ['decode', 'exif', 'flatten', 'resize'] + [f"quantize_{mode}" for mode in quantize.DITHER_MODES] + ['show']
+
+def make_corpus_image(filename, size, orientation, seed):
+    """Generate a deterministic photo-like image: smooth colour fields plus fine noise"""
+    width, height = size
+    rng = numpy.random.RandomState(seed)
+    fields = Image.fromarray(rng.randint(0, 256, (12, 16, 3), dtype=numpy.uint8), 'RGB')
+    image = fields.resize(size, Image.Resampling.BICUBIC)
+    noise = Image.fromarray(rng.randint(0, 256, (height // 4, width // 4), dtype=numpy.uint8), 'L')
+    image = Image.blend(image, Image.merge('RGB', [noise.resize(size)] * 3), 0.15)
+
+    path = os.path.join(CORPUS_FOLDER, filename)
+    if filename.endswith('.png'):
+        if 'alpha' in filename:
+            image.putalpha(Image.linear_gradient('L').resize(size))
+        image.save(path, 'PNG')
+    else:
+        exif = Image.Exif()
+        exif[274] = orientation
+        image.save(path, 'JPEG', quality=90, exif=exif.tobytes())
+    return path
+
+def ensure_corpus():
+    """Generate any missing corpus images, returning their paths"""
+    os.makedirs(CORPUS_FOLDER, exist_ok=True)
+    paths = []
+    for seed, (filename, size, orientation) in enumerate(CORPUS):
+        path = os.path.join(CORPUS_FOLDER, filename)
+        if not os.path.exists(path):
+            print(f"Generating {filename} ({size[0]}x{size[1]})", file=sys.stderr)
+            make_corpus_image(filename, size, orientation, seed)
+        paths.append(path)
+    return paths
+
+def read_memory_mb(field):
+    """Read a memory figure for this process, such as VmRSS or VmHWM, in megabytes.
+
+    VmHWM is used for the peak rather than getrusage(), whose maximum is
+    carried over from the parent when a process is spawned.
+    """
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) // 1024
+    return 0
+
+def run_case(path, orientation, repeat):
+    """Time each pipeline stage for one image; runs in its own process"""
+    baseline_rss = read_memory_mb('VmRSS')
+    display = backends.MemoryDisplay(RESOLUTION)
+    target_size = imaging.display_size_for(orientation, RESOLUTION)
+    timings = {stage: [] for stage in STAGES}
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        image, exif_orientation = imaging.decode_image(path, target_size)
+        timings['decode'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        image = imaging.apply_exif_orientation(image, exif_orientation)
+        timings['exif'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        image = imaging.flatten_to_rgb(image)
+        timings['flatten'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        display_image = imaging.prepare_for_display(image, orientation, RESOLUTION)
+        timings['resize'].append(time.perf_counter() - start)
+
+        for mode in quantize.DITHER_MODES:
+            start = time.perf_counter()
+            frame = quantize.quantize_image(display_image, mode)
+            timings[f"quantize_{mode}"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        display.set_image(frame)
+        display.show()
+        imaging.pack_frame(display.buf)
+        timings['show'].append(time.perf_counter() - start)
+
+    with Image.open(path) as header:
+        width, height = header.size
+    stages = {stage: {'mean_ms': round(sum(values) / len(values) * 1000, 2),
+                      'min_ms': round(min(values) * 1000, 2)}
+              for stage, values in timings.items()}
+    # A full refresh quantizes once, with the default error diffusion
+    pipeline_stages = ['decode', 'exif', 'flatten', 'resize', 'quantize_diffusion', 'show']
+    total_ms = sum(stages[stage]['mean_ms'] for stage in pipeline_stages)
+    return {
+        'image': os.path.basename(path),
+        'format': os.path.splitext(path)[1].lstrip('.').upper(),
+        'size': [width, height],
+        'file_size': os.path.getsize(path),
+        'stages': stages,
+        'total_ms': round(total_ms, 2),
+        'images_per_sec': round(1000 / total_ms, 3) if total_ms else None,
+        'megapixels_per_sec': round(width * height / 1e6 / (total_ms / 1000), 2) if total_ms else None,
+        'baseline_rss_mb': baseline_rss,
+        'peak_rss_mb': read_memory_mb('VmHWM'),
+        'peak_rss_delta_mb': read_memory_mb('VmHWM') - baseline_rss
+    }
+
+def git_commit():
+    """Get the current git commit, if this is a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def run_benchmark(repeat=3, orientation=imaging.ORIENTATION_0):
+    """Run every corpus image through the pipeline and collect the results"""
+    paths = ensure_corpus()
+    # Build the palette lookup table up front so it isn't timed
+    quantize.get_palette_lut(quantize.blend_palette())
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for path in paths:
+            result = pool.apply(run_case, (path, orientation, repeat))
+            results.append(result)
+            print(f"{result['image']:<28} {result['total_ms']:>9.1f} ms  "
+                  f"{result['megapixels_per_sec']:>7.2f} MP/s  peak +{result['peak_rss_delta_mb']} MB",
+                  file=sys.stderr)
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'date': datetime.now().isoformat(),
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'numpy': numpy.__version__,
+            'cpu_count': os.cpu_count(),
+            'repeat': repeat,
+            'orientation': orientation,
+            'resolution': list(RESOLUTION)
+        },
+        'results': results
+    }
+
+def print_report(report, baseline=None):
+    """Print per-stage timings, with the change from a baseline report if given"""
+    baseline_results = {r['image']: r for r in baseline['results']} if baseline else {}
+    print(f"Commit {report['meta']['commit']} on {report['meta']['machine']}, "
+          f"mean of {report['meta']['repeat']} runs (ms)")
+    print(f"{'image':<28}" + ''.join(f"{stage.replace('quantize_', 'q_'):>12}" for stage in STAGES)
+          + f"{'total':>10}{'peak MB':>9}")
+    for result in report['results']:
+        row = f"{result['image']:<28}"
+        row += ''.join(f"{result['stages'][stage]['mean_ms']:>12.1f}" for stage in STAGES)
+        row += f"{result['total_ms']:>10.1f}{result['peak_rss_delta_mb']:>9}"
+        print(row)
+
+        previous = baseline_results.get(result['image'])
+        if previous:
+            changes = []
+            for stage in STAGES + ['total']:
+                old = previous['total_ms'] if stage == 'total' else previous['stages'].get(stage, {}).get('mean_ms')
+                new = result['total_ms'] if stage == 'total' else result['stages'][stage]['mean_ms']
+                changes.append(f"{(new - old) / old * 100:>+11.0f}%" if old else f"{'-':>12}")
+            memory_change = result['peak_rss_delta_mb'] - previous['peak_rss_delta_mb']
+            print(f"{'  vs ' + str(baseline['meta']['commit']):<28}" + ''.join(changes[:-1])
+                  + f"{changes[-1]:>10}{memory_change:>+9}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Inky Photo Frame render pipeline")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per image (default: 3)")
+    parser.add_argument('--orientation', choices=imaging.ORIENTATIONS, default=imaging.ORIENTATION_0)
+    parser.add_argument('--output', help="save results as JSON to compare against later")
+    parser.add_argument('--compare', help="JSON results from an earlier run to compare against")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    report = run_benchmark(args.repeat, args.orientation)
+    print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results saved to {args.output}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,355 @@
+import os
+import math
+import ctypes
+import logging
+import resource
+import threading
+from datetime import datetime
+from lazy import lazy_import
+
+# Only imported when an image is first processed, to keep startup fast
+numpy = lazy_import('numpy')
+Image = lazy_import('PIL.Image')
+
+logger = logging.getLogger('inky_frame')
+
+ORIENTATION_0 = "0"    # Normal
+ORIENTATION_90 = "90"  # Rotated right
+ORIENTATION_180 = "180"  # Upside down
+ORIENTATION_270 = "270"  # Rotated left
+ORIENTATIONS = [ORIENTATION_0, ORIENTATION_90, ORIENTATION_180, ORIENTATION_270]
+
+# Most memory a single image may take once decoded; bigger JPEGs are decoded
+# at reduced scale and other formats over the limit are refused
+DECODE_MEMORY_BUDGET = 96 * 1024 * 1024
+
+# Collages of up to COLLAGE_MAX_PHOTOS photos, with white gutters between them
+COLLAGE_MAX_PHOTOS = 4
+COLLAGE_GUTTER = 4
+
+def get_exif_orientation(image):
+    """Get the EXIF orientation tag of an image, reading only its header"""
+    try:
+        # Check if image has EXIF data
+        if hasattr(image, '_getexif') and image._getexif():
+            exif = dict(image._getexif().items())
+            
+            # EXIF orientation tag
+            return exif.get(274, 1)  # 274 is the orientation tag ID
+    except Exception as e:
+        logger.warning(f"Error processing EXIF orientation: {e}")
+    return 1
+
+def oriented_size(image):
+    """Get the size of an opened image once its EXIF orientation is applied, reading only its header"""
+    width, height = image.size
+    if get_exif_orientation(image) in (5, 6, 7, 8):
+        return (height, width)
+    return (width, height)
+
+def apply_exif_orientation(image, orientation):
+    """Rotate or flip an image according to an EXIF orientation value"""
+    if orientation == 2:
+        return image.transpose(Image.FLIP_LEFT_RIGHT)
+    elif orientation == 3:
+        return image.transpose(Image.ROTATE_180)
+    elif orientation == 4:
+        return image.transpose(Image.FLIP_TOP_BOTTOM)
+    elif orientation == 5:
+        return image.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_90)
+    elif orientation == 6:
+        return image.transpose(Image.ROTATE_270)
+    elif orientation == 7:
+        return image.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_270)
+    elif orientation == 8:
+        return image.transpose(Image.ROTATE_90)
+    return image
+
+def fix_image_orientation(image):
+    """Fix image orientation based on EXIF data"""
+    try:
+        return apply_exif_orientation(image, get_exif_orientation(image))
+    except Exception as e:
+        logger.warning(f"Error processing EXIF orientation: {e}")
+    
+    return image
+
+def get_capture_time(image):
+    """Get the EXIF capture time of an image as an ISO timestamp, or None"""
+    try:
+        if hasattr(image, '_getexif') and image._getexif():
+            exif = image._getexif()
+            # 36867 is DateTimeOriginal, 306 is DateTime
+            value = exif.get(36867) or exif.get(306)
+            if value:
+                return datetime.strptime(value.strip('\x00 '), '%Y:%m:%d %H:%M:%S').isoformat()
+    except Exception as e:
+        logger.warning(f"Error reading EXIF capture time: {e}")
+    return None
+
+def plan_decode(image, target_size=None):
+    """Work out the smallest size an opened image needs decoding at.
+
+    The size is still big enough to fit target_size once EXIF orientation is
+    applied, and is shrunk further if needed to fit DECODE_MEMORY_BUDGET.
+    It is in the image's stored orientation, ready to pass to draft().
+    """
+    width, height = image.size
+    scale = 1.0
+    if target_size is not None:
+        target_width, target_height = target_size
+        if get_exif_orientation(image) in (5, 6, 7, 8):
+            target_width, target_height = target_height, target_width
+        scale = min(target_width / width, target_height / height, 1.0)
+    needed = (max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale)))
+
+    # Pillow keeps decoded pixels at up to 4 bytes each, and the JPEG decoder
+    # only scales by powers of two, so find the first scale that fits the budget
+    for denominator in (1, 2, 4, 8):
+        if math.ceil(width / denominator) * math.ceil(height / denominator) * 4 <= DECODE_MEMORY_BUDGET:
+            break
+    if denominator > 1:
+        needed = (min(needed[0], width // denominator), min(needed[1], height // denominator))
+    return needed
+
+def decode_image(source, target_size=None):
+    """Decode an image at reduced scale for a target box, returning it with its EXIF orientation.
+
+    JPEGs are scaled by the decoder itself (1/2, 1/4 or 1/8), other formats
+    are reduced by an integer factor straight after decoding. The decoded size
+    is checked against DECODE_MEMORY_BUDGET before any pixels are read.
+    Without a target size the image is only reduced as far as the budget needs.
+    """
+    image = Image.open(source)
+    orientation = get_exif_orientation(image)
+    original_size = image.size
+    needed = plan_decode(image, target_size)
+    if image.format == 'JPEG':
+        image.draft('RGB', needed)
+
+    decoded_bytes = image.width * image.height * 4
+    if decoded_bytes > DECODE_MEMORY_BUDGET:
+        raise ValueError(f"Image {image.width}x{image.height} needs {decoded_bytes // (1024 * 1024)}MB to decode, "
+                         f"over the {DECODE_MEMORY_BUDGET // (1024 * 1024)}MB budget")
+    image.load()
+
+    factor = min(image.width // needed[0], image.height // needed[1])
+    if factor >= 2:
+        image = image.reduce(factor)
+    logger.info(f"Decoded {original_size[0]}x{original_size[1]} image at {image.width}x{image.height} "
+                f"(~{decoded_bytes // (1024 * 1024)}MB)")
+    return image, orientation
+
+def open_image(source, target_size=None):
+    """Open an image decoded at reduced scale for a target box, with EXIF orientation applied"""
+    image, orientation = decode_image(source, target_size)
+    return apply_exif_orientation(image, orientation)
+
+def open_image_covering(source, size):
+    """Open an image decoded at reduced scale, but still big enough to fill a box once cropped"""
+    with Image.open(source) as header:
+        width, height = oriented_size(header)
+    scale = min(max(size[0] / width, size[1] / height), 1.0)
+    return open_image(source, (math.ceil(width * scale), math.ceil(height * scale)))
+
+def estimate_decode_memory(source, target_size=None):
+    """Estimate the bytes needed to decode and process an image from its header"""
+    with Image.open(source) as image:
+        if image.format == 'JPEG':
+            image.draft('RGB', plan_decode(image, target_size))
+        width, height = image.size
+    # Decoded source plus the converted and resized copies made while processing
+    return width * height * 4 * 2
+
+def peak_rss_mb():
+    """Get the peak resident memory of this process in megabytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+def current_rss_bytes():
+    """Get the current resident memory of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        # Not Linux; the peak is the best figure available
+        return peak_rss_mb() * 1024 * 1024
+
+def trim_memory():
+    """Hand memory freed after image work back to the system, where the C library allows it"""
+    try:
+        ctypes.CDLL(None).malloc_trim(0)
+    except (OSError, AttributeError):
+        pass  # Not glibc; freed memory is kept for reuse instead
+
+def lower_thread_priority(niceness):
+    """Lower the calling thread's CPU priority, and on Linux its disk priority with it, where the system allows"""
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), niceness)
+    except (AttributeError, OSError):
+        pass  # Not Linux, or not allowed; the thread keeps its priority
+
+def flatten_to_rgb(image):
+    """Convert an image to RGB, putting any transparency on a white background"""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        if image.mode == 'P':
+            image = image.convert('RGBA')
+        background.paste(image, mask=image.split()[-1])
+        return background
+    elif image.mode != 'RGB':
+        return image.convert('RGB')
+    return image
+
+def perceptual_hash(image):
+    """Get a 64-bit difference hash of an image as hex, unchanged by resizing or re-encoding"""
+    small = image.convert('L').resize((9, 8), Image.Resampling.LANCZOS)
+    pixels = numpy.asarray(small, dtype=numpy.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return f"{int(''.join('1' if bit else '0' for bit in bits), 2):016x}"
+
+def hash_distance(first, second):
+    """Count the bits that differ between two perceptual hashes"""
+    return bin(int(first, 16) ^ int(second, 16)).count('1')
+
+def display_size_for(orientation, resolution):
+    """Get the size an image is laid out at, before rotation, for an orientation"""
+    width, height = resolution
+    if orientation in [ORIENTATION_90, ORIENTATION_270]:
+        return (height, width)
+    return (width, height)
+
+def master_size_for(size, resolution):
+    """Get the size a photo is stored at: the largest it is shown at in either panel orientation.
+
+    Photos are never enlarged, and keep their aspect ratio without padding,
+    so one master serves landscape and portrait layouts alike.
+    """
+    width, height = size
+    panel_width, panel_height = resolution
+    scale = max(min(panel_width / width, panel_height / height), min(panel_height / width, panel_width / height))
+    scale = min(scale, 1.0)
+    return (max(1, round(width * scale)), max(1, round(height * scale)))
+
+def master_decode_size(resolution):
+    """Get a box that decoding at reduced scale for still leaves enough pixels for any master"""
+    return (max(resolution), max(resolution))
+
+def normalize_image(image, resolution):
+    """Shrink an image to the size its master is stored at"""
+    size = master_size_for(image.size, resolution)
+    if size == image.size:
+        return image
+    return image.resize(size, Image.Resampling.LANCZOS)
+
+def prepare_for_display(image, orientation, resolution):
+    """Prepare image for display by rotating if needed"""
+    # Create a mapping of orientations to rotation angles
+    rotations = {
+        ORIENTATION_0: 0,
+        ORIENTATION_90: 90,
+        ORIENTATION_180: 180,
+        ORIENTATION_270: 270
+    }
+    
+    # Determine target dimensions based on orientation
+    target_width, target_height = display_size_for(orientation, resolution)
+    
+    # Calculate scaling ratios
+    width_ratio = target_width / image.width
+    height_ratio = target_height / image.height
+    scale_ratio = min(width_ratio, height_ratio)
+    
+    # Calculate new dimensions
+    new_width = int(image.width * scale_ratio)
+    new_height = int(image.height * scale_ratio)
+    
+    # Create a black background image of the correct size
+    final_image = Image.new("RGB", (target_width, target_height), (0, 0, 0))
+    
+    # Resize the original image
+    resized_image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    
+    # Center the resized image
+    x = (target_width - new_width) // 2
+    y = (target_height - new_height) // 2
+    final_image.paste(resized_image, (x, y))
+    
+    # Get the rotation angle and rotate if needed
+    angle = rotations.get(orientation, 0)
+    if angle != 0:
+        # For 90 and 270 degree rotations, we need to rotate around the center and adjust the size
+        if orientation in [ORIENTATION_90, ORIENTATION_270]:
+            # Create a new image with swapped dimensions
+            rotated = Image.new("RGB", resolution, (255, 255, 255))
+            # Rotate and paste into the center of the new image
+            rotated_content = final_image.rotate(angle, expand=True)
+            x = (resolution[0] - rotated_content.width) // 2
+            y = (resolution[1] - rotated_content.height) // 2
+            rotated.paste(rotated_content, (x, y))
+            return rotated
+        else:
+            return final_image.rotate(angle, expand=False)
+    
+    return final_image
+
+def split_box(box, count, across):
+    """Split an (x, y, width, height) box into equal parts side by side or stacked, with gutters between"""
+    x, y, width, height = box
+    length = width if across else height
+    edges = [round(i * (length + COLLAGE_GUTTER) / count) for i in range(count + 1)]
+    parts = []
+    for start, end in zip(edges, edges[1:]):
+        size = end - start - COLLAGE_GUTTER
+        parts.append((x + start, y, size, height) if across else (x, y + start, width, size))
+    return parts
+
+def collage_layout(count, size):
+    """Get the (x, y, width, height) tiles of a collage of 2 to 4 photos filling size.
+
+    Tiles are split along the long side first, so two photos sit side by side
+    in landscape and stacked in portrait. With three, the first photo takes
+    half and the other two share the rest.
+    """
+    width, height = size
+    across = width >= height
+    whole = (0, 0, width, height)
+    if count == 2:
+        return split_box(whole, 2, across)
+    elif count == 3:
+        first, rest = split_box(whole, 2, across)
+        return [first] + split_box(rest, 2, not across)
+    elif count == 4:
+        return [tile for row in split_box(whole, 2, False) for tile in split_box(row, 2, True)]
+    raise ValueError(f"A collage needs 2 to {COLLAGE_MAX_PHOTOS} photos, not {count}")
+
+def fill_tile(image, size):
+    """Scale and centre-crop an image to exactly fill a tile, in one resize"""
+    tile_width, tile_height = size
+    scale = max(tile_width / image.width, tile_height / image.height)
+    crop_width, crop_height = tile_width / scale, tile_height / scale
+    left = (image.width - crop_width) / 2
+    top = (image.height - crop_height) / 2
+    return image.resize(size, Image.Resampling.LANCZOS, box=(left, top, left + crop_width, top + crop_height))
+
+def render_collage(images, orientation, resolution):
+    """Lay images out as a collage for an orientation, ready to quantize like a single photo"""
+    width, height = display_size_for(orientation, resolution)
+    canvas = numpy.full((height, width, 3), 255, dtype=numpy.uint8)
+    for image, (x, y, tile_width, tile_height) in zip(images, collage_layout(len(images), (width, height))):
+        tile = fill_tile(flatten_to_rgb(image), (tile_width, tile_height))
+        canvas[y:y + tile_height, x:x + tile_width] = numpy.asarray(tile)
+    # Already the right size, so this only rotates it onto the panel
+    return prepare_for_display(Image.fromarray(canvas), orientation, resolution)
+
+def pack_frame(buf):
+    """Pack a palette index buffer into two pixels per byte"""
+    flat = buf.flatten()
+    return (((flat[::2] << 4) & 0xF0) | (flat[1::2] & 0x0F)).astype(numpy.uint8).tobytes()
+
+def unpack_frame(data, width, height):
+    """Unpack a packed frame into the palette index buffer the display shows, without going through PIL"""
+    packed = numpy.frombuffer(data, dtype=numpy.uint8)
+    buf = numpy.empty(packed.size * 2, dtype=numpy.uint8)
+    buf[0::2] = packed >> 4
+    buf[1::2] = packed & 0x0F
+    return buf.reshape((height, width))
@@ -0,0 +1,105 @@
+"""Import a ZIP or tar archive of photos into a running photo frame.
+
+The archive is streamed to the frame's /import endpoint, which reads the
+photos out of it one at a time. Run on the frame itself, the frame is given
+the archive's path instead and reads it in place, which works for archives
+of any size; sent archives are limited to the frame's upload size. Importing the same archive again resumes
+where the last import stopped, skipping photos already stored.
+
+    python import_photos.py album.zip
+    python import_photos.py album.tar.gz --url http://inky-frame.local:5000 --report album.json
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import urllib.error
+import urllib.parse
+import urllib.request
+
+def archive_import_id(path):
+    """Get an import id that stays the same for the same archive, so a rerun resumes it"""
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+def is_local(url):
+    """Check whether the frame runs on this machine, so it can read the archive from disk"""
+    return urllib.parse.urlsplit(url).hostname in ('localhost', '127.0.0.1', '::1')
+
+def import_local_archive(url, path, import_id):
+    """Have the frame import an archive on its own disk and return its response"""
+    query = urllib.parse.urlencode({'import_id': import_id, 'path': os.path.abspath(path)})
+    request = urllib.request.Request(f"{url.rstrip('/')}/import?{query}", method='POST',
+                                     headers={'Accept': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+def send_archive(url, path, import_id):
+    """Stream the archive to the frame and return its response"""
+    query = urllib.parse.urlencode({'import_id': import_id, 'name': os.path.basename(path)})
+    with open(path, 'rb') as f:
+        request = urllib.request.Request(f"{url.rstrip('/')}/import?{query}", data=f, method='POST', headers={
+            'Content-Type': 'application/octet-stream',
+            'Content-Length': str(os.path.getsize(path)),
+            'Accept': 'application/json'
+        })
+        with urllib.request.urlopen(request) as response:
+            return json.load(response)
+
+def wait_for_import(url, status_url, interval=2):
+    """Poll the import's progress until every photo has been processed, returning the report"""
+    while True:
+        with urllib.request.urlopen(f"{url.rstrip('/')}{status_url}") as response:
+            status = json.load(response)
+        processed = status['done'] + status['failed'] + status['duplicate']
+        print(f"\rProcessed {processed} of {status['total']}: {status['done']} stored, "
+              f"{status['duplicate']} duplicates, {status['failed']} failed", end='', file=sys.stderr)
+        if status['finished_at']:
+            print(file=sys.stderr)
+            return status
+        time.sleep(interval)
+
+def main():
+    parser = argparse.ArgumentParser(description="Import a ZIP or tar archive of photos into an Inky Photo Frame")
+    parser.add_argument('archive', help="ZIP or tar archive (.tar, .tar.gz, .tar.bz2 or .tar.xz)")
+    parser.add_argument('--url', default='http://localhost:5000', help="photo frame address (default: %(default)s)")
+    parser.add_argument('--send', action='store_true',
+                        help="send the archive over HTTP even when the frame runs on this machine")
+    parser.add_argument('--restart', action='store_true', help="start a new import instead of resuming")
+    parser.add_argument('--report', help="save the per-file results as JSON")
+    args = parser.parse_args()
+
+    import_id = archive_import_id(args.archive)
+    if args.restart:
+        import_id = f"{import_id}-{int(time.time())}"
+
+    try:
+        if is_local(args.url) and not args.send:
+            result = import_local_archive(args.url, args.archive, import_id)
+        else:
+            result = send_archive(args.url, args.archive, import_id)
+    except urllib.error.HTTPError as e:
+        print(f"Import failed: {e.code} {e.read().decode(errors='replace')}", file=sys.stderr)
+        return 1
+    print(f"Import {result['import_id']} sent, processing photos", file=sys.stderr)
+    report = wait_for_import(args.url, result['status_url'])
+
+    for item in report['items']:
+        if item['state'] == 'failed':
+            print(f"Failed: {item['name']}: {item['error']}")
+        elif item['similar_to']:
+            print(f"Similar: {item['name']} looks like {item['similar_to']}")
+    if report.get('error'):
+        print(f"Archive error: {report['error']}")
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report saved to {args.report}", file=sys.stderr)
+    return 1 if report['failed'] or report.get('error') else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
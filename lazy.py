@@ -0,0 +1,23 @@
+import importlib
+import threading
+
+class LazyModule:
+    """Stand-in for a module that imports it the first time one of its attributes is used"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+                module = self._module
+        return getattr(module, attr)
+
+def lazy_import(name):
+    """Get a module that is only imported when first used, keeping slow imports out of startup"""
+    return LazyModule(name)
@@ -0,0 +1,140 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from a cached frame load up to a slow e-ink refresh
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_registry = []
+_lock = threading.Lock()
+
+def _format_labels(labelnames, values, extra=()):
+    """Format label names and values in the Prometheus text format"""
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    """Format a sample value, using the Prometheus spelling of infinity"""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """A value that only goes up, such as a count of refreshes"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        register(self)
+
+    def inc(self, amount=1, **labels):
+        """Add to the counter for a set of labels"""
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        """Get (suffix, label text, value) for each series"""
+        with _lock:
+            values = dict(self._values)
+        return [('_total', _format_labels(self.labelnames, key), value) for key, value in sorted(values.items())]
+
+class Gauge:
+    """A value that goes up and down, set directly or read from a function at scrape time"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._values = {}
+        register(self)
+
+    def set(self, value, **labels):
+        """Set the gauge for a set of labels"""
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with _lock:
+            self._values[key] = value
+
+    def samples(self):
+        """Get (suffix, label text, value) for each series"""
+        if self.function is not None:
+            return [('', '', self.function())]
+        with _lock:
+            values = dict(self._values)
+        return [('', _format_labels(self.labelnames, key), value) for key, value in sorted(values.items())]
+
+class Histogram:
+    """Counts of observed durations in cumulative buckets, plus their sum"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}
+        register(self)
+
+    def observe(self, value, **labels):
+        """Record one observation for a set of labels"""
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with _lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the enclosed block takes"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        """Get (suffix, label text, value) for each series"""
+        with _lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        samples = []
+        for key, (counts, total) in sorted(values.items()):
+            for bound, count in zip(self.buckets, counts):
+                samples.append(('_bucket', _format_labels(self.labelnames, key, [('le', _format_value(bound))]), count))
+            samples.append(('_sum', _format_labels(self.labelnames, key), total))
+            samples.append(('_count', _format_labels(self.labelnames, key), counts[-1]))
+        return samples
+
+def register(metric):
+    """Add a metric to those rendered by render()"""
+    with _lock:
+        _registry.append(metric)
+
+def render():
+    """Render every registered metric in the Prometheus text exposition format"""
+    with _lock:
+        registered = list(_registry)
+    lines = []
+    for metric in registered:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        try:
+            samples = metric.samples()
+        except Exception:
+            # A failing gauge function shouldn't break the whole scrape
+            continue
+        for suffix, labels, value in samples:
+            lines.append(f"{metric.name}{suffix}{labels} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
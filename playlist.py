@@ -0,0 +1,135 @@
+import os
+import json
+import random
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger('inky_frame')
+
+class ShuffleBag:
+    """Shows every photo once in a weighted random order before any repeats, saved to a file to survive restarts.
+
+    Photos still to be shown this round are kept sorted by a random key
+    drawn as random() ** (1 / weight), so heavier photos tend to come first
+    and photos can be added or removed without reshuffling the rest.
+    """
+
+    def __init__(self, path, weight=None):
+        self.path = path
+        self.weight = weight or (lambda photo: 1.0)
+        self.upcoming = []  # [key, photo] pairs in ascending key order, next photo last
+        self.shown = []     # Photos shown so far this round, oldest first
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        """Load the bag from its file, starting empty if there isn't a usable one"""
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            self.upcoming = sorted([float(key), str(photo)] for key, photo in state.get('upcoming', []))
+            self.shown = [str(photo) for photo in state.get('shown', [])]
+            logger.info(f"Loaded playlist: {len(self.upcoming)} photos to come, {len(self.shown)} shown this round")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Could not load playlist ({e}), starting a new one")
+            self.upcoming = []
+            self.shown = []
+
+    def save(self):
+        """Save the bag so its order survives a restart"""
+        # Saved under the lock, so the file never holds an older state than one saved before it
+        with self._lock:
+            temp_path = f"{self.path}.{threading.get_ident()}.tmp"
+            try:
+                with open(temp_path, 'w') as f:
+                    json.dump({'upcoming': self.upcoming, 'shown': self.shown}, f)
+                os.replace(temp_path, self.path)
+            except Exception as e:
+                logger.error(f"Error saving playlist: {e}")
+
+    def _insert(self, photo):
+        """Put a photo among those to come at a random, weighted position"""
+        weight = max(float(self.weight(photo)), 1e-6)
+        bisect.insort(self.upcoming, [random.random() ** (1.0 / weight), photo])
+
+    def _discard(self, photo):
+        """Take a photo out of the bag, returning whether it was in it"""
+        count = len(self.upcoming) + len(self.shown)
+        self.upcoming = [entry for entry in self.upcoming if entry[1] != photo]
+        self.shown = [shown for shown in self.shown if shown != photo]
+        return len(self.upcoming) + len(self.shown) != count
+
+    def _refill(self):
+        """Start a new round with every photo shown in the last one"""
+        last = self.shown[-1] if self.shown else None
+        photos, self.shown = self.shown, []
+        for photo in photos:
+            self._insert(photo)
+        # Don't show the same photo twice in a row across rounds
+        if len(self.upcoming) > 1 and self.upcoming[-1][1] == last:
+            self.upcoming[-1][1], self.upcoming[-2][1] = self.upcoming[-2][1], last
+        logger.info(f"Playlist round started with {len(self.upcoming)} photos")
+
+    def sync(self, photos):
+        """Bring the bag in line with the library, keeping the order of photos already in it"""
+        photos = set(photos)
+        with self._lock:
+            known = {photo for _, photo in self.upcoming} | set(self.shown)
+            removed = known - photos
+            self.upcoming = [entry for entry in self.upcoming if entry[1] in photos]
+            self.shown = [photo for photo in self.shown if photo in photos]
+            added = photos - known
+            for photo in sorted(added):
+                self._insert(photo)
+        if added or removed:
+            logger.info(f"Playlist synced: {len(added)} added, {len(removed)} removed")
+            self.save()
+
+    def add(self, photo):
+        """Add a new photo to those still to come this round"""
+        with self._lock:
+            if any(entry[1] == photo for entry in self.upcoming) or photo in self.shown:
+                return
+            self._insert(photo)
+        self.save()
+
+    def remove(self, photo):
+        """Remove a deleted photo from the bag"""
+        with self._lock:
+            removed = self._discard(photo)
+        if removed:
+            self.save()
+
+    def reweight(self, photo):
+        """Draw a new position for a photo still to come after its weight changes"""
+        with self._lock:
+            if not any(entry[1] == photo for entry in self.upcoming):
+                return
+            self.upcoming = [entry for entry in self.upcoming if entry[1] != photo]
+            self._insert(photo)
+        self.save()
+
+    def peek(self):
+        """Get the photo that will be shown next without moving on, or None if the bag is empty"""
+        with self._lock:
+            if not self.upcoming and self.shown:
+                self._refill()
+            return self.upcoming[-1][1] if self.upcoming else None
+
+    def advance(self):
+        """Move on to the next photo and return it, or None if the bag is empty"""
+        with self._lock:
+            photo = self.peek()
+            if photo is not None:
+                self.upcoming.pop()
+                self.shown.append(photo)
+        self.save()
+        return photo
+
+    def status(self):
+        """Describe the current round"""
+        with self._lock:
+            return {'next': self.peek(), 'upcoming': len(self.upcoming), 'shown': len(self.shown)}
@@ -0,0 +1,117 @@
+"""Profile a running photo frame through its /profile endpoints.
+
+The frame must be started with INKY_FRAME_PROFILE_TOKEN set; pass the same
+token with --token or the environment variable.
+
+    python profile_frame.py update --save profiles
+    python profile_frame.py upload photo.jpg --url http://inky-frame.local:5000
+    python profile_frame.py sample 10 --interval 50 --save profiles
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import urllib.error
+import urllib.parse
+import urllib.request
+
+def call(args, method, path, query=None, data=None):
+    """Make an authenticated request to the frame and return its JSON response"""
+    url = f"{args.url.rstrip('/')}{path}"
+    if query:
+        url = f"{url}?{urllib.parse.urlencode(query)}"
+    headers = {'Authorization': f"Bearer {args.token}", 'Accept': 'application/json'}
+    if data is not None:
+        headers['Content-Type'] = 'application/octet-stream'
+    request = urllib.request.Request(url, data=data, method=method, headers=headers)
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+def download(args, name):
+    """Save a profile file from the frame into the --save folder"""
+    os.makedirs(args.save, exist_ok=True)
+    path = os.path.join(args.save, name)
+    request = urllib.request.Request(f"{args.url.rstrip('/')}/profile/files/{urllib.parse.quote(name)}",
+                                     headers={'Authorization': f"Bearer {args.token}"})
+    with urllib.request.urlopen(request) as response, open(path, 'wb') as f:
+        f.write(response.read())
+    print(f"Saved {path}", file=sys.stderr)
+
+def print_profile(report):
+    """Print the top functions by cumulative time and the top allocation sites"""
+    print(f"Took {report['seconds']:.3f}s, traced peak {report['traced_peak_kb']:.0f}KB")
+    print(f"\n{'cumulative':>10} {'own':>10} {'calls':>8}  function")
+    for function in report['functions']:
+        print(f"{function['cumulative_seconds']:>10.4f} {function['total_seconds']:>10.4f} "
+              f"{function['calls']:>8}  {function['function']}")
+    print(f"\n{'KB':>10} {'blocks':>8}  allocation site")
+    for allocation in report['allocations']:
+        print(f"{allocation['size_kb']:>10.1f} {allocation['count']:>8}  {allocation['site']}")
+
+def print_samples(report):
+    """Print the functions seen most often by the stack sampler"""
+    print(f"{report['samples']} samples over {report['seconds']:.0f}s, by thread: "
+          + ', '.join(f"{name} {count}" for name, count in report['threads'].items()))
+    for title, key in (('in the function itself', 'own'), ('in or below the function', 'cumulative')):
+        print(f"\n{'samples':>8} {'%':>6}  function ({title})")
+        for function in report[key]:
+            print(f"{function['samples']:>8} {function['percent']:>6.1f}  {function['function']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile the render and upload paths of an Inky Photo Frame")
+    parser.add_argument('--url', default='http://localhost:5000', help="photo frame address (default: %(default)s)")
+    parser.add_argument('--token', default=os.environ.get('INKY_FRAME_PROFILE_TOKEN'),
+                        help="profiling token (default: $INKY_FRAME_PROFILE_TOKEN)")
+    parser.add_argument('--top', type=int, default=25, help="functions and allocation sites to show")
+    parser.add_argument('--save', help="folder to download the .prof or .folded file into")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('update', help="profile one display refresh")
+    upload = commands.add_parser('upload', help="profile processing one photo, which is then stored")
+    upload.add_argument('photo', help="JPEG or PNG photo")
+    sample = commands.add_parser('sample', help="sample every thread's stack for a while")
+    sample.add_argument('minutes', type=float, help="how long to sample for")
+    sample.add_argument('--interval', type=int, default=20, help="milliseconds between samples (default: %(default)s)")
+    args = parser.parse_args()
+    if not args.token:
+        parser.error("a profiling token is needed, from --token or INKY_FRAME_PROFILE_TOKEN")
+
+    query = {'top': args.top, 'save': '1' if args.save else '0'}
+    try:
+        if args.command == 'update':
+            report = call(args, 'POST', '/profile/update', query)
+        elif args.command == 'upload':
+            with open(args.photo, 'rb') as f:
+                report = call(args, 'POST', '/profile/upload', dict(query, name=os.path.basename(args.photo)), f.read())
+            print(f"Stored as {report['filename']}", file=sys.stderr)
+        else:
+            call(args, 'POST', '/profile/sample', {'minutes': args.minutes, 'interval_ms': args.interval})
+            print(f"Sampling for {args.minutes:g} minutes", file=sys.stderr)
+            try:
+                while True:
+                    time.sleep(min(10, args.minutes * 60 / 4))
+                    report = call(args, 'GET', '/profile/sample', {'top': args.top})
+                    if not report['running']:
+                        break
+                    print(f"\r{report['samples']} samples", end='', file=sys.stderr)
+            except KeyboardInterrupt:
+                call(args, 'POST', '/profile/sample/stop')
+                time.sleep(1)
+                report = call(args, 'GET', '/profile/sample', {'top': args.top})
+            print(file=sys.stderr)
+    except urllib.error.HTTPError as e:
+        print(f"Profiling failed: {e.code} {e.read().decode(errors='replace')}", file=sys.stderr)
+        return 1
+
+    if args.command == 'sample':
+        print_samples(report)
+        saved = report['folded_file']
+    else:
+        print_profile(report)
+        saved = report['prof_file']
+    if args.save and saved:
+        download(args, saved)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+"""Profile the render and upload paths on a running frame.
+
+profile_call runs one call with cProfile and tracemalloc switched on and
+reports where its time went and what it allocated. Sampler is a lighter
+statistical profiler that can be left running in production: it looks at
+every thread's Python stack at an interval and counts what it finds.
+"""
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+# Stacks are cut off below this depth when sampling
+MAX_SAMPLE_DEPTH = 64
+# Threads whose innermost Python frame is in one of these are waiting, not working
+IDLE_MODULES = ('threading.py', 'selectors.py', 'queue.py', 'socketserver.py', 'thread.py')
+
+def _function_name(filename, line, name):
+    """Format a function as module:line(name), the way pstats does, or just its name if built in"""
+    if filename == '~':
+        return name
+    return f"{os.path.basename(filename)}:{line}({name})"
+
+def profile_call(func, *args, top=25, prof_path=None, **kwargs):
+    """Run a call under cProfile and tracemalloc, returning its result and a report.
+
+    cProfile only follows the calling thread, while tracemalloc sees the
+    allocations of every thread made while the call runs. Pillow's image
+    buffers are allocated outside Python and are not traced. The raw profile
+    is saved to prof_path for pstats or snakeviz when given.
+    """
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        elapsed = time.perf_counter() - start
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        if started_tracing:
+            tracemalloc.stop()
+
+    stats = pstats.Stats(profiler).sort_stats('cumulative')
+    functions = []
+    for function in stats.fcn_list[:top]:
+        primitive_calls, calls, total, cumulative, _ = stats.stats[function]
+        functions.append({'function': _function_name(*function), 'calls': calls,
+                          'total_seconds': round(total, 6), 'cumulative_seconds': round(cumulative, 6)})
+
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                       tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')])
+    allocations = [{'site': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                    'size_kb': round(stat.size / 1024, 1), 'count': stat.count}
+                   for stat in snapshot.statistics('lineno')[:top]]
+
+    if prof_path:
+        profiler.dump_stats(prof_path)
+    report = {'seconds': round(elapsed, 6), 'functions': functions, 'allocations': allocations,
+              'traced_peak_kb': round(peak / 1024, 1), 'prof_file': os.path.basename(prof_path) if prof_path else None}
+    return result, report
+
+class Sampler:
+    """Statistical profiler that samples the Python stack of every thread at an interval.
+
+    Only one sampling run goes at a time. Counts are kept per function, both
+    for time spent in the function itself and anywhere below it, and as
+    folded stacks that flame graph tools can read.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._reset(0, 0, None)
+
+    def _reset(self, seconds, interval, folded_path):
+        self.folded_path = folded_path
+        self.started_at = None
+        self.finished_at = None
+        self.seconds = seconds
+        self.interval = interval
+        self.samples = 0
+        self.own = Counter()
+        self.cumulative = Counter()
+        self.threads = Counter()
+        self.folded = Counter()
+
+    def running(self):
+        """Check whether a sampling run is going"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, interval=0.02, folded_path=None):
+        """Start sampling for a number of seconds, returning False if a run is already going.
+
+        The folded stacks are saved to folded_path when the run ends, if given.
+        """
+        with self._lock:
+            if self.running():
+                return False
+            self._reset(seconds, interval, folded_path)
+            self.started_at = datetime.now().isoformat()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(seconds, interval, folded_path),
+                                            name='profile-sampler', daemon=True)
+            self._thread.start()
+        return True
+
+    def stop(self):
+        """End the current sampling run early"""
+        self._stop.set()
+
+    def _run(self, seconds, interval, folded_path):
+        """Take samples until the run is over or stopped"""
+        own_thread = threading.get_ident()
+        end = time.monotonic() + seconds
+        while not self._stop.wait(interval) and time.monotonic() < end:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_thread or os.path.basename(frame.f_code.co_filename) in IDLE_MODULES:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_SAMPLE_DEPTH:
+                    code = frame.f_code
+                    stack.append(_function_name(code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                name = names.get(ident, str(ident))
+                with self._lock:
+                    self.samples += 1
+                    self.threads[name] += 1
+                    self.own[stack[0]] += 1
+                    self.cumulative.update(set(stack))
+                    self.folded[';'.join([name] + stack[::-1])] += 1
+        with self._lock:
+            self.finished_at = datetime.now().isoformat()
+        if folded_path:
+            self.write_folded(folded_path)
+
+    def write_folded(self, path):
+        """Save the samples as folded stacks, one 'thread;outer;...;inner count' line each"""
+        with self._lock:
+            lines = [f"{stack} {count}\n" for stack, count in self.folded.most_common()]
+        with open(path, 'w') as f:
+            f.writelines(lines)
+
+    def report(self, top=25):
+        """Describe the current or last sampling run, with the functions seen most often"""
+        with self._lock:
+            samples = self.samples
+            share = lambda count: round(count / samples * 100, 1) if samples else 0.0
+            return {
+                'running': self.running(),
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+                'seconds': self.seconds,
+                'interval': self.interval,
+                'samples': samples,
+                'folded_file': os.path.basename(self.folded_path) if self.folded_path else None,
+                'threads': dict(self.threads.most_common()),
+                'own': [{'function': function, 'samples': count, 'percent': share(count)}
+                        for function, count in self.own.most_common(top)],
+                'cumulative': [{'function': function, 'samples': count, 'percent': share(count)}
+                               for function, count in self.cumulative.most_common(top)]
+            }
@@ -0,0 +1,168 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from lazy import lazy_import
+
+numpy = lazy_import('numpy')
+Image = lazy_import('PIL.Image')
+
+logger = logging.getLogger('inky_frame')
+
+# The 7 colours of the Inky Impression panel, as measured (saturated) and as
+# ideal primaries (desaturated). The saturation setting blends between them.
+SATURATED_PALETTE = [
+    (57, 48, 57),     # Black
+    (255, 255, 255),  # White
+    (58, 91, 70),     # Green
+    (61, 59, 94),     # Blue
+    (156, 72, 75),    # Red
+    (208, 190, 71),   # Yellow
+    (177, 106, 73)    # Orange
+]
+DESATURATED_PALETTE = [
+    (0, 0, 0),
+    (255, 255, 255),
+    (0, 255, 0),
+    (0, 0, 255),
+    (255, 0, 0),
+    (255, 255, 0),
+    (255, 140, 0)
+]
+
+DITHER_DIFFUSION = 'diffusion'  # Floyd-Steinberg error diffusion
+DITHER_ORDERED = 'ordered'      # 8x8 Bayer matrix
+DITHER_NEAREST = 'nearest'      # No dithering
+DITHER_MODES = [DITHER_DIFFUSION, DITHER_ORDERED, DITHER_NEAREST]
+
+# The lookup table maps each colour to its nearest palette index, using the
+# top LUT_BITS of each channel. Palettes come from clients of a render server
+# too, so only the tables used most recently are kept, LUT_MEMORY_LIMIT of them
+# in memory and LUT_FILES_LIMIT on disk.
+LUT_BITS = 6
+LUT_CACHE_FOLDER = os.path.abspath(os.path.join('cache', 'luts'))
+LUT_MEMORY_LIMIT = 4
+LUT_FILES_LIMIT = 16
+
+# How far the Bayer threshold moves each channel, roughly the gap between palette colours
+ORDERED_SPREAD = 96
+
+BAYER_8X8 = [
+    [0, 32, 8, 40, 2, 34, 10, 42],
+    [48, 16, 56, 24, 50, 18, 58, 26],
+    [12, 44, 4, 36, 14, 46, 6, 38],
+    [60, 28, 52, 20, 62, 30, 54, 22],
+    [3, 35, 11, 43, 1, 33, 9, 41],
+    [51, 19, 59, 27, 49, 17, 57, 25],
+    [15, 47, 7, 39, 13, 45, 5, 37],
+    [63, 31, 55, 23, 61, 29, 53, 21]
+]
+
+_lut_cache = OrderedDict()
+_lut_lock = threading.Lock()
+
+def blend_palette(saturation=0.5, palette=None):
+    """Get the 7 panel colours for a saturation, or the calibrated palette if one is given"""
+    if palette:
+        return [tuple(int(c) for c in colour) for colour in palette]
+    saturation = min(max(float(saturation), 0.0), 1.0)
+    return [tuple(int(s * saturation + d * (1.0 - saturation)) for s, d in zip(saturated, desaturated))
+            for saturated, desaturated in zip(SATURATED_PALETTE, DESATURATED_PALETTE)]
+
+def palette_signature(mode, colours):
+    """Get a short signature identifying a dither mode and palette, for cache keys"""
+    key = f"{mode}:{LUT_BITS}:" + ','.join(f"{r}-{g}-{b}" for r, g, b in colours)
+    return hashlib.sha1(key.encode()).hexdigest()[:10]
+
+def build_palette_lut(colours):
+    """Build the table mapping every reduced RGB colour to its nearest palette index"""
+    levels = 1 << LUT_BITS
+    step = 256 // levels
+    # Use the middle of each bucket as its colour
+    values = numpy.arange(levels, dtype=numpy.float32) * step + step / 2
+    grid = numpy.stack(numpy.meshgrid(values, values, values, indexing='ij'), axis=-1).reshape(-1, 1, 3)
+    palette = numpy.array(colours, dtype=numpy.float32).reshape(1, -1, 3)
+    distances = ((grid - palette) ** 2).sum(axis=2)
+    return distances.argmin(axis=1).astype(numpy.uint8)
+
+def get_palette_lut(colours):
+    """Get the lookup table for a palette from memory, disk, or by building it"""
+    key = palette_signature('lut', colours)
+    with _lut_lock:
+        if key in _lut_cache:
+            _lut_cache.move_to_end(key)
+            return _lut_cache[key]
+
+        lut_path = os.path.join(LUT_CACHE_FOLDER, f"{key}.npy")
+        try:
+            lut = numpy.load(lut_path)
+            if lut.shape != (1 << (LUT_BITS * 3),):
+                raise ValueError(f"unexpected shape {lut.shape}")
+            os.utime(lut_path)  # Mark it as recently used
+        except FileNotFoundError:
+            lut = None
+        except Exception as e:
+            logger.warning(f"Could not load palette lookup table {lut_path}: {e}")
+            lut = None
+
+        if lut is None:
+            lut = build_palette_lut(colours)
+            try:
+                os.makedirs(LUT_CACHE_FOLDER, exist_ok=True)
+                temp_path = f"{lut_path}.tmp.npy"
+                numpy.save(temp_path, lut)
+                os.replace(temp_path, lut_path)
+                logger.info(f"Built palette lookup table: {lut_path}")
+                _prune_lut_files()
+            except Exception as e:
+                logger.warning(f"Could not save palette lookup table {lut_path}: {e}")
+
+        _lut_cache[key] = lut
+        while len(_lut_cache) > LUT_MEMORY_LIMIT:
+            _lut_cache.popitem(last=False)
+        return lut
+
+def _prune_lut_files():
+    """Remove the least recently used lookup tables beyond LUT_FILES_LIMIT"""
+    tables = [entry for entry in os.scandir(LUT_CACHE_FOLDER) if entry.name.endswith('.npy')]
+    tables.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in tables[LUT_FILES_LIMIT:]:
+        os.remove(entry.path)
+        logger.info(f"Removed palette lookup table: {entry.path}")
+
+def map_to_palette(rgb, lut):
+    """Map an RGB array to palette indices with a single lookup per pixel"""
+    shift = 8 - LUT_BITS
+    channels = (rgb >> shift).astype(numpy.uint32)
+    index = (channels[..., 0] << (LUT_BITS * 2)) | (channels[..., 1] << LUT_BITS) | channels[..., 2]
+    return lut[index]
+
+def quantize_image(image, mode=DITHER_DIFFUSION, saturation=0.5, palette=None):
+    """Quantize an image to the panel palette, returning a palette-index ("P") image.
+
+    The display copies "P" images straight into its buffer, so the result is
+    shown without being quantized again.
+    """
+    colours = blend_palette(saturation, palette)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    if mode == DITHER_DIFFUSION:
+        # Error diffusion is sequential per pixel, so use Pillow's C implementation
+        palette_image = Image.new('P', (1, 1))
+        # Pad with the first colour so ties never pick an index past the panel's 7
+        palette_image.putpalette([c for colour in colours + [colours[0]] * (256 - len(colours)) for c in colour])
+        result = image.quantize(palette=palette_image, dither=Image.Dither.FLOYDSTEINBERG)
+    else:
+        rgb = numpy.asarray(image, dtype=numpy.uint8)
+        if mode == DITHER_ORDERED:
+            height, width = rgb.shape[:2]
+            threshold = (numpy.array(BAYER_8X8, dtype=numpy.float32) + 0.5) / 64.0 - 0.5
+            threshold = numpy.tile(threshold, (height // 8 + 1, width // 8 + 1))[:height, :width, None]
+            rgb = numpy.clip(rgb + threshold * ORDERED_SPREAD, 0, 255).astype(numpy.uint8)
+        indices = map_to_palette(rgb, get_palette_lut(colours))
+        result = Image.frombytes('P', image.size, indices.tobytes())
+
+    result.putpalette([c for colour in colours for c in colour])
+    return result
@@ -0,0 +1,34 @@
+import os
+import sys
+import time
+import pytest
+
+@pytest.fixture(scope='session')
+def frame_app(tmp_path_factory):
+    """The app started in an empty folder, with the stand-in display and no buttons"""
+    os.environ['INKY_FRAME_DISPLAY'] = 'memory'
+    os.environ['INKY_FRAME_BUTTONS'] = 'null'
+    os.chdir(tmp_path_factory.mktemp('frame'))
+    sys.modules.pop('app', None)  # Folders are set from the working directory on import
+    import app
+    app.create_app()
+    app.update_settings(min_refresh_minutes=0)  # Don't hold the refreshes uploads start
+    deadline = time.monotonic() + 30
+    while app.scheduler is None and time.monotonic() < deadline:
+        time.sleep(0.1)  # Let the background startup finish
+    yield app
+    # Let refreshes and the next frame's render finish before the folder is removed
+    while app.get_refresh_status()['state'] in ('pending', 'running') and time.monotonic() < deadline + 30:
+        time.sleep(0.1)
+    with app.prepare_running, app.render_target_build_lock:
+        pass
+
+def wait_for_batch(client, status_url, timeout=30):
+    """Poll an upload batch or import until it finishes, returning its status"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = client.get(status_url).get_json()
+        if status['finished_at']:
+            return status
+        time.sleep(0.1)
+    raise AssertionError(f"{status_url} did not finish")
@@ -0,0 +1,62 @@
+import io
+import tarfile
+import zipfile
+import pytest
+import archives
+
+def zip_stream(members):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        for name, data in members:
+            zf.writestr(name, data)
+    buf.seek(0)
+    return buf
+
+def unseekable_zip_stream(members):
+    """A ZIP arriving as a request body, which has to be spooled before it can be read"""
+    data = zip_stream(members)
+    class Unseekable(io.RawIOBase):
+        def readable(self):
+            return True
+        def readinto(self, buffer):
+            chunk = data.read(len(buffer))
+            buffer[:len(chunk)] = chunk
+            return len(chunk)
+    return Unseekable()
+
+def tar_stream(members):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tf:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+    buf.seek(0)
+    return buf
+
+MEMBERS = [('2019/IMG_0001.jpg', b'one'), ('2020/IMG_0001.jpg', b'two'), ('notes.txt', b'skip'),
+           ('__MACOSX/2019/._IMG_0001.jpg', b'fork'), ('.hidden.png', b'skip')]
+
+@pytest.mark.parametrize('make_stream', [zip_stream, unseekable_zip_stream, tar_stream])
+def test_members_with_the_same_name_are_all_yielded(make_stream, tmp_path):
+    spool = tmp_path / 'spool'
+    spool.mkdir()
+    members = []
+    for index, (name, size, save) in enumerate(
+            archives.iter_photo_members(make_stream(MEMBERS), str(tmp_path / 'spool.zip'), 1024)):
+        save(str(spool / str(index)))
+        members.append((name, (spool / str(index)).read_bytes()))
+    assert members == [('2019/IMG_0001.jpg', b'one'), ('2020/IMG_0001.jpg', b'two')]
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['spool']
+
+def test_oversized_members_are_refused(tmp_path):
+    members = archives.iter_photo_members(zip_stream([('big.jpg', b'x' * 100)]), str(tmp_path / 'spool.zip'), 10)
+    name, size, save = next(members)
+    with pytest.raises(ValueError):
+        save(str(tmp_path / 'big.jpg'))
+    assert not (tmp_path / 'big.jpg').exists()
+
+def test_members_bigger_than_their_header_are_refused(tmp_path):
+    with pytest.raises(ValueError):
+        archives.save_member(io.BytesIO(b'x' * 100), 5, 10, str(tmp_path / 'lying.jpg'))
+    assert not (tmp_path / 'lying.jpg').exists()
@@ -0,0 +1,27 @@
+import pytest
+from imaging import collage_layout, COLLAGE_GUTTER
+
+def overlaps(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+@pytest.mark.parametrize('size', [(600, 448), (448, 600), (601, 447)])
+@pytest.mark.parametrize('count', [2, 3, 4])
+def test_collage_tiles_fit_without_overlapping(count, size):
+    tiles = collage_layout(count, size)
+    assert len(tiles) == count
+    for x, y, width, height in tiles:
+        assert x >= 0 and y >= 0 and width > 0 and height > 0
+        assert x + width <= size[0] and y + height <= size[1]
+    assert not any(overlaps(a, b) for i, a in enumerate(tiles) for b in tiles[i + 1:])
+    # Tiles and gutters cover the whole canvas along the first split
+    assert max(x + width for x, _, width, _ in tiles) == size[0]
+    assert max(y + height for _, y, _, height in tiles) == size[1]
+
+def test_two_photos_split_along_the_long_side():
+    assert collage_layout(2, (600, 448)) == [(0, 0, 298, 448), (298 + COLLAGE_GUTTER, 0, 298, 448)]
+    assert all(width == 448 for _, _, width, _ in collage_layout(2, (448, 600)))
+
+@pytest.mark.parametrize('count', [0, 1, 5])
+def test_collage_needs_two_to_four_photos(count):
+    with pytest.raises(ValueError):
+        collage_layout(count, (600, 448))
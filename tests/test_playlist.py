@@ -0,0 +1,49 @@
+import json
+import logging
+import threading
+import playlist
+
+def test_add_from_many_threads_keeps_every_photo(tmp_path, caplog):
+    path = tmp_path / 'playlist.json'
+    bag = playlist.ShuffleBag(str(path))
+    stop = threading.Event()
+    read_errors = []
+
+    def read():
+        while not stop.is_set():
+            try:
+                with open(path) as f:
+                    json.load(f)
+            except FileNotFoundError:
+                pass
+            except ValueError as e:
+                read_errors.append(e)
+
+    def add(worker):
+        for i in range(100):
+            bag.add(f"{worker}_{i}.jpg")
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    workers = [threading.Thread(target=add, args=(worker,)) for worker in range(4)]
+    with caplog.at_level(logging.ERROR, logger='inky_frame'):
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    stop.set()
+    reader.join()
+
+    assert not read_errors
+    assert not [record for record in caplog.records if record.levelno >= logging.ERROR]
+    assert list(tmp_path.glob('*.tmp')) == []
+    saved = playlist.ShuffleBag(str(path))
+    assert len(saved.upcoming) == 400
+    assert {photo for _, photo in saved.upcoming} == {f"{w}_{i}.jpg" for w in range(4) for i in range(100)}
+
+def test_advance_shows_every_photo_before_repeating(tmp_path):
+    bag = playlist.ShuffleBag(str(tmp_path / 'playlist.json'))
+    bag.sync([f"{i}.jpg" for i in range(5)])
+    first_round = [bag.advance() for _ in range(5)]
+    assert sorted(first_round) == [f"{i}.jpg" for i in range(5)]
+    assert bag.advance() != first_round[-1]
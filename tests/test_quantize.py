@@ -0,0 +1,42 @@
+from collections import OrderedDict
+import numpy
+import pytest
+from PIL import Image
+import quantize
+
+@pytest.fixture(autouse=True)
+def lut_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(quantize, 'LUT_CACHE_FOLDER', str(tmp_path))
+    monkeypatch.setattr(quantize, '_lut_cache', OrderedDict())
+
+@pytest.mark.parametrize('mode', quantize.DITHER_MODES)
+@pytest.mark.parametrize('saturation', [0.0, 0.5, 1.0])
+def test_indices_stay_within_the_panel_palette(mode, saturation):
+    rng = numpy.random.default_rng(1)
+    image = Image.fromarray(rng.integers(0, 256, (48, 64, 3), dtype=numpy.uint8))
+    result = quantize.quantize_image(image, mode, saturation)
+    assert result.mode == 'P' and result.size == (64, 48)
+    indices = numpy.asarray(result)
+    assert indices.min() >= 0 and indices.max() < len(quantize.SATURATED_PALETTE)
+
+def test_palette_colours_map_to_themselves():
+    colours = quantize.blend_palette(1.0)
+    image = Image.new('RGB', (len(colours), 1))
+    image.putdata([tuple(colour) for colour in colours])
+    result = quantize.quantize_image(image, quantize.DITHER_NEAREST, 1.0)
+    assert list(numpy.asarray(result)[0]) == list(range(len(colours)))
+
+def test_signature_changes_with_mode_and_palette():
+    colours = quantize.blend_palette(0.5)
+    signatures = {quantize.palette_signature(mode, colours) for mode in quantize.DITHER_MODES}
+    signatures.add(quantize.palette_signature(quantize.DITHER_NEAREST, quantize.blend_palette(0.6)))
+    assert len(signatures) == len(quantize.DITHER_MODES) + 1
+
+def test_only_recent_lookup_tables_are_kept(tmp_path, monkeypatch):
+    monkeypatch.setattr(quantize, 'LUT_MEMORY_LIMIT', 2)
+    monkeypatch.setattr(quantize, 'LUT_FILES_LIMIT', 3)
+    palettes = [[(shade, shade, shade)] + quantize.DESATURATED_PALETTE[1:] for shade in range(5)]
+    for palette in palettes:
+        quantize.get_palette_lut(palette)
+    assert len(quantize._lut_cache) == 2
+    assert len(list(tmp_path.glob('*.npy'))) == 3
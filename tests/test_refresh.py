@@ -0,0 +1,70 @@
+import numpy
+import threading
+import time
+
+def wait_for_refreshes(app, timeout=30):
+    """Wait until no display refresh is pending or running"""
+    deadline = time.monotonic() + timeout
+    while app.get_refresh_status()['state'] in ('pending', 'running'):
+        assert time.monotonic() < deadline, "Display refreshes did not finish"
+        time.sleep(0.05)
+
+def test_refreshes_queued_while_one_runs_are_coalesced(frame_app):
+    wait_for_refreshes(frame_app)
+    started, release = threading.Event(), threading.Event()
+    ran = []
+    def blocking():
+        started.set()
+        release.wait(10)
+        ran.append('first')
+
+    first = frame_app.request_display_update('web', blocking)
+    assert started.wait(10)
+    second = frame_app.request_display_update('web', lambda: ran.append('second'))
+    third = frame_app.request_display_update('web', lambda: ran.append('third'))
+
+    assert frame_app.get_refresh_status(first)['state'] == 'running'
+    assert frame_app.get_refresh_status(second)['state'] == 'pending'
+    status = frame_app.get_refresh_status()
+    assert status['pending']['id'] == third and status['running']['id'] == first
+
+    release.set()
+    wait_for_refreshes(frame_app)
+    assert ran == ['first', 'third']
+    assert [frame_app.get_refresh_status(request_id)['state'] for request_id in (first, second, third)] == ['done'] * 3
+
+def test_failed_refreshes_are_reported(frame_app):
+    wait_for_refreshes(frame_app)
+    request_id = frame_app.request_display_update('web', lambda: False)
+    wait_for_refreshes(frame_app)
+    assert frame_app.get_refresh_status(request_id)['state'] == 'failed'
+    assert frame_app.get_refresh_status(request_id + 1)['state'] == 'unknown'
+
+def test_identical_frames_are_not_sent_to_the_panel_again(frame_app):
+    wait_for_refreshes(frame_app)
+    display = frame_app.display
+    frame = numpy.full((display.height, display.width), 3, dtype=numpy.uint8)
+    shows = display.show_count
+    assert frame_app.show_frame(frame, 'same.jpg')
+    assert not frame_app.show_frame(frame.copy(), 'same.jpg')
+    assert display.show_count == shows + 1
+
+    frame[0, 0] = 4
+    assert frame_app.show_frame(frame, 'same.jpg')
+    assert display.show_count == shows + 2
+
+def test_only_unrequested_refreshes_are_held_by_the_rate_limit(frame_app, monkeypatch):
+    wait_for_refreshes(frame_app)
+    monkeypatch.setitem(frame_app.settings, 'min_refresh_minutes', 1)
+    monkeypatch.setattr(frame_app, 'last_show_time', time.monotonic())
+    ran = []
+
+    scheduled = frame_app.request_display_update('scheduler', lambda: ran.append('scheduler'))
+    time.sleep(0.2)
+    status = frame_app.get_refresh_status(scheduled)
+    assert status['state'] == 'pending' and status['held'] and status['pending']['held_for'] > 0
+
+    # A refresh asked for from the web interface replaces it and runs straight away
+    frame_app.request_display_update('web', lambda: ran.append('web'))
+    wait_for_refreshes(frame_app, timeout=5)
+    assert ran == ['web']
@@ -0,0 +1,83 @@
+import io
+import os
+from contextlib import closing
+from datetime import datetime, timedelta
+from PIL import Image
+from conftest import wait_for_batch
+
+def stored_photo_key(frame_app):
+    """Upload a photo and return its content hash"""
+    buf = io.BytesIO()
+    Image.new('RGB', (320, 240), (120, 60, 200)).save(buf, 'JPEG')
+    buf.seek(0)
+    client = frame_app.app.test_client()
+    response = client.post('/upload', data={'photos': [(buf, 'target.jpg')]}, content_type='multipart/form-data',
+                           headers={'Accept': 'application/json'})
+    item = wait_for_batch(client, response.get_json()['status_url'])['items'][0]
+    filename = item['filename'] or item['duplicate_of']  # Stored by an earlier test
+    with closing(frame_app.catalog_connection()) as conn:
+        return conn.execute("SELECT content_hash FROM photos WHERE filename = ?", (filename,)).fetchone()[0]
+
+def test_frames_remember_only_served_targets(frame_app):
+    key = stored_photo_key(frame_app)
+    client = frame_app.app.test_client()
+    with frame_app.render_targets_lock:
+        frame_app.render_targets.clear()
+
+    assert client.get(f'/frames/{key}?width=4096&height=2&orientation=0').status_code == 400
+    assert client.get('/frames/unknown?width=40&height=30&orientation=0').status_code == 404
+    assert frame_app.render_targets == {}
+
+    assert client.get(f'/frames/{key}?width=40&height=30&orientation=0&saturation=0.5049').status_code == 200
+    assert client.get(f'/frames/{key}?width=40&height=30&orientation=0&saturation=0.4951').status_code == 200
+    assert [target['colours']['saturation'] for target in frame_app.render_targets.values()] == [0.5]
+    with frame_app.render_targets_lock:
+        frame_app.render_targets.clear()
+
+def test_render_targets_are_limited_and_expire(frame_app):
+    with frame_app.render_targets_lock:
+        frame_app.render_targets.clear()
+    for width in range(2, 2 + 2 * (frame_app.RENDER_TARGETS_LIMIT + 3), 2):
+        frame_app.remember_render_target((width, 10), '0', {'dither': 'diffusion', 'saturation': 0.5, 'palette': None})
+    assert len(frame_app.render_targets) == frame_app.RENDER_TARGETS_LIMIT
+
+    oldest = min(frame_app.render_targets, key=lambda key: frame_app.render_targets[key]['last_requested'])
+    expired = datetime.now() - timedelta(days=frame_app.RENDER_TARGET_EXPIRY_DAYS + 1)
+    with frame_app.render_targets_lock:
+        frame_app.render_targets[oldest]['last_requested'] = expired.isoformat()
+        frame_app.expire_render_targets()
+    assert oldest not in frame_app.render_targets
+    with frame_app.render_targets_lock:
+        frame_app.render_targets.clear()  # Don't render later tests' uploads for these
+
+def test_frames_of_forgotten_targets_are_deleted(frame_app):
+    colours = {'dither': 'nearest', 'saturation': 0.5, 'palette': None}
+    layout = f"0.2x10.{frame_app.frame_signature(colours)}"
+    frame_path = os.path.join(frame_app.app.config['FRAME_CACHE_FOLDER'], f"somephoto.{layout}.frame")
+    with frame_app.render_targets_lock:
+        frame_app.render_targets.clear()
+    frame_app.remember_render_target((2, 10), '0', colours)
+    open(frame_path, 'wb').close()
+
+    expired = datetime.now() - timedelta(days=frame_app.RENDER_TARGET_EXPIRY_DAYS + 1)
+    with frame_app.render_targets_lock:
+        frame_app.render_targets[layout]['last_requested'] = expired.isoformat()
+    frame_app.remember_render_target((4, 10), '0', colours)
+    assert layout not in frame_app.render_targets
+    assert not os.path.exists(frame_path)
+    with frame_app.render_targets_lock:
+        frame_app.render_targets.clear()
+
+def test_prune_keeps_only_frames_for_the_current_colours(frame_app):
+    key = stored_photo_key(frame_app)
+    width, height = frame_app.display.width, frame_app.display.height
+    old_colours = {'dither': 'ordered', 'saturation': 0.1, 'palette': None}
+    folder = frame_app.app.config['FRAME_CACHE_FOLDER']
+    current = os.path.join(folder, f"{key}.0.{width}x{height}.{frame_app.frame_signature()}.frame")
+    stale = os.path.join(folder, f"{key}.0.{width}x{height}.{frame_app.frame_signature(old_colours)}.frame")
+    for path in (current, stale):
+        open(path, 'wb').close()
+        os.utime(path, (0, 0))  # Older than the prune
+    frame_app.prune_artifacts()
+    assert os.path.exists(current)
+    assert not os.path.exists(stale)
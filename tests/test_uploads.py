@@ -0,0 +1,106 @@
+import io
+import os
+import zipfile
+import pytest
+from PIL import Image
+from conftest import wait_for_batch
+
+def jpeg_bytes(colour):
+    buf = io.BytesIO()
+    Image.new('RGB', (320, 240), colour).save(buf, 'JPEG')
+    return buf.getvalue()
+
+def test_import_keeps_photos_with_the_same_name(frame_app):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zf:
+        for folder, colour in (('2019', (200, 30, 30)), ('2020', (30, 200, 30)), ('2021', (30, 30, 200))):
+            zf.writestr(f"{folder}/IMG_0001.jpg", jpeg_bytes(colour))
+
+    client = frame_app.app.test_client()
+    response = client.post('/import?name=album.zip', data=archive.getvalue())
+    assert response.status_code == 202
+    status = wait_for_batch(client, response.get_json()['status_url'])
+
+    filenames = [item['filename'] for item in status['items']]
+    assert [item['state'] for item in status['items']] == ['done'] * 3
+    assert len(set(filenames)) == 3
+    for filename in filenames:
+        assert os.path.getsize(os.path.join(frame_app.app.config['UPLOAD_FOLDER'], filename)) > 0
+    assert set(filenames) <= set(frame_app.list_photos())
+    assert not [name for name in os.listdir(frame_app.app.config['SPOOL_FOLDER'])
+                if name.startswith(response.get_json()['import_id'])]
+
+def test_reserved_names_get_a_counter(frame_app):
+    first = frame_app.reserve_photo_filename('same.jpg')
+    second = frame_app.reserve_photo_filename('same.jpg')
+    assert first != second
+    assert second.endswith('same_2.jpg') or first[:15] != second[:15]
+
+def test_archives_on_the_frame_are_imported_by_path(frame_app, tmp_path):
+    path = tmp_path / 'album.zip'
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('by_path.jpg', jpeg_bytes((90, 140, 10)))
+    client = frame_app.app.test_client()
+
+    response = client.post(f'/import?path={path}', environ_base={'REMOTE_ADDR': '192.168.1.20'})
+    assert response.status_code == 403
+
+    response = client.post(f'/import?path={path}')
+    assert response.status_code == 202
+    status = wait_for_batch(client, response.get_json()['status_url'])
+    assert [item['state'] for item in status['items']] == ['done']
+    assert path.exists()
+
+def send_chunks(client, upload_id, data, chunk_size, start=0):
+    """Send an upload, or the rest of it from byte start, in chunks through the chunked upload protocol"""
+    for offset in range(0, len(data), chunk_size):
+        response = client.put(f'/upload_chunks/{upload_id}?offset={start + offset}',
+                              data=data[offset:offset + chunk_size])
+        assert response.status_code == 200
+
+@pytest.mark.parametrize('keep, colour', [(True, (10, 90, 200)), (False, (200, 90, 10))])
+def test_finished_uploads_keep_originals_when_asked(frame_app, keep, colour):
+    client = frame_app.app.test_client()
+    data = jpeg_bytes(colour)
+    upload_id = f"keep{int(keep)}"
+    send_chunks(client, upload_id, data, 1000)
+    response = client.post('/upload_chunks/finish', json={
+        'uploads': [{'upload_id': upload_id, 'name': f'keep{int(keep)}.jpg', 'size': len(data)}],
+        'keep_originals': keep})
+    assert response.status_code == 202
+    filename = wait_for_batch(client, response.get_json()['status_url'])['items'][0]['filename']
+    assert os.path.exists(os.path.join(frame_app.app.config['ORIGINALS_FOLDER'], filename)) == keep
+
+def test_chunked_uploads_resume_after_a_lost_chunk(frame_app):
+    client = frame_app.app.test_client()
+    data = jpeg_bytes((150, 20, 150))
+    upload_id = 'resumed'
+    assert client.put(f'/upload_chunks/{upload_id}?offset=0', data=data[:200]).get_json()['offset'] == 200
+
+    # A chunk resent after its response was lost is out of step
+    response = client.put(f'/upload_chunks/{upload_id}?offset=0', data=data[:200])
+    assert response.status_code == 409
+    assert response.get_json()['offset'] == 200
+    response = client.put(f'/upload_chunks/{upload_id}?offset=600', data=data[600:800])
+    assert response.status_code == 409
+
+    # After a reload the page asks where to carry on from
+    offset = client.get(f'/upload_chunks/{upload_id}').get_json()['offset']
+    assert offset == 200
+    send_chunks(client, upload_id, data[offset:], 200, start=offset)
+    response = client.post('/upload_chunks/finish', json={
+        'uploads': [{'upload_id': upload_id, 'name': 'resumed.jpg', 'size': len(data)}]})
+    assert response.status_code == 202
+    status = wait_for_batch(client, response.get_json()['status_url'])
+    assert [item['state'] for item in status['items']] == ['done']
+    assert client.get(f'/upload_chunks/{upload_id}').get_json()['offset'] == 0
+
+def test_incomplete_chunked_uploads_are_not_finished(frame_app):
+    client = frame_app.app.test_client()
+    data = jpeg_bytes((20, 150, 150))
+    send_chunks(client, 'partial', data[:200], 200)
+    response = client.post('/upload_chunks/finish', json={
+        'uploads': [{'upload_id': 'partial', 'name': 'partial.jpg', 'size': len(data)}]})
+    assert response.status_code == 400
+    assert response.get_json()['errors'][0]['upload_id'] == 'partial'
+    assert client.get('/upload_chunks/partial').get_json()['offset'] == 200